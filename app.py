@@ -2,22 +2,57 @@ from werkzeug.security import generate_password_hash, check_password_hash
 
 import os
 import csv
+import multiprocessing
 import re
+import json
+import shutil
+import uuid
+import hashlib
+import base64
+import binascii
+import time
+import threading
+import smtplib
 import requests
+import requests.adapters
 import psycopg2
-from datetime import datetime, date
+import psycopg2.errors
+import psycopg2.pool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import execute_values
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+from email.message import EmailMessage
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    session, send_from_directory, jsonify, flash, Response
+    session, send_from_directory, send_file, jsonify, flash, Response
 )
 from werkzeug.utils import secure_filename
 from functools import wraps
 
 import cloudinary
 import cloudinary.uploader
+import cloudinary.utils
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+try:
+    import pytesseract  # OCR local (optionnel : nécessite aussi le binaire tesseract)
+except ImportError:
+    pytesseract = None
 
 import io
-from PIL import Image as PILImage
+from receipt_image import preprocess_receipt, tesseract_text
+from receipt_parser import parse_receipt
+from expense_rows import (
+    EXPENSE_COLUMNS, REPORT_CSV_HEADER, ALL_EXPENSES_CSV_HEADER,
+    expense_from_row, expense_json, expense_report_csv_row, expense_full_csv_row,
+    expense_pdf_cells,
+)
+from PIL import Image as PILImage, ImageOps, UnidentifiedImageError
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm
@@ -58,8 +93,8 @@ def upload_receipt(file):
     """
     Upload du justificatif.
     - Si Cloudinary est configuré : upload dans le cloud et on stocke l'URL.
-    - Sinon : stockage en local dans /uploads, on stocke le nom de fichier.
-    On retourne une 'receipt_path' (URL ou nom de fichier).
+    - Sinon : stockage local adressé par contenu (voir store_receipt_blob).
+    On retourne une 'receipt_path' (URL ou chemin relatif dans /uploads).
     """
     if not file or not file.filename:
         return None
@@ -70,10 +105,229 @@ def upload_receipt(file):
         return result.get("secure_url")
     else:
         # Fallback local
-        filename = secure_filename(file.filename)
-        save_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        file.save(save_path)
-        return filename
+        return store_receipt_blob(file.stream, file.filename)
+
+
+# -----------------------------------------------------------------------------#
+# STOCKAGE LOCAL DES JUSTIFICATIFS : adressé par contenu (SHA-256)
+# -----------------------------------------------------------------------------#
+# uploads/ab/cd/abcd...<64 hex>.jpg : deux envois identiques = un seul fichier, plus
+# d'écrasement entre "image.jpg" de téléphones différents, et des dossiers de taille
+# raisonnable. La table receipt_blobs compte les notes qui pointent vers chaque fichier.
+RECEIPT_UPLOAD_CHUNK = 64 * 1024
+RECEIPT_BLOB_RE = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})(\.[a-z0-9]+)?$")
+RECEIPT_FORMAT_EXTENSIONS = {"JPEG": ".jpg", "MPO": ".jpg", "PNG": ".png", "WEBP": ".webp", "GIF": ".gif"}
+# Fichier adressé par contenu = jamais modifié : cache navigateur d'un an
+RECEIPT_CACHE_MAX_AGE = 365 * 24 * 3600
+
+
+def write_receipt_tmp(stream, max_bytes=None):
+    """
+    Copie un flux dans un fichier temporaire par morceaux, en calculant le SHA-256 au passage.
+    Retourne (chemin temporaire, sha256, taille). Lève ValueError si max_bytes est dépassé.
+    """
+    tmp_dir = os.path.join(app.config["UPLOAD_FOLDER"], "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f"{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            while True:
+                chunk = stream.read(RECEIPT_UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise ValueError("Fichier trop volumineux")
+                digest.update(chunk)
+                f.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size
+
+
+def receipt_extension(path, filename=None):
+    """Extension d'après le contenu (format détecté par Pillow), sinon d'après le nom d'origine."""
+    try:
+        with PILImage.open(path) as img:
+            ext = RECEIPT_FORMAT_EXTENSIONS.get(img.format)
+            if ext:
+                return ext
+    except (UnidentifiedImageError, OSError):
+        pass
+    ext = os.path.splitext(secure_filename(filename or ""))[1].lower()
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,5}", ext) else ""
+
+
+def commit_receipt_blob(tmp_path, sha256, filename=None):
+    """Range le fichier temporaire à son adresse de contenu. Retourne le chemin relatif."""
+    rel_path = f"{sha256[:2]}/{sha256[2:4]}/{sha256}{receipt_extension(tmp_path, filename)}"
+    final_path = os.path.join(app.config["UPLOAD_FOLDER"], rel_path)
+    if os.path.exists(final_path):
+        # déjà stocké : même contenu, on garde l'existant ; date rafraîchie pour que
+        # sweep_orphan_receipts le laisse au nouveau jeton le temps d'être utilisé
+        os.remove(tmp_path)
+        os.utime(final_path)
+    else:
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+    return rel_path
+
+
+def store_receipt_blob(stream, filename=None):
+    tmp_path, sha256, _ = write_receipt_tmp(stream)
+    return commit_receipt_blob(tmp_path, sha256, filename)
+
+
+def add_receipt_ref(cur, receipt_path):
+    """
+    Une note de plus pointe vers ce justificatif local (dans la transaction qui l'insère).
+    Lève ValueError si le fichier a disparu entre-temps (supprimé avec sa dernière note).
+    """
+    m = RECEIPT_BLOB_RE.match(receipt_path or "")
+    if not m:
+        return
+    full_path = os.path.join(app.config["UPLOAD_FOLDER"], receipt_path)
+    size = os.path.getsize(full_path) if os.path.exists(full_path) else 0
+    # même verrou que remove_released_receipts : le fichier ne peut pas être effacé
+    # entre la vérification ci-dessous et le commit de cette note
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (receipt_lock_id(m.group(1)),))
+    cur.execute(
+        """
+        INSERT INTO receipt_blobs (sha256, path, size, refcount)
+        VALUES (%s, %s, %s, 1)
+        ON CONFLICT (sha256) DO UPDATE SET refcount = receipt_blobs.refcount + 1
+        """,
+        (m.group(1), receipt_path, size)
+    )
+    if not os.path.exists(full_path):
+        raise ValueError("Le justificatif a été supprimé entre-temps, merci de le renvoyer.")
+
+
+def receipt_lock_id(sha256):
+    """Clé du verrou consultatif d'un justificatif (ajout de référence / effacement du fichier)."""
+    return int(sha256[:15], 16)
+
+
+def release_receipt(cur, receipt_path):
+    """
+    À appeler après le DELETE d'une note qui pointait vers ce justificatif (même transaction).
+    Retourne le chemin à effacer APRÈS le commit (voir remove_released_receipts) si c'était
+    sa dernière référence, sinon None.
+    """
+    if not receipt_path or receipt_path.startswith("http"):
+        return None
+    m = RECEIPT_BLOB_RE.match(receipt_path)
+    if m:
+        cur.execute(
+            """
+            UPDATE receipt_blobs SET refcount = refcount - 1
+            WHERE sha256 = %s
+            RETURNING refcount
+            """,
+            (m.group(1),)
+        )
+        row = cur.fetchone()
+        if row and row[0] > 0:
+            return None
+        cur.execute("DELETE FROM receipt_blobs WHERE sha256 = %s", (m.group(1),))
+    else:
+        # ancien fichier à plat (nom d'origine) : peut être partagé par plusieurs notes
+        cur.execute(
+            "SELECT count(*) FROM expenses WHERE receipt_path = %s",
+            (receipt_path,)
+        )
+        if cur.fetchone()[0] > 0:
+            return None
+    return receipt_path
+
+
+def remove_released_receipts(receipt_paths):
+    """
+    Efface les fichiers rendus par release_receipt, une fois la suppression des notes
+    validée (commit) : un rollback ne fait jamais perdre de justificatif. Un fichier
+    réutilisé entre-temps par une nouvelle note est gardé ; un échec ici ne laisse
+    qu'un fichier orphelin. Ses miniatures / aperçus en cache sont effacés avec lui.
+    """
+    receipt_paths = [p for p in receipt_paths if p]
+    if not receipt_paths:
+        return
+    try:
+        with get_db() as conn:
+            cur = conn.cursor()
+            for receipt_path in receipt_paths:
+                m = RECEIPT_BLOB_RE.match(receipt_path)
+                if m:
+                    cur.execute("SELECT pg_advisory_xact_lock(%s)", (receipt_lock_id(m.group(1)),))
+                    cur.execute("SELECT 1 FROM receipt_blobs WHERE sha256 = %s", (m.group(1),))
+                    if cur.fetchone():
+                        conn.commit()
+                        continue
+                full_path = os.path.join(app.config["UPLOAD_FOLDER"], receipt_path)
+                # chemins des versions réduites calculés avant (ancien fichier à plat : stat)
+                cached_paths = receipt_derivative_paths(receipt_path)
+                try:
+                    for path in cached_paths + [full_path]:
+                        if os.path.exists(path):
+                            os.remove(path)
+                except OSError as e:
+                    print(f"[RECEIPT] Effacement impossible de {receipt_path} : {e!r}", flush=True)
+                conn.commit()
+    except psycopg2.Error as e:
+        print(f"[RECEIPT] Effacement des justificatifs libérés interrompu : {e!r}", flush=True)
+
+
+def sweep_orphan_receipts():
+    """
+    python app.py sweep_receipts (cron quotidien) : efface les justificatifs adressés par
+    contenu qu'aucune note ne référence (envoi direct puis formulaire abandonné, insertion
+    échouée, jeton refusé), plus vieux que RECEIPT_UPLOAD_TOKEN_TTL : leur jeton a expiré,
+    plus rien ne peut les rattacher à une note. Idem pour les envois interrompus de tmp/.
+    """
+    upload_dir = app.config["UPLOAD_FOLDER"]
+    cutoff = time.time() - RECEIPT_UPLOAD_TOKEN_TTL
+
+    tmp_dir = os.path.join(upload_dir, "tmp")
+    if os.path.isdir(tmp_dir):
+        for name in os.listdir(tmp_dir):
+            path = os.path.join(tmp_dir, name)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+
+    candidates = {}
+    for root, dirs, files in os.walk(upload_dir):
+        if root == upload_dir:
+            dirs[:] = [d for d in dirs if d != "tmp"]
+        for name in files:
+            full_path = os.path.join(root, name)
+            rel_path = os.path.relpath(full_path, upload_dir).replace(os.sep, "/")
+            m = RECEIPT_BLOB_RE.match(rel_path)
+            if m and os.path.getmtime(full_path) < cutoff:
+                candidates[m.group(1)] = rel_path
+    if not candidates:
+        return 0
+
+    removed = 0
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT sha256 FROM receipt_blobs WHERE sha256 = ANY(%s)", (list(candidates),))
+        referenced = {r[0] for r in cur.fetchall()}
+        for sha256, rel_path in candidates.items():
+            if sha256 in referenced:
+                continue
+            # même verrou que add_receipt_ref : pas d'effacement pendant qu'une note s'y rattache
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (receipt_lock_id(sha256),))
+            cur.execute("SELECT 1 FROM receipt_blobs WHERE sha256 = %s", (sha256,))
+            if cur.fetchone() is None:
+                for path in receipt_derivative_paths(rel_path) + [os.path.join(upload_dir, rel_path)]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                removed += 1
+            conn.commit()
+    print(f"[RECEIPT] {removed} justificatif(s) sans note effacé(s).", flush=True)
+    return removed
 
 
 # -----------------------------------------------------------------------------#
@@ -81,23 +335,211 @@ def upload_receipt(file):
 # -----------------------------------------------------------------------------#
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
+# Pool de connexions (un pool par worker gunicorn)
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "5"))
+# Attente max (secondes) quand toutes les connexions sont prises
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+# Une connexion inactive depuis plus longtemps est vérifiée (SELECT 1) avant usage
+DB_POOL_CHECK_AFTER = float(os.environ.get("DB_POOL_CHECK_AFTER", "30"))
+# Au-delà de DB_POOL_MIN, une connexion inactive depuis plus longtemps est fermée
+DB_POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", "300"))
 
-def get_db():
+
+class ConnectionPool:
+    """
+    Pool de connexions PostgreSQL, thread-safe.
+    - ouvre les connexions à la demande, jusqu'à maxconn
+    - si tout est pris : attente (bornée par timeout) qu'une connexion soit rendue
+    - vérifie au checkout les connexions restées inactives trop longtemps
+    - ferme les connexions inactives au-delà de minconn
+    """
+
+    def __init__(self, dsn, minconn, maxconn, timeout, **connect_kwargs):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = max(maxconn, 1)
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+        self._idle = []  # [(conn, last_used)] ; la fin de liste = la plus récente
+        self._size = 0   # connexions ouvertes (inactives + empruntées)
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_ms": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "discarded": 0,
+        }
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _recycle_idle(self):
+        """Ferme les connexions inactives depuis trop longtemps (appelé sous verrou)."""
+        now = time.monotonic()
+        while (
+            self._idle
+            and self._size > self.minconn
+            and now - self._idle[0][1] > DB_POOL_MAX_IDLE
+        ):
+            conn, _ = self._idle.pop(0)
+            self._close(conn)
+            self._size -= 1
+            self._stats["discarded"] += 1
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < DB_POOL_CHECK_AFTER:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        conn = None
+        last_used = None
+        waited = False
+
+        with self._cond:
+            self._stats["checkouts"] += 1
+            while True:
+                self._recycle_idle()
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    # On réserve la place, la connexion est ouverte hors verrou
+                    self._size += 1
+                    break
+                waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise psycopg2.pool.PoolError(
+                        f"Aucune connexion disponible après {self.timeout:g}s"
+                    )
+                self._cond.wait(remaining)
+            if waited:
+                self._stats["waits"] += 1
+                self._stats["wait_time_ms"] += (time.monotonic() - start) * 1000
+
+        if conn is not None and not self._is_healthy(conn, last_used):
+            self._close(conn)
+            with self._cond:
+                self._stats["discarded"] += 1
+            conn = None
+
+        if conn is None:
+            try:
+                conn = psycopg2.connect(self.dsn, **self.connect_kwargs)
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._stats["created"] += 1
+
+        return conn
+
+    def putconn(self, conn):
+        broken = bool(conn.closed)
+        if not broken and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            # Transaction non commitée (exception, return anticipé...) : on annule
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+
+        with self._cond:
+            if broken:
+                self._close(conn)
+                self._size -= 1
+                self._stats["discarded"] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            data = dict(self._stats)
+            data["wait_time_ms"] = round(data["wait_time_ms"], 1)
+            data.update({
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min": self.minconn,
+                "max": self.maxconn,
+                "pid": os.getpid(),
+            })
+            return data
+
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    """
+    Pool du process courant. Recréé après un fork : les connexions héritées
+    du process parent ne doivent pas être partagées (ni fermées) par l'enfant.
+    """
+    global _db_pool, _db_pool_pid
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL is not set")
-    conn = psycopg2.connect(
-        DATABASE_URL,
-        sslmode=os.environ.get("DB_SSLMODE", "require")
-    )
-    return conn
+    pid = os.getpid()
+    if _db_pool is None or _db_pool_pid != pid:
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool_pid != pid:
+                _db_pool = ConnectionPool(
+                    DATABASE_URL,
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    DB_POOL_TIMEOUT,
+                    sslmode=os.environ.get("DB_SSLMODE", "require"),
+                )
+                _db_pool_pid = pid
+    return _db_pool
 
 
-def init_db():
-    conn = get_db()
-    cur = conn.cursor()
+@contextmanager
+def get_db():
+    """
+    Emprunte une connexion au pool, et la rend toujours en sortie du bloc :
+        with get_db() as conn:
+            ...
+            conn.commit()
+    Ce qui n'a pas été commité est annulé au retour dans le pool.
+    """
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
 
-    # Table users
-    cur.execute("""
+# -----------------------------------------------------------------------------#
+# MIGRATIONS DU SCHÉMA (python app.py migrate, une fois par déploiement)
+# -----------------------------------------------------------------------------#
+# Liste ordonnée de (version, description, [requêtes]).
+# Une migration déjà appliquée ne doit plus être modifiée : on en ajoute une nouvelle.
+MIGRATIONS = [
+    (1, "Tables users et expenses", [
+        """
         CREATE TABLE IF NOT EXISTS users (
             id SERIAL PRIMARY KEY,
             email TEXT UNIQUE NOT NULL,
@@ -106,10 +548,9 @@ def init_db():
             last_name TEXT,
             is_active BOOLEAN NOT NULL DEFAULT TRUE
         );
-    """)
-
-    # Table expenses (avec status + validation + HT/TVA + payment_method + comment_text)
-    cur.execute("""
+        """,
+        # avec status + validation + HT/TVA + payment_method + comment_text
+        """
         CREATE TABLE IF NOT EXISTS expenses (
             id SERIAL PRIMARY KEY,
             user_email TEXT NOT NULL,
@@ -127,49 +568,388 @@ def init_db():
             validated_at TIMESTAMPTZ,
             created_at TIMESTAMP NOT NULL
         );
-    """)
-
-    # Ajout des colonnes HT / TVA / moyen de paiement / commentaire si base déjà existante
-    cur.execute("""
-        ALTER TABLE expenses
-        ADD COLUMN IF NOT EXISTS amount_ht NUMERIC(10,2);
-    """)
-    cur.execute("""
-        ALTER TABLE expenses
-        ADD COLUMN IF NOT EXISTS tva_amount NUMERIC(10,2);
-    """)
-    cur.execute("""
-        ALTER TABLE expenses
-        ADD COLUMN IF NOT EXISTS payment_method TEXT;
-    """)
-    cur.execute("""
-        ALTER TABLE expenses
-        ADD COLUMN IF NOT EXISTS comment_text TEXT;
-    """)
-
-    conn.commit()
-    conn.close()
-
-
-# IMPORTANT : on initialise la DB au chargement du module
-init_db()
+        """,
+        # colonnes ajoutées après coup sur les bases déjà existantes
+        "ALTER TABLE expenses ADD COLUMN IF NOT EXISTS amount_ht NUMERIC(10,2);",
+        "ALTER TABLE expenses ADD COLUMN IF NOT EXISTS tva_amount NUMERIC(10,2);",
+        "ALTER TABLE expenses ADD COLUMN IF NOT EXISTS payment_method TEXT;",
+        "ALTER TABLE expenses ADD COLUMN IF NOT EXISTS comment_text TEXT;",
+    ]),
+    (2, "Index de listing et de rapports sur expenses", [
+        # liste d'un utilisateur (WHERE user_email = ... ORDER BY date, id)
+        "CREATE INDEX IF NOT EXISTS expenses_user_date_idx ON expenses (user_email, date, id);",
+        # liste admin paginée (ORDER BY date, id)
+        "CREATE INDEX IF NOT EXISTS expenses_date_id_idx ON expenses (date, id);",
+        # rapports mensuels (date dans le mois, status = 'approved')
+        "CREATE INDEX IF NOT EXISTS expenses_date_status_idx ON expenses (date, status);",
+        "CREATE INDEX IF NOT EXISTS expenses_status_idx ON expenses (status);",
+    ]),
+    (3, "File d'envoi des notifications (outbox)", [
+        """
+        CREATE TABLE IF NOT EXISTS mail_outbox (
+            id SERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            expense_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            sent_at TIMESTAMPTZ
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS mail_outbox_pending_idx
+        ON mail_outbox (next_attempt_at) WHERE status = 'pending';
+        """,
+    ]),
+    (4, "Exports en arrière-plan", [
+        """
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            params JSONB NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'queued',
+            rows_done INTEGER,
+            rows_total INTEGER,
+            receipts_done INTEGER,
+            receipts_total INTEGER,
+            file_path TEXT,
+            filename TEXT,
+            error TEXT,
+            created_by TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMPTZ,
+            expires_at TIMESTAMPTZ
+        );
+        """,
+    ]),
+    (5, "Récaps mensuels matérialisés", [
+        # version incrémentée à chaque note ajoutée / validée / refusée / supprimée du mois
+        """
+        CREATE TABLE IF NOT EXISTS report_months (
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (year, month)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS report_snapshots (
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            approved_only BOOLEAN NOT NULL,
+            version INTEGER NOT NULL,
+            content_hash TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            total_ttc NUMERIC(12,2) NOT NULL,
+            total_ht NUMERIC(12,2) NOT NULL,
+            total_tva NUMERIC(12,2) NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (year, month, kind, approved_only)
+        );
+        """,
+    ]),
+    (6, "Totaux pré-agrégés mois × chantier × utilisateur × statut", [
+        """
+        CREATE TABLE IF NOT EXISTS expense_summary (
+            month DATE NOT NULL,
+            chantier TEXT NOT NULL,
+            user_email TEXT NOT NULL,
+            status TEXT NOT NULL,
+            expense_count INTEGER NOT NULL DEFAULT 0,
+            total_ttc NUMERIC(14,2) NOT NULL DEFAULT 0,
+            total_ht NUMERIC(14,2) NOT NULL DEFAULT 0,
+            total_tva NUMERIC(14,2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, chantier, user_email, status)
+        );
+        """,
+        # Mise à jour incrémentale par trigger : toute écriture sur expenses
+        # (formulaire, validation, suppression, futurs traitements en lot) est prise en compte.
+        """
+        CREATE OR REPLACE FUNCTION expense_summary_apply() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO expense_summary AS s
+                    (month, chantier, user_email, status,
+                     expense_count, total_ttc, total_ht, total_tva)
+                VALUES
+                    (date_trunc('month', OLD.date)::date, OLD.chantier, OLD.user_email, OLD.status,
+                     -1, -OLD.amount, -COALESCE(OLD.amount_ht, 0), -COALESCE(OLD.tva_amount, 0))
+                ON CONFLICT (month, chantier, user_email, status) DO UPDATE
+                SET expense_count = s.expense_count + EXCLUDED.expense_count,
+                    total_ttc = s.total_ttc + EXCLUDED.total_ttc,
+                    total_ht = s.total_ht + EXCLUDED.total_ht,
+                    total_tva = s.total_tva + EXCLUDED.total_tva;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO expense_summary AS s
+                    (month, chantier, user_email, status,
+                     expense_count, total_ttc, total_ht, total_tva)
+                VALUES
+                    (date_trunc('month', NEW.date)::date, NEW.chantier, NEW.user_email, NEW.status,
+                     1, NEW.amount, COALESCE(NEW.amount_ht, 0), COALESCE(NEW.tva_amount, 0))
+                ON CONFLICT (month, chantier, user_email, status) DO UPDATE
+                SET expense_count = s.expense_count + EXCLUDED.expense_count,
+                    total_ttc = s.total_ttc + EXCLUDED.total_ttc,
+                    total_ht = s.total_ht + EXCLUDED.total_ht,
+                    total_tva = s.total_tva + EXCLUDED.total_tva;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        "DROP TRIGGER IF EXISTS expense_summary_trg ON expenses;",
+        """
+        CREATE TRIGGER expense_summary_trg
+        AFTER INSERT OR DELETE
+           OR UPDATE OF date, chantier, user_email, status, amount, amount_ht, tva_amount
+        ON expenses
+        FOR EACH ROW EXECUTE FUNCTION expense_summary_apply();
+        """,
+        # Reprise de l'existant (le trigger bloque les écritures jusqu'au commit)
+        "DELETE FROM expense_summary;",
+        """
+        INSERT INTO expense_summary
+            (month, chantier, user_email, status,
+             expense_count, total_ttc, total_ht, total_tva)
+        SELECT date_trunc('month', date)::date, chantier, user_email, status,
+               COUNT(*), SUM(amount), COALESCE(SUM(amount_ht), 0), COALESCE(SUM(tva_amount), 0)
+        FROM expenses
+        GROUP BY 1, 2, 3, 4;
+        """,
+    ]),
+    (7, "Jobs OCR", [
+        """
+        CREATE TABLE IF NOT EXISTS ocr_jobs (
+            id TEXT PRIMARY KEY,
+            user_email TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            result JSONB,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMPTZ
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS ocr_jobs_created_at_idx ON ocr_jobs (created_at);",
+    ]),
+    (8, "Cache OCR par empreinte d'image et empreintes des justificatifs", [
+        """
+        CREATE TABLE IF NOT EXISTS ocr_cache (
+            content_hash TEXT PRIMARY KEY,
+            phash BIT(256) NOT NULL,
+            result JSONB NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+        "ALTER TABLE expenses ADD COLUMN IF NOT EXISTS receipt_sha256 TEXT;",
+        "ALTER TABLE expenses ADD COLUMN IF NOT EXISTS receipt_phash BIT(256);",
+        "CREATE INDEX IF NOT EXISTS expenses_receipt_sha256_idx ON expenses (receipt_sha256);",
+    ]),
+    (9, "Justificatifs locaux adressés par contenu (compteur de références)", [
+        """
+        CREATE TABLE IF NOT EXISTS receipt_blobs (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size BIGINT NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+    ]),
+    (10, "Date de dernière modification des notes (cache HTTP de /api/expenses)", [
+        "ALTER TABLE expenses ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ;",
+        # reprise de l'existant : dernière écriture connue (created_at est en UTC sans fuseau)
+        """
+        UPDATE expenses
+        SET updated_at = GREATEST(created_at AT TIME ZONE 'UTC', validated_at)
+        WHERE updated_at IS NULL;
+        """,
+        "ALTER TABLE expenses ALTER COLUMN updated_at SET DEFAULT clock_timestamp();",
+        "ALTER TABLE expenses ALTER COLUMN updated_at SET NOT NULL;",
+        # Trigger : toute modification (validation, refus, traitements en lot...) est datée
+        """
+        CREATE OR REPLACE FUNCTION expenses_touch_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := clock_timestamp();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        "DROP TRIGGER IF EXISTS expenses_touch_updated_at_trg ON expenses;",
+        """
+        CREATE TRIGGER expenses_touch_updated_at_trg
+        BEFORE UPDATE ON expenses
+        FOR EACH ROW EXECUTE FUNCTION expenses_touch_updated_at();
+        """,
+        "CREATE INDEX IF NOT EXISTS expenses_updated_at_idx ON expenses (updated_at);",
+        "CREATE INDEX IF NOT EXISTS expenses_user_updated_at_idx ON expenses (user_email, updated_at);",
+    ]),
+    (11, "Traces des notes supprimées (synchronisation par delta de /api/expenses)", [
+        """
+        CREATE TABLE IF NOT EXISTS expense_tombstones (
+            expense_id INTEGER PRIMARY KEY,
+            user_email TEXT NOT NULL,
+            deleted_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS expense_tombstones_deleted_at_idx ON expense_tombstones (deleted_at);",
+        # Trigger : toute suppression laisse une trace, quelle que soit la route
+        """
+        CREATE OR REPLACE FUNCTION expenses_tombstone() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO expense_tombstones (expense_id, user_email, deleted_at)
+            VALUES (OLD.id, OLD.user_email, clock_timestamp())
+            ON CONFLICT (expense_id) DO UPDATE SET deleted_at = EXCLUDED.deleted_at;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        "DROP TRIGGER IF EXISTS expenses_tombstone_trg ON expenses;",
+        """
+        CREATE TRIGGER expenses_tombstone_trg
+        AFTER DELETE ON expenses
+        FOR EACH ROW EXECUTE FUNCTION expenses_tombstone();
+        """,
+    ]),
+    (12, "Compteurs de version des notes par portée (ETag de /api/expenses)", [
+        # scope '*' = toutes les notes (admins), sinon l'email du propriétaire
+        """
+        CREATE TABLE IF NOT EXISTS expense_versions (
+            scope TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            changed_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+        );
+        """,
+        # Trigger par requête : une fois par INSERT/UPDATE/DELETE, pas par ligne.
+        # Le compteur n'est visible qu'au commit (verrou de ligne tenu jusque-là), contrairement
+        # à updated_at daté à l'écriture. '*' est toujours pris en premier : pas d'interblocage.
+        """
+        CREATE OR REPLACE FUNCTION expense_versions_bump() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO expense_versions (scope, version, changed_at)
+            VALUES ('*', 1, clock_timestamp())
+            ON CONFLICT (scope) DO UPDATE
+                SET version = expense_versions.version + 1, changed_at = EXCLUDED.changed_at;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO expense_versions (scope, version, changed_at)
+                SELECT DISTINCT user_email, 1, clock_timestamp() FROM new_rows
+                ON CONFLICT (scope) DO UPDATE
+                    SET version = expense_versions.version + 1, changed_at = EXCLUDED.changed_at;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO expense_versions (scope, version, changed_at)
+                SELECT DISTINCT user_email, 1, clock_timestamp() FROM old_rows
+                ON CONFLICT (scope) DO UPDATE
+                    SET version = expense_versions.version + 1, changed_at = EXCLUDED.changed_at;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        # Tables de transition : un seul événement par trigger
+        "DROP TRIGGER IF EXISTS expense_versions_insert_trg ON expenses;",
+        """
+        CREATE TRIGGER expense_versions_insert_trg
+        AFTER INSERT ON expenses
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION expense_versions_bump();
+        """,
+        "DROP TRIGGER IF EXISTS expense_versions_update_trg ON expenses;",
+        """
+        CREATE TRIGGER expense_versions_update_trg
+        AFTER UPDATE ON expenses
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION expense_versions_bump();
+        """,
+        "DROP TRIGGER IF EXISTS expense_versions_delete_trg ON expenses;",
+        """
+        CREATE TRIGGER expense_versions_delete_trg
+        AFTER DELETE ON expenses
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION expense_versions_bump();
+        """,
+    ]),
+    (13, "Purge du cache OCR et recherche bornée des justificatifs quasi identiques", [
+        "CREATE INDEX IF NOT EXISTS ocr_cache_created_at_idx ON ocr_cache (created_at);",
+        # candidats de la comparaison perceptuelle : les derniers justificatifs avec empreinte
+        """
+        CREATE INDEX IF NOT EXISTS expenses_receipt_phash_recent_idx
+        ON expenses (id) WHERE receipt_phash IS NOT NULL;
+        """,
+    ]),
+    (14, "Jetons d'upload de justificatif déjà utilisés (usage unique)", [
+        """
+        CREATE TABLE IF NOT EXISTS receipt_tokens_used (
+            token_id TEXT PRIMARY KEY,
+            used_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS receipt_tokens_used_used_at_idx ON receipt_tokens_used (used_at);",
+    ]),
+]
 
+# Verrou consultatif : deux déploiements simultanés ne migrent pas en même temps
+MIGRATIONS_LOCK_ID = 7310001
 
-def sync_users_from_csv():
+
+def run_migrations():
     """
-    Lit users.csv et synchronise dans la table users.
-    - crée les utilisateurs manquants
-    - met à jour prénom/nom si besoin
-    - NE réécrit PAS les mots de passe existants
+    Applique, dans l'ordre, les migrations plus récentes que la version
+    enregistrée dans schema_version. Chaque migration est dans sa propre transaction.
     """
-    csv_path = os.path.join(BASE_DIR, "users.csv")
-    if not os.path.exists(csv_path):
-        print("users.csv introuvable, pas de synchro utilisateurs.")
-        return
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+        try:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+            """)
+            conn.commit()
+
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            current = cur.fetchone()[0]
+
+            for version, description, statements in MIGRATIONS:
+                if version <= current:
+                    continue
+                print(f"[MIGRATE] {version} : {description}", flush=True)
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                    (version, description)
+                )
+                conn.commit()
+                current = version
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_ID,))
+            conn.commit()
+
+    print(f"[MIGRATE] Schéma à jour (version {current}).", flush=True)
+
+
+# Verrou consultatif : une seule synchro à la fois, les autres passent
+USERS_SYNC_LOCK_ID = 7310002
+# > 1 : les nouveaux mots de passe sont hashés dans un pool de process
+USERS_SYNC_HASH_WORKERS = int(os.environ.get("USERS_SYNC_HASH_WORKERS", "0"))
 
-    conn = get_db()
-    cur = conn.cursor()
 
+def read_users_csv(csv_path):
+    """
+    Lit users.csv -> {email: (password, prénom, nom)}.
+    Si un email apparaît plusieurs fois : mot de passe de la 1ère ligne, noms de la dernière.
+    """
+    users = {}
     with open(csv_path, encoding="latin-1") as f:
         reader = csv.DictReader(f, delimiter=";")
         for row in reader:
@@ -181,38 +961,102 @@ def sync_users_from_csv():
             if not email or not pwd:
                 continue
 
-            # Vérifier si l'utilisateur existe déjà
-            cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-            existing = cur.fetchone()
+            if email in users:
+                pwd = users[email][0]
+            users[email] = (pwd, first_name, last_name)
+    return users
+
+
+def hash_passwords(passwords):
+    """Hash (volontairement lent) d'une liste de mots de passe, en parallèle si configuré."""
+    if USERS_SYNC_HASH_WORKERS > 1 and len(passwords) > 1:
+        with ProcessPoolExecutor(max_workers=USERS_SYNC_HASH_WORKERS) as executor:
+            return list(executor.map(generate_password_hash, passwords))
+    return [generate_password_hash(pwd) for pwd in passwords]
+
+
+def sync_users_from_csv():
+    """
+    Lit users.csv et synchronise dans la table users.
+    - crée les utilisateurs manquants
+    - met à jour prénom/nom si besoin
+    - NE réécrit PAS les mots de passe existants
+    Un seul SELECT, puis insertions / mises à jour groupées dans une transaction.
+    Seuls les nouveaux utilisateurs paient le hash du mot de passe.
+    """
+    csv_path = os.path.join(BASE_DIR, "users.csv")
+    if not os.path.exists(csv_path):
+        print("users.csv introuvable, pas de synchro utilisateurs.")
+        return
+
+    csv_users = read_users_csv(csv_path)
+
+    with get_db() as conn:
+        cur = conn.cursor()
+
+        # Libéré au commit ; si un autre worker synchronise déjà, on ne refait rien
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (USERS_SYNC_LOCK_ID,))
+        if not cur.fetchone()[0]:
+            print("Synchronisation des utilisateurs déjà en cours ailleurs, ignorée.")
+            return
 
-            if existing:
+        cur.execute("SELECT email, first_name, last_name FROM users")
+        existing = {row[0]: (row[1] or "", row[2] or "") for row in cur.fetchall()}
+
+        to_update = []
+        new_emails = []
+        for email, (pwd, first_name, last_name) in csv_users.items():
+            if email not in existing:
+                new_emails.append(email)
+            elif existing[email] != (first_name, last_name):
                 # Mise à jour prénom/nom, mais on ne touche pas au mot de passe
-                cur.execute(
-                    """
-                    UPDATE users
-                    SET first_name = %s, last_name = %s
-                    WHERE email = %s
-                    """,
-                    (first_name, last_name, email)
-                )
-            else:
-                # Création avec mot de passe hashé
-                password_hash = generate_password_hash(pwd)
-                cur.execute(
-                    """
-                    INSERT INTO users (email, password_hash, first_name, last_name)
-                    VALUES (%s, %s, %s, %s)
-                    """,
-                    (email, password_hash, first_name, last_name)
-                )
+                to_update.append((email, first_name, last_name))
+
+        to_insert = []
+        if new_emails:
+            hashes = hash_passwords([csv_users[email][0] for email in new_emails])
+            for email, password_hash in zip(new_emails, hashes):
+                _, first_name, last_name = csv_users[email]
+                to_insert.append((email, password_hash, first_name, last_name))
+
+            execute_values(
+                cur,
+                """
+                INSERT INTO users (email, password_hash, first_name, last_name)
+                VALUES %s
+                ON CONFLICT (email) DO NOTHING
+                """,
+                to_insert
+            )
+
+        if to_update:
+            execute_values(
+                cur,
+                """
+                UPDATE users AS u
+                SET first_name = v.first_name, last_name = v.last_name
+                FROM (VALUES %s) AS v (email, first_name, last_name)
+                WHERE u.email = v.email
+                """,
+                to_update
+            )
 
-    conn.commit()
-    conn.close()
-    print("Synchronisation des utilisateurs depuis users.csv terminée.")
+        conn.commit()
+    print(
+        f"Synchronisation des utilisateurs depuis users.csv terminée "
+        f"({len(to_insert)} créé(s), {len(to_update)} mis à jour)."
+    )
 
 
-# synchro au chargement
-sync_users_from_csv()
+# La synchro est faite par `python app.py migrate` (phase release) et par le serveur de dev,
+# pas à chaque import : un worker gunicorn démarré ou recyclé ne relit pas users.csv.
+# USERS_SYNC_ON_START=1 la refait au chargement (hébergement sans phase release).
+if os.environ.get("USERS_SYNC_ON_START", "0") == "1":
+    try:
+        sync_users_from_csv()
+    except psycopg2.errors.UndefinedTable:
+        # base neuve : le schéma est créé par la commande de migration
+        print("Table users absente, lancer 'python app.py migrate'.", flush=True)
 
 # -----------------------------------------------------------------------------#
 # AUTH / ROLES
@@ -247,18 +1091,17 @@ def admin_required(f):
 
 
 def get_user_by_email(email: str):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, email, password_hash, first_name, last_name
-        FROM users
-        WHERE email = %s AND is_active = TRUE
-        """,
-        (email.lower(),)
-    )
-    row = cur.fetchone()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, email, password_hash, first_name, last_name
+            FROM users
+            WHERE email = %s AND is_active = TRUE
+            """,
+            (email.lower(),)
+        )
+        row = cur.fetchone()
     if not row:
         return None
     return {
@@ -307,423 +1150,1849 @@ def index():
 # -----------------------------------------------------------------------------#
 # ROUTES FICHIERS UPLOAD (fallback local)
 # -----------------------------------------------------------------------------#
-@app.route("/uploads/<filename>")
+@app.route("/uploads/<path:filename>")
 @login_required
 def uploaded_file(filename):
     # ⚠️ Pour une sécurité stricte, on pourrait vérifier ici que le fichier
     # correspond bien à une note appartenant à l'utilisateur ou à un admin.
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+    if os.path.normpath(filename).replace(os.sep, "/").split("/", 1)[0] == "tmp":
+        # envois en cours (write_receipt_tmp) : jamais servis
+        return "Fichier introuvable", 404
+    m = RECEIPT_BLOB_RE.match(filename)
+    if not m:
+        # ancien fichier à plat : contenu modifiable, cache par défaut
+        return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+
+    # Adressé par contenu : le hash est un ETag fort et le fichier ne change jamais
+    resp = send_from_directory(
+        app.config["UPLOAD_FOLDER"], filename,
+        etag=m.group(1), max_age=RECEIPT_CACHE_MAX_AGE,
+    )
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    resp.cache_control.immutable = True
+    return resp
 
 
 # -----------------------------------------------------------------------------#
-# ROUTE PRINCIPALE : NOTES DE FRAIS
+# JUSTIFICATIFS : UPLOAD DIRECT (navigateur -> Cloudinary, ou disque par morceaux)
 # -----------------------------------------------------------------------------#
-@app.route("/expenses", methods=["GET", "POST"])
-@login_required
-def expenses():
-    conn = get_db()
-    cur = conn.cursor()
-    current_user = session["user_email"]
+# Durée de validité d'un ticket d'upload (le formulaire peut être envoyé plus tard)
+RECEIPT_UPLOAD_TOKEN_TTL = int(os.environ.get("RECEIPT_UPLOAD_TOKEN_TTL", str(12 * 3600)))
+RECEIPT_MAX_BYTES = int(os.environ.get("RECEIPT_MAX_BYTES", str(20 * 1024 * 1024)))
+RECEIPT_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".heic", ".gif"}
+CLOUDINARY_FOLDER = "notes-frais-batirenov"
+# Formats acceptés par Cloudinary pour un upload direct (paramètre signé)
+CLOUDINARY_ALLOWED_FORMATS = "jpg,jpeg,png,webp,heic,gif"
+# Réduction des photos dans le navigateur avant envoi (plus grand côté en px, qualité JPEG 0-1)
+RECEIPT_CLIENT_MAX_DIMENSION = int(os.environ.get("RECEIPT_CLIENT_MAX_DIMENSION", "2000"))
+RECEIPT_CLIENT_QUALITY = float(os.environ.get("RECEIPT_CLIENT_QUALITY", "0.8"))
+# Garde-fou contre les images piégées (dimensions énormes pour un petit fichier)
+RECEIPT_MAX_PIXELS = int(os.environ.get("RECEIPT_MAX_PIXELS", str(50 * 1000 * 1000)))
+
+_upload_serializer = URLSafeTimedSerializer(app.secret_key, salt="receipt-upload")
+
+
+def create_upload_ticket(user_email, filename):
+    """
+    Prépare l'upload d'un justificatif : le serveur choisit l'emplacement et le signe.
+    Retourne le dict renvoyé au navigateur (où envoyer le fichier + jeton à joindre au formulaire).
+    """
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext not in RECEIPT_EXTENSIONS:
+        ext = ".jpg"
+    key = uuid.uuid4().hex
 
-    if request.method == "POST":
-        # Récupération des champs du formulaire
-        amount = request.form.get("amount")
-        amount_ht_str = request.form.get("amount_ht") or ""
-        tva_amount_str = request.form.get("tva_amount") or ""
-        date_str = request.form.get("date")
-        label = request.form.get("label")
-        chantier = request.form.get("chantier")
+    if CLOUDINARY_URL:
+        config = cloudinary.config()
+        public_id = f"{CLOUDINARY_FOLDER}/{key}"
+        params = {
+            "public_id": public_id,
+            "timestamp": int(time.time()),
+            "allowed_formats": CLOUDINARY_ALLOWED_FORMATS,
+        }
+        params["signature"] = cloudinary.utils.api_sign_request(params, config.api_secret)
+        params["api_key"] = config.api_key
+        token = _upload_serializer.dumps(
+            {"p": "cloudinary", "k": public_id, "u": user_email, "j": uuid.uuid4().hex}
+        )
+        return {
+            "provider": "cloudinary",
+            "upload_url": cloudinary.utils.cloudinary_api_url("upload"),
+            "fields": params,
+            "token": token,
+        }
 
-        # Nouveaux champs optionnels
-        payment_method = (request.form.get("payment_method") or "").strip() or None
-        comment_text = (request.form.get("comment_text") or "").strip() or None
+    token = _upload_serializer.dumps(
+        {"p": "local", "k": key + ext, "u": user_email, "j": uuid.uuid4().hex}
+    )
+    return {
+        "provider": "local",
+        "upload_url": url_for("receipt_upload_local", token=token),
+        "token": token,
+    }
 
-        # Validation basique
-        if not all([amount, date_str, label, chantier]):
-            flash("Tous les champs marqués * sont obligatoires.", "danger")
-        else:
+
+def check_receipt_image(path):
+    """
+    Vérifie qu'un fichier reçu est bien une image lisible et raisonnable.
+    Retourne (largeur, hauteur) ; lève ValueError sinon.
+    """
+    try:
+        with PILImage.open(path) as img:
+            width, height = img.size
+            img.verify()
+    except (UnidentifiedImageError, PILImage.DecompressionBombError, OSError, SyntaxError):
+        raise ValueError("Le fichier envoyé n'est pas une image lisible")
+    if width * height > RECEIPT_MAX_PIXELS:
+        raise ValueError("Image trop grande")
+    return width, height
+
+
+def _load_upload_token_data(token, user_email):
+    try:
+        data = _upload_serializer.loads(token, max_age=RECEIPT_UPLOAD_TOKEN_TTL)
+    except BadSignature:
+        raise ValueError("Justificatif invalide ou expiré, merci de le renvoyer.")
+    if data.get("u") != user_email:
+        raise ValueError("Justificatif invalide ou expiré, merci de le renvoyer.")
+    return data
+
+
+def resolve_receipt_token(token, user_email, upload_proof=None):
+    """
+    Jeton envoyé avec le formulaire -> (receipt_path à enregistrer, id du jeton).
+    Le fichier doit être arrivé : sur disque, ou chez Cloudinary. Pour Cloudinary,
+    upload_proof est la réponse de l'upload transmise par le navigateur (JSON public_id,
+    version, signature, format) : sa signature (api_secret) prouve que le fichier est
+    stocké, sans appel à l'API admin (limitée par heure) pendant la requête.
+    L'id est à consommer avec consume_receipt_token dans la transaction de la note.
+    Lève ValueError sinon.
+    """
+    data = _load_upload_token_data(token, user_email)
+    provider, key = data["p"], data["k"]
+    # jetons émis avant l'id "j" : le jeton lui-même sert d'identifiant
+    token_id = data.get("j") or hashlib.sha256(token.encode("utf-8")).hexdigest()
+    if provider == "cloudinary":
+        try:
+            proof = json.loads(upload_proof or "")
+            public_id, version = proof["public_id"], proof["version"]
+            signature, fmt = proof["signature"], proof.get("format") or ""
+        except (ValueError, TypeError, KeyError):
+            raise ValueError("Le justificatif n'a pas fini d'être envoyé, merci de réessayer.")
+        if public_id != key or not cloudinary.utils.verify_api_response_signature(
+            public_id, version, signature
+        ):
+            raise ValueError("Justificatif invalide ou expiré, merci de le renvoyer.")
+        # format non signé : seulement le suffixe de l'URL, limité aux formats acceptés à l'upload
+        if fmt not in CLOUDINARY_ALLOWED_FORMATS.split(","):
+            fmt = None
+        url, _ = cloudinary.utils.cloudinary_url(public_id, version=version, format=fmt, secure=True)
+        return url, token_id
+    if not RECEIPT_BLOB_RE.match(key) or not os.path.exists(os.path.join(app.config["UPLOAD_FOLDER"], key)):
+        raise ValueError("Le justificatif n'a pas fini d'être envoyé, merci de réessayer.")
+    return key, token_id
+
+
+def consume_receipt_token(cur, token_id):
+    """
+    Marque le jeton comme utilisé, dans la transaction qui insère la note : un même jeton
+    ne crée qu'une note (formulaire renvoyé, jeton rejoué). Lève ValueError s'il a déjà servi.
+    """
+    cur.execute(
+        "DELETE FROM receipt_tokens_used WHERE used_at < NOW() - make_interval(secs => %s)",
+        (RECEIPT_UPLOAD_TOKEN_TTL,)
+    )
+    cur.execute(
+        """
+        INSERT INTO receipt_tokens_used (token_id) VALUES (%s)
+        ON CONFLICT (token_id) DO NOTHING
+        RETURNING token_id
+        """,
+        (token_id,)
+    )
+    if cur.fetchone() is None:
+        raise ValueError("Ce justificatif a déjà été utilisé pour une note, merci de le renvoyer.")
+
+
+@app.route("/api/receipt_uploads", methods=["POST"])
+@login_required
+def create_receipt_upload():
+    """
+    Ticket d'upload direct : le navigateur envoie ensuite la photo lui-même (Cloudinary
+    signé, ou PUT sur /api/receipt_uploads/<token>) et le formulaire ne transmet que le jeton.
+    """
+    payload = request.get_json(silent=True) or {}
+    return jsonify(create_upload_ticket(session["user_email"], payload.get("filename")))
+
+
+@app.route("/api/receipt_uploads/<token>", methods=["PUT"])
+@login_required
+def receipt_upload_local(token):
+    """
+    Stockage local : corps de la requête écrit sur disque par morceaux, sans tout charger
+    en mémoire, puis rangé dans le stockage adressé par contenu.
+    """
+    try:
+        data = _load_upload_token_data(token, session["user_email"])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if data["p"] != "local" or not data.get("j"):
+        return jsonify({"error": "Ticket d'upload invalide"}), 400
+    key = data["k"]
+    if request.content_length and request.content_length > RECEIPT_MAX_BYTES:
+        return jsonify({"error": "Fichier trop volumineux"}), 413
+
+    # un ticket = un seul PUT (même table que les jetons de formulaire, ids distincts)
+    with get_db() as conn:
+        cur = conn.cursor()
+        try:
+            consume_receipt_token(cur, data["j"])
+        except ValueError:
+            conn.rollback()
+            return jsonify({"error": "Ticket d'upload déjà utilisé, merci de le redemander."}), 409
+        conn.commit()
+
+    try:
+        tmp_path, sha256, size = write_receipt_tmp(request.stream, RECEIPT_MAX_BYTES)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 413
+    try:
+        if not size:
+            raise ValueError("Fichier vide")
+        width, height = check_receipt_image(tmp_path)
+    except ValueError as e:
+        os.remove(tmp_path)
+        return jsonify({"error": str(e)}), 400
+    receipt_path = commit_receipt_blob(tmp_path, sha256, key)
+
+    # "compact" : la photo a bien été réduite par le navigateur
+    # "token" : désigne le fichier stocké (adresse de contenu), c'est lui qu'on joint au formulaire
+    return jsonify({
+        "ok": True,
+        "size": size,
+        "width": width,
+        "height": height,
+        "compact": max(width, height) <= RECEIPT_CLIENT_MAX_DIMENSION,
+        "token": _upload_serializer.dumps(
+            {"p": "local", "k": receipt_path, "u": session["user_email"], "j": uuid.uuid4().hex}
+        ),
+    })
+
+
+# -----------------------------------------------------------------------------#
+# JUSTIFICATIFS : MINIATURES ET APERÇUS
+# -----------------------------------------------------------------------------#
+# Le tableau affiche une miniature et le clic ouvre un aperçu moyen, au lieu de charger
+# l'original (plusieurs Mo) à chaque ligne. Versions réduites générées juste après l'ajout
+# de la note (arrière-plan), sinon au premier appel, puis gardées en cache disque.
+RECEIPT_DERIVATIVES = {
+    "thumb": int(os.environ.get("RECEIPT_THUMB_SIZE", "160")),
+    "preview": int(os.environ.get("RECEIPT_PREVIEW_SIZE", "1024")),
+}
+RECEIPT_DERIVATIVE_QUALITY = int(os.environ.get("RECEIPT_DERIVATIVE_QUALITY", "75"))
+RECEIPT_DERIVATIVE_DIR = os.environ.get(
+    "RECEIPT_DERIVATIVE_DIR", os.path.join(BASE_DIR, "cache", "derivatives")
+)
+# Cache navigateur ; au-delà, revalidation par ETag (304)
+RECEIPT_DERIVATIVE_MAX_AGE = 24 * 3600
+# format servi -> (format Pillow, extension, type MIME)
+RECEIPT_DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", ".webp", "image/webp"),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+}
+# Threads des travaux d'arrière-plan sur les justificatifs (miniatures, empreintes) :
+# séparés du pool OCR, qui reste réservé aux scans des utilisateurs
+RECEIPT_BACKGROUND_WORKERS = int(os.environ.get("RECEIPT_BACKGROUND_WORKERS", "2"))
+
+_receipt_executor = None
+_receipt_executor_pid = None
+_receipt_executor_lock = threading.Lock()
+
+
+def get_receipt_executor():
+    """Pool de threads du process pour les miniatures et empreintes calculées après l'ajout d'une note."""
+    global _receipt_executor, _receipt_executor_pid
+    pid = os.getpid()
+    if _receipt_executor is None or _receipt_executor_pid != pid:
+        with _receipt_executor_lock:
+            if _receipt_executor is None or _receipt_executor_pid != pid:
+                _receipt_executor = ThreadPoolExecutor(
+                    max_workers=RECEIPT_BACKGROUND_WORKERS, thread_name_prefix="receipt"
+                )
+                _receipt_executor_pid = pid
+    return _receipt_executor
+
+
+def flatten_to_rgb(img):
+    """Image en RGB ; la transparence devient du blanc (sinon noire en JPEG)."""
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = PILImage.new("RGB", img.size, "white")
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+
+def receipt_source_key(receipt_path):
+    """
+    Identité du contenu d'un justificatif, sans le lire : hash du stockage adressé par
+    contenu, URL Cloudinary (jamais réécrite), ou nom + date + taille d'un ancien fichier
+    à plat. None si le fichier local est introuvable.
+    """
+    m = RECEIPT_BLOB_RE.match(receipt_path)
+    if m:
+        return m.group(1)
+    if receipt_path.startswith("http"):
+        return receipt_path
+    try:
+        st = os.stat(os.path.join(app.config["UPLOAD_FOLDER"], receipt_path))
+    except OSError:
+        return None
+    return f"{receipt_path}|{st.st_mtime_ns}|{st.st_size}"
+
+
+def _derivative_location(source_key, variant, fmt):
+    """(chemin en cache, etag) d'une version réduite, à partir de l'identité du contenu."""
+    size = RECEIPT_DERIVATIVES[variant]
+    etag = hashlib.sha256(
+        f"{source_key}|{size}|q{RECEIPT_DERIVATIVE_QUALITY}|{fmt}".encode("utf-8")
+    ).hexdigest()
+    ext = RECEIPT_DERIVATIVE_FORMATS[fmt][1]
+    return os.path.join(RECEIPT_DERIVATIVE_DIR, etag[:2], f"{etag}{ext}"), etag
+
+
+def _derivative_marker(source_key):
+    """Marqueur "pas d'aperçu possible" (PDF, fichier abîmé) : on ne réessaie pas à chaque affichage."""
+    key = hashlib.sha256(f"{source_key}|none".encode("utf-8")).hexdigest()
+    return os.path.join(RECEIPT_DERIVATIVE_DIR, key[:2], f"{key}.none")
+
+
+def receipt_derivative_paths(receipt_path):
+    """Fichiers en cache (versions réduites et marqueur) d'un justificatif ; [] si introuvable."""
+    source_key = receipt_source_key(receipt_path)
+    if source_key is None:
+        return []
+    paths = [
+        _derivative_location(source_key, variant, fmt)[0]
+        for variant in RECEIPT_DERIVATIVES
+        for fmt in RECEIPT_DERIVATIVE_FORMATS
+    ]
+    paths.append(_derivative_marker(source_key))
+    return paths
+
+
+def receipt_derivative(receipt_path, variant, fmt):
+    """
+    Version réduite d'un justificatif ("thumb" ou "preview", en "webp" ou "jpeg").
+    Retourne (chemin en cache, etag), ou (None, None) si le justificatif est introuvable
+    ou n'est pas une image.
+    """
+    # extension connue et pas une image (PDF...) : ni téléchargement ni décodage
+    ext = os.path.splitext(receipt_path.split("?", 1)[0])[1].lower()
+    if ext and ext not in RECEIPT_EXTENSIONS:
+        return None, None
+    source_key = receipt_source_key(receipt_path)
+    if source_key is None:
+        return None, None
+    pil_format = RECEIPT_DERIVATIVE_FORMATS[fmt][0]
+    size = RECEIPT_DERIVATIVES[variant]
+    out_path, etag = _derivative_location(source_key, variant, fmt)
+    if os.path.exists(out_path):
+        return out_path, etag
+    marker_path = _derivative_marker(source_key)
+    if os.path.exists(marker_path):
+        return None, None
+
+    try:
+        src_path = fetch_receipt_file(receipt_path)
+    except requests.RequestException as e:
+        print(f"[RECEIPT] Justificatif inaccessible ({receipt_path}) : {e!r}", flush=True)
+        return None, None
+    if not src_path:
+        return None, None
+
+    try:
+        with PILImage.open(src_path) as img:
+            # JPEG : décodage directement à taille réduite ; carré car l'EXIF peut encore pivoter l'image
+            img.draft("RGB", (size, size))
+            img = flatten_to_rgb(ImageOps.exif_transpose(img))
+            img.thumbnail((size, size), PILImage.LANCZOS)
+    except (UnidentifiedImageError, PILImage.DecompressionBombError, SyntaxError, OSError) as e:
+        if isinstance(e, OSError) and e.errno is not None:
+            # erreur système (disque, droits, fichier en cours d'écriture) : on réessaiera
+            print(f"[RECEIPT] Lecture impossible de {receipt_path} : {e!r}", flush=True)
+            return None, None
+        # PDF ou fichier abîmé (décodage impossible, sans errno) : pas de miniature, le lien
+        # vers l'original reste ; marqueur pour ne pas réessayer à chaque affichage
+        os.makedirs(os.path.dirname(marker_path), exist_ok=True)
+        open(marker_path, "wb").close()
+        return None, None
+
+    tmp_path = f"{out_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        if pil_format == "WEBP":
+            img.save(tmp_path, format="WEBP", quality=RECEIPT_DERIVATIVE_QUALITY, method=4)
+        else:
+            img.save(tmp_path, format="JPEG", quality=RECEIPT_DERIVATIVE_QUALITY, optimize=True)
+        os.replace(tmp_path, out_path)
+    except OSError as e:
+        # cache plein ou illisible : pas de marqueur, l'aperçu sera retenté plus tard
+        print(f"[RECEIPT] Écriture impossible de {out_path} : {e!r}", flush=True)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None, None
+    return out_path, etag
+
+
+def warm_receipt_derivatives(receipt_path):
+    """Génère d'avance toutes les versions réduites d'un nouveau justificatif (arrière-plan)."""
+    try:
+        for variant in RECEIPT_DERIVATIVES:
+            for fmt in RECEIPT_DERIVATIVE_FORMATS:
+                receipt_derivative(receipt_path, variant, fmt)
+    except Exception as e:
+        print(f"[RECEIPT] Miniatures impossibles pour {receipt_path} : {e!r}", flush=True)
+
+
+@app.route("/receipts/<int:expense_id>/<any(thumb, preview):variant>")
+@login_required
+def receipt_derivative_file(expense_id, variant):
+    """Miniature / aperçu du justificatif d'une note (WebP si le navigateur l'accepte, sinon JPEG)."""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_email, receipt_path FROM expenses WHERE id = %s", (expense_id,))
+        row = cur.fetchone()
+    if not row or not row[1] or (row[0] != session["user_email"] and not is_admin()):
+        return "Justificatif introuvable", 404
+
+    fmt = "webp" if request.accept_mimetypes["image/webp"] else "jpeg"
+    path, etag = receipt_derivative(row[1], variant, fmt)
+    if not path:
+        return "Aperçu indisponible", 404
+
+    resp = send_file(
+        path, mimetype=RECEIPT_DERIVATIVE_FORMATS[fmt][2],
+        etag=etag, max_age=RECEIPT_DERIVATIVE_MAX_AGE, conditional=True,
+    )
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    resp.vary.add("Accept")
+    return resp
+
+
+# -----------------------------------------------------------------------------#
+# LISTE DES NOTES : FILTRES, TRI ET PAGINATION (côté serveur)
+# -----------------------------------------------------------------------------#
+EXPENSES_PAGE_SIZE = int(os.environ.get("EXPENSES_PAGE_SIZE", "50"))
+EXPENSES_PAGE_SIZE_MAX = 200
+
+EXPENSE_STATUSES = ("pending", "approved", "rejected")
+
+# clé de tri publique -> colonne SQL (toujours départagée par id)
+EXPENSE_SORT_COLUMNS = {
+    "date": "date",
+    "amount": "amount",
+}
+
+
+def encode_cursor(sort_value, expense_id):
+    """Curseur opaque pour la pagination par clé (valeur de tri, id)."""
+    raw = json.dumps([str(sort_value), expense_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, sort):
+    """Inverse de encode_cursor ; lève ValueError si le curseur est invalide."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_value, expense_id = json.loads(base64.urlsafe_b64decode(padded))
+        expense_id = int(expense_id)
+        if sort == "amount":
+            sort_value = Decimal(sort_value)
+        else:
+            sort_value = date.fromisoformat(sort_value)
+    except (TypeError, ValueError, ArithmeticError, binascii.Error):
+        raise ValueError("Curseur de pagination invalide")
+    return sort_value, expense_id
+
+
+def _like_pattern(value):
+    """Motif ILIKE 'contient', en échappant les jokers saisis par l'utilisateur."""
+    escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def parse_expense_query(args):
+    """
+    Lit les paramètres de liste depuis request.args.
+    Filtres : date_from, date_to, chantier, status, user, amount_min, amount_max
+    Tri     : sort=date|amount, order=asc|desc
+    Page    : cursor, limit
+    Lève ValueError si un paramètre est invalide.
+    """
+    query = {
+        "date_from": None,
+        "date_to": None,
+        "chantier": (args.get("chantier") or "").strip() or None,
+        "status": (args.get("status") or "").strip() or None,
+        "user": (args.get("user") or "").strip().lower() or None,
+        "amount_min": None,
+        "amount_max": None,
+        "sort": args.get("sort") or "date",
+        "order": (args.get("order") or "desc").lower(),
+        "cursor": args.get("cursor") or None,
+        "limit": EXPENSES_PAGE_SIZE,
+    }
+
+    try:
+        for key in ("date_from", "date_to"):
+            if args.get(key):
+                query[key] = datetime.strptime(args[key], "%Y-%m-%d").date()
+        for key in ("amount_min", "amount_max"):
+            if args.get(key):
+                query[key] = Decimal(args[key].replace(",", "."))
+        if args.get("limit"):
+            query["limit"] = int(args["limit"])
+    except (ValueError, ArithmeticError):
+        raise ValueError("Dates, montants ou limit invalides")
+
+    if query["status"] and query["status"] not in EXPENSE_STATUSES:
+        raise ValueError("Paramètre status invalide")
+    if query["sort"] not in EXPENSE_SORT_COLUMNS:
+        raise ValueError("Paramètre sort invalide")
+    if query["order"] not in ("asc", "desc"):
+        raise ValueError("Paramètre order invalide")
+
+    query["limit"] = max(1, min(query["limit"], EXPENSES_PAGE_SIZE_MAX))
+    if query["cursor"]:
+        query["cursor"] = decode_cursor(query["cursor"], query["sort"])
+    return query
+
+
+def expense_scope(current_user, admin):
+    """Notes visibles : conditions SQL et paramètres (un utilisateur ne voit que les siennes)."""
+    if admin:
+        return [], []
+    return ["user_email = %s"], [current_user]
+
+
+def expense_filters(admin, query):
+    """Filtres de la liste (hors visibilité et pagination) : conditions SQL et paramètres."""
+    where = []
+    params = []
+
+    if admin and query["user"]:
+        where.append("user_email ILIKE %s")
+        params.append(_like_pattern(query["user"]))
+
+    if query["date_from"]:
+        where.append("date >= %s")
+        params.append(query["date_from"])
+    if query["date_to"]:
+        where.append("date <= %s")
+        params.append(query["date_to"])
+    if query["chantier"]:
+        where.append("chantier ILIKE %s")
+        params.append(_like_pattern(query["chantier"]))
+    if query["status"]:
+        where.append("status = %s")
+        params.append(query["status"])
+    if query["amount_min"] is not None:
+        where.append("amount >= %s")
+        params.append(query["amount_min"])
+    if query["amount_max"] is not None:
+        where.append("amount <= %s")
+        params.append(query["amount_max"])
+    return where, params
+
+
+def fetch_expenses_page(current_user, admin, query):
+    """
+    Une page de notes, triée et filtrée en SQL.
+    Pagination par clé sur (colonne de tri, id) : le coût d'une page ne dépend
+    pas de sa position, contrairement à un OFFSET.
+    Retourne (liste d'Expense, curseur suivant ou None).
+    """
+    where, params = expense_scope(current_user, admin)
+    filter_where, filter_params = expense_filters(admin, query)
+    where += filter_where
+    params += filter_params
+
+    sort_col = EXPENSE_SORT_COLUMNS[query["sort"]]
+    direction = "DESC" if query["order"] == "desc" else "ASC"
+    if query["cursor"]:
+        op = "<" if direction == "DESC" else ">"
+        where.append(f"({sort_col}, id) {op} (%s, %s)")
+        params.extend(query["cursor"])
+
+    sql = f"SELECT {EXPENSE_COLUMNS} FROM expenses"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    # une ligne de plus que demandé pour savoir s'il existe une page suivante
+    sql += f" ORDER BY {sort_col} {direction}, id {direction} LIMIT %s"
+    params.append(query["limit"] + 1)
+
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        expenses = list(map(expense_from_row, cur.fetchall()))
+
+    next_cursor = None
+    if len(expenses) > query["limit"]:
+        expenses = expenses[:query["limit"]]
+        last = expenses[-1]
+        sort_value = last.amount if query["sort"] == "amount" else last.date.isoformat()
+        next_cursor = encode_cursor(sort_value, last.id)
+
+    return expenses, next_cursor
+
+
+# -----------------------------------------------------------------------------#
+# ROUTE PRINCIPALE : NOTES DE FRAIS
+# -----------------------------------------------------------------------------#
+@app.route("/expenses", methods=["GET", "POST"])
+@login_required
+def expenses():
+    current_user = session["user_email"]
+
+    if request.method == "POST":
+        # Récupération des champs du formulaire
+        amount = request.form.get("amount")
+        amount_ht_str = request.form.get("amount_ht") or ""
+        tva_amount_str = request.form.get("tva_amount") or ""
+        date_str = request.form.get("date")
+        label = request.form.get("label")
+        chantier = request.form.get("chantier")
+
+        # Nouveaux champs optionnels
+        payment_method = (request.form.get("payment_method") or "").strip() or None
+        comment_text = (request.form.get("comment_text") or "").strip() or None
+
+        # Validation basique
+        if not all([amount, date_str, label, chantier]):
+            flash("Tous les champs marqués * sont obligatoires.", "danger")
+        else:
             try:
                 amount_val = float(amount.replace(",", "."))
-                datetime.strptime(date_str, "%Y-%m-%d")
+                expense_date = datetime.strptime(date_str, "%Y-%m-%d").date()
                 amount_ht_val = float(amount_ht_str.replace(",", ".")) if amount_ht_str else None
                 tva_amount_val = float(tva_amount_str.replace(",", ".")) if tva_amount_str else None
             except ValueError:
                 flash("Montants ou date invalides.", "danger")
-                conn.close()
                 return redirect(url_for("expenses"))
 
-            # Gestion du fichier justificatif (Cloudinary ou local)
-            file = request.files.get("receipt")
-            receipt_path = upload_receipt(file) if file and file.filename else None
+            # Gestion du fichier justificatif (Cloudinary ou local)
+            # Justificatif déjà envoyé directement par le navigateur (jeton), sinon
+            # fichier joint au formulaire (Cloudinary ou local)
+            receipt_token = request.form.get("receipt_token")
+            file = request.files.get("receipt")
+            fingerprint = None
+            receipt_token_id = None
+            if receipt_token:
+                try:
+                    receipt_path, receipt_token_id = resolve_receipt_token(
+                        receipt_token, current_user, request.form.get("receipt_upload")
+                    )
+                except ValueError as e:
+                    flash(str(e), "danger")
+                    return redirect(url_for("expenses"))
+            else:
+                fingerprint = fingerprint_upload(file) if file and file.filename else None
+                receipt_path = upload_receipt(file) if file and file.filename else None
+            receipt_sha256, receipt_phash = fingerprint or (None, None)
+
+            # Status = pending par défaut (défini aussi en base)
+            with get_db() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    """
+                    INSERT INTO expenses
+                        (user_email, amount, amount_ht, tva_amount,
+                         date, label, chantier, payment_method, comment_text,
+                         receipt_path, receipt_sha256, receipt_phash, created_at)
+                    VALUES
+                        (%s, %s, %s, %s,
+                         %s, %s, %s, %s, %s,
+                         %s, %s, %s::bit(256), %s)
+                    RETURNING id
+                    """,
+                    (
+                        current_user,
+                        amount_val,
+                        amount_ht_val,
+                        tva_amount_val,
+                        date_str,
+                        label,
+                        chantier,
+                        payment_method,
+                        comment_text,
+                        receipt_path,
+                        receipt_sha256,
+                        receipt_phash,
+                        datetime.utcnow(),
+                    )
+                )
+                expense_id = cur.fetchone()[0]
+                try:
+                    if receipt_token_id:
+                        consume_receipt_token(cur, receipt_token_id)
+                    add_receipt_ref(cur, receipt_path)
+                except ValueError as e:
+                    conn.rollback()
+                    flash(str(e), "danger")
+                    return redirect(url_for("expenses"))
+                duplicates = (
+                    [d for d in find_duplicate_expenses(cur, *fingerprint, current_user)
+                     if d["id"] != expense_id]
+                    if fingerprint else []
+                )
+                # Notification envoyée en différé par le dispatcher (même transaction)
+                enqueue_new_expense_notification(cur, expense_id)
+                invalidate_month_reports(cur, [expense_date])
+                conn.commit()
+            if receipt_token:
+                # le serveur n'a pas vu le fichier : empreinte calculée en arrière-plan
+                get_receipt_executor().submit(fingerprint_expense_receipt, expense_id, receipt_path)
+            if receipt_path:
+                get_receipt_executor().submit(warm_receipt_derivatives, receipt_path)
+            flash("Note de frais ajoutée avec succès ✅", "success")
+            if duplicates:
+                ids = ", ".join(f"#{d['id']}" for d in duplicates)
+                flash(f"Attention : ce justificatif semble déjà utilisé pour la note {ids}.", "warning")
+
+        return redirect(url_for("expenses"))
+
+    # ----------- PARTIE LECTURE / AFFICHAGE -----------#
+    # Seule la première page est rendue, main.js charge la suite via /api/expenses
+    try:
+        query = parse_expense_query(request.args)
+    except ValueError as e:
+        flash(str(e), "danger")
+        query = parse_expense_query({})
+    sync_cursor = current_sync_cursor()
+    expenses_data, next_cursor = fetch_expenses_page(current_user, is_admin(), query)
+
+    return render_template(
+        "expenses.html",
+        expenses=expenses_data,
+        next_cursor=next_cursor,
+        page_size=query["limit"],
+        sort=query["sort"],
+        order=query["order"],
+        user_name=session.get("user_name"),
+        user_email=current_user,
+        is_admin=is_admin(),
+        compress_max=RECEIPT_CLIENT_MAX_DIMENSION,
+        compress_quality=RECEIPT_CLIENT_QUALITY,
+        sync_cursor=sync_cursor,
+        sync_interval=EXPENSES_SYNC_INTERVAL,
+    )
+
+
+# -----------------------------------------------------------------------------#
+# API JSON pour le tableau (utilisée par main.js : filtres, tri, pages suivantes)
+# -----------------------------------------------------------------------------#
+# À changer si le format JSON de /api/expenses change (invalide les ETag déjà donnés)
+EXPENSES_API_VERSION = 1
+
+# Synchronisation par delta (?since=) : main.js interroge toutes les EXPENSES_SYNC_INTERVAL s
+EXPENSES_SYNC_INTERVAL = int(os.environ.get("EXPENSES_SYNC_INTERVAL", "20"))
+# Recouvrement entre deux deltas : une transaction datée avant le curseur mais validée
+# après (updated_at = heure de l'écriture, pas du commit) est quand même renvoyée
+EXPENSES_SYNC_OVERLAP_SECONDS = 30
+# Au-delà de ce nombre de changements, le client recharge la liste
+EXPENSES_SYNC_MAX_CHANGES = 500
+# Traces des suppressions gardées ce nombre de jours ; curseur plus ancien = rechargement
+EXPENSE_TOMBSTONE_DAYS = int(os.environ.get("EXPENSE_TOMBSTONE_DAYS", "7"))
+
+
+def encode_sync_cursor(moment):
+    """Curseur opaque de synchronisation (horodatage de la base)."""
+    return base64.urlsafe_b64encode(moment.isoformat().encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_sync_cursor(cursor):
+    """Inverse de encode_sync_cursor ; lève ValueError si le curseur est invalide."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        moment = datetime.fromisoformat(base64.urlsafe_b64decode(padded).decode("utf-8"))
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError("Curseur de synchronisation invalide")
+    if moment.tzinfo is None:
+        raise ValueError("Curseur de synchronisation invalide")
+    return moment
+
+
+def current_sync_cursor():
+    """Curseur à donner avec une liste complète : à lire AVANT la liste (rien n'est manqué)."""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT NOW()")
+        return encode_sync_cursor(cur.fetchone()[0])
+
+
+def fetch_expenses_delta(current_user, admin, query, since):
+    """
+    Notes créées, modifiées ou supprimées depuis le curseur since (parmi les notes visibles).
+    Chaque note modifiée est renvoyée avec "match" : correspond-elle aux filtres de la liste ?
+    (sinon le client la retire de l'affichage, ex. note validée alors qu'on filtre "en attente").
+    Retourne le dict de réponse : items, deleted, cursor, reset.
+    """
+    scope_where, scope_params = expense_scope(current_user, admin)
+    filter_where, filter_params = expense_filters(admin, query)
+    match_sql = " AND ".join(f"({w})" for w in filter_where) or "TRUE"
+    from_moment = since - timedelta(seconds=EXPENSES_SYNC_OVERLAP_SECONDS)
+
+    with get_db() as conn:
+        cur = conn.cursor()
+        # horodatage lu AVANT les changements : ce qui s'écrit pendant sera dans le prochain delta
+        cur.execute(
+            "SELECT NOW(), NOW() - make_interval(days => %s)", (EXPENSE_TOMBSTONE_DAYS,)
+        )
+        now, oldest = cur.fetchone()
+        if since < oldest:
+            # traces des suppressions déjà purgées : delta impossible
+            return {"items": [], "deleted": [], "cursor": encode_sync_cursor(now), "reset": True}
+
+        cur.execute(
+            f"""
+            SELECT {EXPENSE_COLUMNS}, ({match_sql}) AS match
+            FROM expenses
+            WHERE {" AND ".join(scope_where + ["updated_at > %s"])}
+            ORDER BY updated_at, id
+            LIMIT %s
+            """,
+            filter_params + scope_params + [from_moment, EXPENSES_SYNC_MAX_CHANGES + 1]
+        )
+        rows = cur.fetchall()
+        if len(rows) > EXPENSES_SYNC_MAX_CHANGES:
+            return {"items": [], "deleted": [], "cursor": encode_sync_cursor(now), "reset": True}
+
+        tombstone_sql = "SELECT expense_id FROM expense_tombstones WHERE deleted_at > %s"
+        tombstone_params = [from_moment]
+        if not admin:
+            tombstone_sql += " AND user_email = %s"
+            tombstone_params.append(current_user)
+        cur.execute(tombstone_sql, tombstone_params)
+        deleted = [r[0] for r in cur.fetchall()]
+
+    items = []
+    for r in rows:
+        item = expense_json(expense_from_row(r[:-1]))
+        item["match"] = bool(r[-1])
+        items.append(item)
+    return {"items": items, "deleted": deleted, "cursor": encode_sync_cursor(now), "reset": False}
+
+
+def expenses_version(current_user, admin):
+    """
+    Version des notes visibles (toutes pour un admin, les siennes sinon) :
+    (compteur, date du dernier changement), lue dans expense_versions par clé primaire.
+    Le compteur est incrémenté par trigger à chaque requête d'écriture et n'est visible
+    qu'une fois la transaction validée : une longue transaction validée après une autre
+    change quand même la version.
+    """
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT version, changed_at FROM expense_versions WHERE scope = %s",
+            ("*" if admin else current_user,)
+        )
+        return cur.fetchone() or (0, None)
+
+
+@app.route("/api/expenses")
+@login_required
+def api_expenses():
+    """
+    Liste paginée des notes visibles par l'utilisateur.
+    Ex: /api/expenses?status=pending&chantier=dupont&sort=amount&order=asc
+    Réponse : {"items": [...], "next_cursor": "..."} ; next_cursor est à
+    repasser tel quel dans ?cursor= pour la page suivante (null = fin de liste).
+
+    Réponse avec ETag (version des notes visibles + paramètres) : un client qui renvoie
+    If-None-Match reçoit 304 sans que la liste soit relue ni sérialisée.
+
+    Avec ?since=<curseur> (data-sync-cursor de la page, puis "cursor" du delta précédent) :
+    seulement les changements depuis le curseur, voir fetch_expenses_delta.
+    Réponse : {"items": [...], "deleted": [ids], "cursor": "...", "reset": false}
+    ("reset": true = trop ancien ou trop de changements, recharger la liste).
+    """
+    try:
+        query = parse_expense_query(request.args)
+        since = decode_sync_cursor(request.args["since"]) if request.args.get("since") else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    current_user = session["user_email"]
+    admin = is_admin()
+    if since:
+        resp = jsonify(fetch_expenses_delta(current_user, admin, query, since))
+        resp.cache_control.no_store = True
+        return resp
+
+    version, last_modified = expenses_version(current_user, admin)
+    scope = "admin" if admin else current_user
+    etag = hashlib.sha256(
+        f"{EXPENSES_API_VERSION}|{scope}|{version}|"
+        f"{request.query_string.decode('latin-1')}".encode("utf-8")
+    ).hexdigest()[:32]
+
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        items, next_cursor = fetch_expenses_page(current_user, admin, query)
+        resp = jsonify({"items": [expense_json(e) for e in items], "next_cursor": next_cursor})
+    resp.set_etag(etag)
+    if last_modified:
+        resp.last_modified = last_modified
+    # Toujours revalidé (le navigateur renvoie lui-même If-None-Match), jamais partagé
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    resp.vary.add("Cookie")
+    return resp
+
+# -----------------------------------------------------------------------------#
+# API JSON : TOTAUX PAR MOIS / CHANTIER / UTILISATEUR / STATUT
+# -----------------------------------------------------------------------------#
+# clé publique -> colonne de expense_summary
+SUMMARY_DIMENSIONS = {
+    "month": "month",
+    "chantier": "chantier",
+    "user": "user_email",
+    "status": "status",
+}
+
+
+def _parse_month(value):
+    """'2025-11' -> date(2025, 11, 1) ; lève ValueError si invalide."""
+    return datetime.strptime(value, "%Y-%m").date()
+
+
+@app.route("/api/summary")
+@login_required
+def api_summary():
+    """
+    Totaux TTC / HT / TVA et nombre de notes, lus dans la table pré-agrégée
+    expense_summary (pas de parcours de expenses).
+    Paramètres :
+      - group_by   : liste séparée par des virgules parmi month, chantier, user, status
+                     (défaut : month)
+      - month_from, month_to : AAAA-MM
+      - chantier, user, status : filtres exacts
+    Un utilisateur non admin ne voit que ses propres totaux.
+    Ex: /api/summary?group_by=month,chantier&month_from=2025-01&status=approved
+    """
+    group_by = [g.strip() for g in (request.args.get("group_by") or "month").split(",") if g.strip()]
+    if not group_by or any(g not in SUMMARY_DIMENSIONS for g in group_by):
+        return jsonify({"error": "Paramètre group_by invalide"}), 400
+    group_by = list(dict.fromkeys(group_by))
+
+    where = ["expense_count <> 0"]
+    params = []
+    try:
+        if request.args.get("month_from"):
+            where.append("month >= %s")
+            params.append(_parse_month(request.args["month_from"]))
+        if request.args.get("month_to"):
+            where.append("month <= %s")
+            params.append(_parse_month(request.args["month_to"]))
+    except ValueError:
+        return jsonify({"error": "Paramètres month_from / month_to invalides (AAAA-MM)"}), 400
+
+    if not is_admin():
+        where.append("user_email = %s")
+        params.append(session["user_email"])
+    elif request.args.get("user"):
+        where.append("user_email = %s")
+        params.append(request.args["user"].strip().lower())
+    if request.args.get("chantier"):
+        where.append("chantier = %s")
+        params.append(request.args["chantier"])
+    if request.args.get("status"):
+        if request.args["status"] not in EXPENSE_STATUSES:
+            return jsonify({"error": "Paramètre status invalide"}), 400
+        where.append("status = %s")
+        params.append(request.args["status"])
+
+    columns = [SUMMARY_DIMENSIONS[g] for g in group_by]
+    sql = f"""
+        SELECT {", ".join(columns)},
+               SUM(expense_count), SUM(total_ttc), SUM(total_ht), SUM(total_tva)
+        FROM expense_summary
+        WHERE {" AND ".join(where)}
+        GROUP BY {", ".join(columns)}
+        ORDER BY {", ".join(columns)}
+    """
+
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+
+    items = []
+    totals = {"count": 0, "total_ttc": 0.0, "total_ht": 0.0, "total_tva": 0.0}
+    for r in rows:
+        item = {}
+        for key, value in zip(group_by, r):
+            item[key] = value.strftime("%Y-%m") if key == "month" else value
+        count, ttc, ht, tva = r[len(group_by):]
+        item.update({
+            "count": int(count),
+            "total_ttc": float(ttc),
+            "total_ht": float(ht),
+            "total_tva": float(tva),
+        })
+        items.append(item)
+        totals["count"] += item["count"]
+        totals["total_ttc"] += item["total_ttc"]
+        totals["total_ht"] += item["total_ht"]
+        totals["total_tva"] += item["total_tva"]
+
+    for key in ("total_ttc", "total_ht", "total_tva"):
+        totals[key] = round(totals[key], 2)
+
+    return jsonify({"group_by": group_by, "items": items, "totals": totals})
+
+
+# -----------------------------------------------------------------------------#
+# OCR EN ARRIÈRE-PLAN : envoi du ticket -> id de job -> main.js interroge le résultat
+# -----------------------------------------------------------------------------#
+OCRSPACE_URL = os.environ.get("OCRSPACE_URL", "https://api.ocr.space/parse/image")
+# Appels OCR simultanés par worker (les autres jobs attendent leur tour)
+OCR_MAX_CONCURRENCY = int(os.environ.get("OCR_MAX_CONCURRENCY", "2"))
+OCR_TIMEOUT = float(os.environ.get("OCR_TIMEOUT", "60"))
+# Moteurs OCR par ordre de préférence : le suivant sert de secours si le premier
+# est indisponible, échoue ou ne trouve rien d'exploitable.
+OCR_BACKENDS = [
+    name.strip().lower()
+    for name in os.environ.get("OCR_BACKENDS", "tesseract,ocrspace").split(",")
+    if name.strip()
+]
+OCR_TESSERACT_LANG = os.environ.get("OCR_TESSERACT_LANG", "fra")
+# Process Tesseract par worker (OCR local = CPU)
+OCR_TESSERACT_WORKERS = int(os.environ.get("OCR_TESSERACT_WORKERS", "1"))
+# Jobs OCR conservés (heures) avant nettoyage
+OCR_JOB_TTL_HOURS = 24
+# Traitement de la photo avant OCR : legacy (photo entière réduite, couleur) ou receipt
+# (recadrée, gris, redressée ; à activer une fois son taux de lecture mesuré)
+OCR_IMAGE_PIPELINE = os.environ.get("OCR_IMAGE_PIPELINE", "legacy").strip().lower()
+# Image envoyée à l'OCR : largeur max et taille visée (pipeline receipt : la qualité s'adapte)
+OCR_IMAGE_MAX_WIDTH = int(os.environ.get("OCR_IMAGE_MAX_WIDTH", "1200"))
+OCR_IMAGE_BYTE_BUDGET = int(os.environ.get("OCR_IMAGE_BYTE_BUDGET", str(36 * 1024)))
+# Process de traitement des photos par worker
+OCR_IMAGE_WORKERS = int(os.environ.get("OCR_IMAGE_WORKERS", "2"))
+# Démarrage des pools de process OCR / images : ils sont créés à la demande depuis des
+# threads de requête, et fork() d'un process multi-threadé peut hériter d'un verrou pris
+# (blocage du fils). forkserver part d'un process neuf et n'importe que receipt_image.
+PROCESS_POOL_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+
+class OcrError(Exception):
+    """Erreur OCR présentée telle quelle à l'utilisateur (raw_text éventuel pour le debug)."""
+
+    def __init__(self, message, raw_text=None):
+        super().__init__(message)
+        self.raw_text = raw_text
+
+
+_image_executor = None
+_image_executor_pid = None
+_image_executor_lock = threading.Lock()
+
+
+def get_image_executor():
+    """Pool de process pour le traitement des photos (CPU, hors du thread de la requête)."""
+    global _image_executor, _image_executor_pid
+    pid = os.getpid()
+    if _image_executor is None or _image_executor_pid != pid:
+        with _image_executor_lock:
+            if _image_executor is None or _image_executor_pid != pid:
+                _image_executor = ProcessPoolExecutor(
+                    max_workers=OCR_IMAGE_WORKERS, mp_context=PROCESS_POOL_CONTEXT
+                )
+                _image_executor_pid = pid
+    return _image_executor
+
+
+def run_preprocess_receipt(data):
+    """
+    receipt_image.preprocess_receipt() dans le pool, selon OCR_IMAGE_PIPELINE :
+    (JPEG pour l'OCR, (sha256, dHash)). Un pool cassé (process tué) est recréé au prochain appel.
+    """
+    global _image_executor
+    try:
+        future = get_image_executor().submit(
+            preprocess_receipt, data,
+            OCR_IMAGE_PIPELINE, OCR_IMAGE_MAX_WIDTH, OCR_IMAGE_BYTE_BUDGET,
+        )
+        return future.result(timeout=OCR_TIMEOUT)
+    except BrokenProcessPool:
+        with _image_executor_lock:
+            _image_executor = None
+        raise
+
+
+# Empreinte perceptuelle : receipt_image.image_dhash (256 bits, stockée en BIT(256)).
+# Distance de Hamming max (sur 256 bits) pour parler de "même ticket"
+OCR_PHASH_MAX_DISTANCE = int(os.environ.get("OCR_PHASH_MAX_DISTANCE", "20"))
+# Comparaison perceptuelle (sans index possible) limitée aux N derniers justificatifs
+OCR_PHASH_CANDIDATES = int(os.environ.get("OCR_PHASH_CANDIDATES", "2000"))
+# Résultats OCR gardés en cache ce nombre de jours
+OCR_CACHE_TTL_DAYS = int(os.environ.get("OCR_CACHE_TTL_DAYS", "30"))
+
+# Nombre de bits différents entre deux empreintes perceptuelles, en SQL
+SQL_PHASH_DISTANCE = "length(replace(({col} # %s::bit(256))::text, '0', ''))"
+
+
+def fingerprint_upload(file):
+    """
+    Empreinte d'un justificatif envoyé avec le formulaire (même normalisation que
+    le scan, pour retrouver les tickets déjà scannés / déjà soumis).
+    None si le fichier n'est pas une image lisible (PDF...). Le flux est rembobiné.
+    """
+    try:
+        return run_preprocess_receipt(file.stream.read())[1]
+    except Exception:
+        return None
+    finally:
+        file.stream.seek(0)
+
+
+def fingerprint_expense_receipt(expense_id, receipt_path):
+    """Empreinte d'un justificatif envoyé en direct (récupéré depuis le stockage), enregistrée sur la note."""
+    try:
+        local_path = fetch_receipt_file(receipt_path)
+        if not local_path:
+            return
+        with open(local_path, "rb") as f:
+            _, (content_hash, phash) = run_preprocess_receipt(f.read())
+    except Exception as e:
+        print(f"[OCR] Empreinte impossible pour la note {expense_id} : {e!r}", flush=True)
+        return
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE expenses
+            SET receipt_sha256 = %s, receipt_phash = %s::bit(256)
+            WHERE id = %s
+            """,
+            (content_hash, phash, expense_id)
+        )
+        conn.commit()
+
+
+def find_cached_ocr(cur, content_hash):
+    """
+    Résultat OCR déjà connu pour exactement cette image, ou None.
+    Pas de recherche perceptuelle ici : une photo voisine peut venir d'un autre ticket
+    (ou d'un autre utilisateur), ses montants ne doivent pas être pré-remplis.
+    """
+    cur.execute(
+        """
+        SELECT result
+        FROM ocr_cache
+        WHERE content_hash = %s AND created_at > NOW() - make_interval(days => %s)
+        """,
+        (content_hash, OCR_CACHE_TTL_DAYS)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def purge_ocr_cache(cur):
+    cur.execute(
+        "DELETE FROM ocr_cache WHERE created_at < NOW() - make_interval(days => %s)",
+        (OCR_CACHE_TTL_DAYS,)
+    )
+
+
+def find_duplicate_expenses(cur, content_hash, phash, current_user):
+    """
+    Notes déjà enregistrées avec le même justificatif (double demande de remboursement ?).
+    Même image : toutes les notes (index sur receipt_sha256). Photo quasi identique :
+    seulement parmi les OCR_PHASH_CANDIDATES derniers justificatifs, la distance de
+    Hamming ne pouvant pas s'appuyer sur un index.
+    Le détail n'est donné que pour les notes de l'utilisateur (ou pour un admin).
+    """
+    distance = SQL_PHASH_DISTANCE.format(col="receipt_phash")
+    cur.execute(
+        f"""
+        SELECT id, user_email, date, amount, label
+        FROM expenses
+        WHERE receipt_sha256 = %s
+        UNION
+        SELECT id, user_email, date, amount, label
+        FROM (
+            SELECT id, user_email, date, amount, label, receipt_phash
+            FROM expenses
+            WHERE receipt_phash IS NOT NULL
+            ORDER BY id DESC
+            LIMIT %s
+        ) recent
+        WHERE {distance} <= %s
+        ORDER BY id DESC
+        LIMIT 5
+        """,
+        (content_hash, OCR_PHASH_CANDIDATES, phash, OCR_PHASH_MAX_DISTANCE)
+    )
+    duplicates = []
+    for expense_id, user_email, d, amount, label in cur.fetchall():
+        own = user_email == current_user
+        item = {"id": expense_id, "date": d.isoformat(), "own": own}
+        if own or is_admin():
+            item.update({"amount": float(amount), "label": label, "user_email": user_email})
+        duplicates.append(item)
+    return duplicates
+
+
+class OcrBackend(ABC):
+    """
+    Moteur OCR : read_text(image_bytes) -> texte brut, lève OcrError.
+    Chaque moteur compte ses appels, échecs et temps passé (voir /admin/ocr_stats).
+    Les sous-classes fournissent name et _read_text().
+    """
+
+    name = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "failures": 0, "unusable": 0, "time_ms": 0.0}
+
+    def available(self):
+        return True
+
+    @abstractmethod
+    def _read_text(self, image_bytes):
+        """Texte brut lu sur l'image ; lève OcrError."""
+
+    def read_text(self, image_bytes):
+        start = time.monotonic()
+        ok = False
+        try:
+            text = self._read_text(image_bytes)
+            ok = True
+            return text
+        finally:
+            elapsed_ms = (time.monotonic() - start) * 1000
+            with self._lock:
+                self._stats["calls"] += 1
+                self._stats["time_ms"] += elapsed_ms
+                if not ok:
+                    self._stats["failures"] += 1
+
+    def mark_unusable(self):
+        """Texte lu mais inexploitable (ni montant ni date)."""
+        with self._lock:
+            self._stats["unusable"] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+        calls = data["calls"]
+        data["time_ms"] = round(data["time_ms"], 1)
+        data["avg_ms"] = round(data["time_ms"] / calls, 1) if calls else None
+        data["available"] = self.available()
+        return data
+
+
+class OcrSpaceBackend(OcrBackend):
+    """API HTTP OCR.space (aller-retour Internet, quotas côté fournisseur)."""
+
+    name = "ocrspace"
+
+    def available(self):
+        return bool(os.environ.get("OCRSPACE_API_KEY"))
+
+    def _read_text(self, image_bytes):
+        ocr_api_key = os.environ.get("OCRSPACE_API_KEY")
+        if not ocr_api_key:
+            raise OcrError("OCR non configuré (OCRSPACE_API_KEY manquant)")
+
+        try:
+            files = {"file": ("ticket.jpg", io.BytesIO(image_bytes), "image/jpeg")}
+            resp = get_http_session().post(
+                OCRSPACE_URL,
+                files=files,
+                data={
+                    "apikey": ocr_api_key,
+                    "language": "fre",
+                    "OCREngine": 2,
+                },
+                timeout=OCR_TIMEOUT,
+            )
+            resp.raise_for_status()
+            data = resp.json()
+        except Exception as e:
+            raise OcrError(f"Erreur OCR: {e}")
+
+        # Si l'API indique une erreur
+        if data.get("IsErroredOnProcessing"):
+            msg_list = data.get("ErrorMessage") or []
+            if isinstance(msg_list, list):
+                msg = " ".join(msg_list)
+            else:
+                msg = str(msg_list)
+            raise OcrError(f"OCR: {msg}")
+
+        parsed_results = data.get("ParsedResults")
+        if not parsed_results:
+            raise OcrError("OCR n'a pas réussi à lire le ticket.")
+
+        return " ".join(r.get("ParsedText", "") for r in parsed_results) or ""
+
+
+class TesseractBackend(OcrBackend):
+    """
+    Tesseract en local (pytesseract + binaire tesseract), sans appel réseau.
+    Le travail CPU tourne dans un pool de process dédié pour ne pas bloquer le worker.
+    """
+
+    name = "tesseract"
+
+    def __init__(self, lang="fra", workers=1):
+        super().__init__()
+        self.lang = lang
+        self.workers = workers
+        self._available = None
+        self._executor = None
+        self._executor_pid = None
+
+    def available(self):
+        if self._available is None:
+            if pytesseract is None:
+                self._available = False
+            else:
+                try:
+                    pytesseract.get_tesseract_version()
+                    self._available = True
+                except Exception:
+                    self._available = False
+        return self._available
+
+    def _get_executor(self):
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self._lock:
+                if self._executor is None or self._executor_pid != pid:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=PROCESS_POOL_CONTEXT
+                    )
+                    self._executor_pid = pid
+        return self._executor
+
+    def _read_text(self, image_bytes):
+        if not self.available():
+            raise OcrError("Tesseract non disponible sur ce serveur")
+        try:
+            future = self._get_executor().submit(
+                tesseract_text, image_bytes, self.lang, OCR_TIMEOUT
+            )
+            return future.result()
+        except Exception as e:
+            raise OcrError(f"Erreur OCR (tesseract): {e}")
+
+
+OCR_BACKEND_CLASSES = {
+    OcrSpaceBackend.name: OcrSpaceBackend,
+    TesseractBackend.name: TesseractBackend,
+}
+
+_ocr_backends = None
+_ocr_backends_lock = threading.Lock()
+
+
+def get_ocr_backends():
+    """Moteurs OCR configurés (OCR_BACKENDS), dans l'ordre de préférence."""
+    global _ocr_backends
+    if _ocr_backends is None:
+        with _ocr_backends_lock:
+            if _ocr_backends is None:
+                backends = []
+                for name in OCR_BACKENDS:
+                    if name not in OCR_BACKEND_CLASSES:
+                        print(f"[OCR] Moteur inconnu ignoré : {name}", flush=True)
+                    elif name == TesseractBackend.name:
+                        backends.append(TesseractBackend(OCR_TESSERACT_LANG, OCR_TESSERACT_WORKERS))
+                    else:
+                        backends.append(OCR_BACKEND_CLASSES[name]())
+                _ocr_backends = backends
+    return _ocr_backends
+
+
+def available_ocr_backends():
+    return [b for b in get_ocr_backends() if b.available()]
+
+
+def parse_receipt_text(text):
+    """
+    Texte OCR -> champs pré-remplis du formulaire (voir receipt_parser.parse_receipt).
+    Lève OcrError si rien d'exploitable.
+    """
+    parsed = parse_receipt(text)
+
+    # Si vraiment rien d'exploitable
+    if not parsed["ttc"] and not parsed["ht"] and not parsed["tva"] and not parsed["date"]:
+        raise OcrError(
+            "Le ticket a été lu mais aucun montant ou date n'ont été détectés.",
+            raw_text=text,
+        )
+
+    # Libellé : l'enseigne si on l'a trouvée, sinon le début du texte
+    label_guess = parsed["merchant"] or (text.strip().replace("\n", " ")[:80] if text else "")
+
+    return {
+        "amount": parsed["ttc"],         # TTC
+        "amount_ht": parsed["ht"],       # HT (peut être None)
+        "tva_amount": parsed["tva"],     # TVA (peut être None)
+        "date": parsed["date"],
+        "label": label_guess,
+        "vat_rates": parsed["vat_rates"],
+        "consistent": parsed["consistent"],   # TTC = HT + TVA vérifié ?
+        "confidence": parsed["confidence"],
+        "raw_text": text,
+    }
+
 
-            # Status = pending par défaut (défini aussi en base)
-            cur.execute(
-                """
-                INSERT INTO expenses
-                    (user_email, amount, amount_ht, tva_amount,
-                     date, label, chantier, payment_method, comment_text,
-                     receipt_path, created_at)
-                VALUES
-                    (%s, %s, %s, %s,
-                     %s, %s, %s, %s, %s,
-                     %s, %s)
-                """,
-                (
-                    current_user,
-                    amount_val,
-                    amount_ht_val,
-                    tva_amount_val,
-                    date_str,
-                    label,
-                    chantier,
-                    payment_method,
-                    comment_text,
-                    receipt_path,
-                    datetime.utcnow(),
+_ocr_executor = None
+_ocr_executor_pid = None
+_ocr_executor_lock = threading.Lock()
+
+
+def get_ocr_executor():
+    """Pool de threads OCR du process : borne le nombre d'appels OCR simultanés."""
+    global _ocr_executor, _ocr_executor_pid
+    pid = os.getpid()
+    if _ocr_executor is None or _ocr_executor_pid != pid:
+        with _ocr_executor_lock:
+            if _ocr_executor is None or _ocr_executor_pid != pid:
+                _ocr_executor = ThreadPoolExecutor(
+                    max_workers=OCR_MAX_CONCURRENCY, thread_name_prefix="ocr"
                 )
-            )
-            conn.commit()
-            try:
-                send_new_expense_email()
-            except Exception as e:
-                print(f"[MAIL] Notification nouvelle note échouée : {e!r}", flush=True)
-            flash("Note de frais ajoutée avec succès ✅", "success")
+                _ocr_executor_pid = pid
+    return _ocr_executor
 
-        conn.close()
-        return redirect(url_for("expenses"))
 
-    # ----------- PARTIE LECTURE / AFFICHAGE -----------#
-    if is_admin():
-        # Admin : voit toutes les notes
+def _finish_ocr_job(job_id, status, result):
+    with get_db() as conn:
+        cur = conn.cursor()
         cur.execute(
             """
-            SELECT id, user_email, amount, amount_ht, tva_amount,
-                   date, label, chantier, payment_method, comment_text,
-                   receipt_path, created_at, status, validated_by, validated_at
-            FROM expenses
-            ORDER BY date DESC, id DESC
-            """
+            UPDATE ocr_jobs
+            SET status = %s, result = %s, finished_at = NOW()
+            WHERE id = %s
+            """,
+            (status, json.dumps(result), job_id)
         )
-    else:
-        # Utilisateur normal : ne voit que ses propres notes
+        conn.commit()
+
+
+def run_ocr_job(job_id, image_bytes, fingerprint):
+    """
+    Exécuté dans le pool OCR : appel OCR, analyse du texte, résultat en base.
+    Un résultat exploitable est aussi mis en cache sous l'empreinte de l'image.
+    """
+    result = None
+    error = OcrError("OCR non configuré (aucun moteur disponible)")
+    for backend in available_ocr_backends():
+        try:
+            text = backend.read_text(image_bytes)
+
+            # Logs debug dans Render
+            print(f"=== OCR RAW TEXT ({backend.name}) ===")
+            print(text)
+            print("====================")
+
+            try:
+                result = parse_receipt_text(text)
+            except OcrError:
+                backend.mark_unusable()
+                raise
+            result["ocr_backend"] = backend.name
+            break
+        except OcrError as e:
+            # moteur suivant (ex : Tesseract n'a rien lu d'exploitable -> OCR.space)
+            error = e
+        except Exception as e:
+            print(f"[OCR] Job {job_id} en erreur ({backend.name}) : {e!r}", flush=True)
+            error = OcrError(f"Erreur OCR: {e}")
+
+    if result is None:
+        _finish_ocr_job(job_id, "failed", {"error": str(error), "raw_text": error.raw_text})
+        return
+
+    with get_db() as conn:
+        cur = conn.cursor()
         cur.execute(
             """
-            SELECT id, user_email, amount, amount_ht, tva_amount,
-                   date, label, chantier, payment_method, comment_text,
-                   receipt_path, created_at, status, validated_by, validated_at
-            FROM expenses
-            WHERE user_email = %s
-            ORDER BY date DESC, id DESC
+            INSERT INTO ocr_cache (content_hash, phash, result)
+            VALUES (%s, %s::bit(256), %s)
+            ON CONFLICT (content_hash) DO UPDATE
+                SET result = EXCLUDED.result, created_at = NOW()
             """,
-            (current_user,)
+            (fingerprint[0], fingerprint[1], json.dumps(result))
         )
+        conn.commit()
+    _finish_ocr_job(job_id, "done", result)
 
-    rows = cur.fetchall()
-    conn.close()
 
-    expenses_data = []
-    for r in rows:
-        expenses_data.append({
-            "id": r[0],
-            "user_email": r[1],
-            "amount": float(r[2]),
-            "amount_ht": float(r[3]) if r[3] is not None else None,
-            "tva_amount": float(r[4]) if r[4] is not None else None,
-            "date": r[5].strftime("%Y-%m-%d"),
-            "label": r[6],
-            "chantier": r[7],
-            "payment_method": r[8],
-            "comment_text": r[9],
-            "receipt_path": r[10],
-            "created_at": r[11].isoformat(),
-            "status": r[12],
-            "validated_by": r[13],
-            "validated_at": r[14].isoformat() if r[14] else None,
-        })
+@app.route("/api/scan_receipt", methods=["POST"])
+@login_required
+def scan_receipt():
+    """
+    Lance la lecture OCR d'un ticket et répond tout de suite (202) avec un id de job.
+    Le résultat se lit ensuite sur /api/scan_receipt/<job_id>.
+    Si ce ticket a déjà été lu, le résultat en cache est renvoyé directement (200).
+    Dans les deux cas, "duplicates" liste les notes déjà soumises avec ce justificatif.
+    """
+    file = request.files.get("receipt")
+    if not file:
+        return jsonify({"error": "Aucun fichier reçu"}), 400
 
-    return render_template(
-        "expenses.html",
-        expenses=expenses_data,
-        user_name=session.get("user_name"),
-        user_email=current_user,
-        is_admin=is_admin(),
-    )
+    if not available_ocr_backends():
+        return jsonify({"error": "OCR non configuré (aucun moteur disponible)"}), 500
 
+    try:
+        image_bytes, fingerprint = run_preprocess_receipt(file.read())
+    except Exception as e:
+        return jsonify({"error": f"Erreur OCR: {e}"}), 400
 
-# -----------------------------------------------------------------------------#
-# API JSON pour le tableau (utilisée par main.js pour filtrer/tri côté client)
-# -----------------------------------------------------------------------------#
-@app.route("/api/expenses")
-@login_required
-def api_expenses():
-    conn = get_db()
-    cur = conn.cursor()
     current_user = session["user_email"]
+    job_id = uuid.uuid4().hex
+    with get_db() as conn:
+        cur = conn.cursor()
+        duplicates = find_duplicate_expenses(cur, *fingerprint, current_user)
+
+        # Ticket déjà scanné (même image) : réponse immédiate
+        cached = find_cached_ocr(cur, fingerprint[0])
+        if cached:
+            data = dict(cached)
+            data.update({"status": "done", "cached": True, "duplicates": duplicates})
+            return jsonify(data)
 
-    if is_admin():
         cur.execute(
-            """
-            SELECT id, user_email, amount, amount_ht, tva_amount,
-                   date, label, chantier, payment_method, comment_text,
-                   receipt_path, created_at, status, validated_by, validated_at
-            FROM expenses
-            ORDER BY date DESC, id DESC
-            """
+            "DELETE FROM ocr_jobs WHERE created_at < NOW() - make_interval(hours => %s)",
+            (OCR_JOB_TTL_HOURS,)
         )
-    else:
+        purge_ocr_cache(cur)
         cur.execute(
-            """
-            SELECT id, user_email, amount, amount_ht, tva_amount,
-                   date, label, chantier, payment_method, comment_text,
-                   receipt_path, created_at, status, validated_by, validated_at
-            FROM expenses
-            WHERE user_email = %s
-            ORDER BY date DESC, id DESC
-            """,
-            (current_user,)
+            "INSERT INTO ocr_jobs (id, user_email) VALUES (%s, %s)",
+            (job_id, current_user)
         )
+        conn.commit()
 
-    rows = cur.fetchall()
-    conn.close()
+    get_ocr_executor().submit(run_ocr_job, job_id, image_bytes, fingerprint)
+    return jsonify({
+        "job_id": job_id,
+        "status": "pending",
+        "status_url": url_for("scan_receipt_status", job_id=job_id),
+        "duplicates": duplicates,
+    }), 202
 
-    data = []
-    for r in rows:
-        data.append({
-            "id": r[0],
-            "user_email": r[1],
-            "amount": float(r[2]),
-            "amount_ht": float(r[3]) if r[3] is not None else None,
-            "tva_amount": float(r[4]) if r[4] is not None else None,
-            "date": r[5].strftime("%Y-%m-%d"),
-            "label": r[6],
-            "chantier": r[7],
-            "payment_method": r[8],
-            "comment_text": r[9],
-            "receipt_path": r[10],
-            "created_at": r[11].isoformat(),
-            "status": r[12],
-            "validated_by": r[13],
-            "validated_at": r[14].isoformat() if r[14] else None,
-        })
+
+@app.route("/api/scan_receipt/<job_id>")
+@login_required
+def scan_receipt_status(job_id):
+    """
+    Résultat d'un scan :
+      - {"status": "pending"}
+      - {"status": "done", "amount": ..., "amount_ht": ..., "tva_amount": ..., "date": ..., ...}
+      - {"status": "failed", "error": ...}
+    """
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT status, result FROM ocr_jobs WHERE id = %s AND user_email = %s",
+            (job_id, session["user_email"])
+        )
+        row = cur.fetchone()
+
+    if not row:
+        return jsonify({"error": "Scan introuvable"}), 404
+
+    status, result = row
+    data = dict(result or {})
+    data["status"] = status
     return jsonify(data)
 
+
 # -----------------------------------------------------------------------------#
-# OCR : Scan d'un ticket pour pré-remplir la note (TTC / HT / TVA)
+# ENVOI DES MAILS : SESSION SMTP PARTAGÉE
 # -----------------------------------------------------------------------------#
-
-def parse_amounts_ttc_ht_tva(text: str):
+SMTP_HOST = os.environ.get("SMTP_HOST")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
+SMTP_USER = os.environ.get("SMTP_USER")
+SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD")
+SMTP_FROM = os.environ.get("SMTP_FROM", "no-reply@batirenov.info")
+# 0 pour un serveur de test local sans TLS (ex: python -m aiosmtpd -n -l localhost:1025)
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "1") != "0"
+# timeout court pour éviter que le worker bloque trop longtemps
+SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", "10"))
+# Session inactive depuis plus longtemps : NOOP avant de s'en resservir
+SMTP_CHECK_AFTER = float(os.environ.get("SMTP_CHECK_AFTER", "60"))
+
+
+class MailTransport:
     """
-    Essaie d'extraire TTC, HT et TVA à partir du texte entier du ticket.
-
-    Stratégie:
-      - on extrait tous les montants avec 2 décimales (10,90 / 10.90)
-      - TTC = plus grand montant
-      - HT  = montant associé à un libellé H.T / HT si présent,
-              sinon le plus grand montant strictement inférieur au TTC
-      - TVA = montant associé à un libellé TVA si présent,
-              sinon TTC - HT
-    On renvoie des chaînes '10.90' ou None.
+    Session SMTP authentifiée gardée ouverte et partagée par les threads du process.
+    - connexion + STARTTLS + login une seule fois, pas à chaque message
+    - reconnexion transparente si le serveur a fermé la session
+    - send_many() envoie un lot de messages sur la même session
     """
-    if not text:
-        return {"ttc": None, "ht": None, "tva": None}
 
-    # Normalisation basique : on remplace les virgules par des points
-    cleaned = text.replace("\u00a0", " ").replace(",", ".")
-    lines = [l.strip() for l in cleaned.splitlines() if l.strip()]
+    def __init__(self, host, port, user=None, password=None,
+                 starttls=True, timeout=10):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self._server = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+        self._stats = {
+            "sent": 0,
+            "failures": 0,
+            "connects": 0,
+            "reconnects": 0,
+            "send_time_ms": 0.0,
+        }
 
-    # 1) Récupérer tous les montants du ticket
-    all_values = []
-    for line in lines:
-        for m in re.findall(r"\d+\.\d{2}", line):
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                server.starttls()
+            if self.user and self.password:
+                server.login(self.user, self.password)
+        except Exception:
+            server.close()
+            raise
+        self._stats["connects"] += 1
+        return server
+
+    def _reset(self):
+        if self._server is not None:
             try:
-                all_values.append(float(m))
-            except ValueError:
+                self._server.close()
+            except Exception:
                 pass
+        self._server = None
 
-    if not all_values:
-        return {"ttc": None, "ht": None, "tva": None}
-
-    # 2) TTC = plus grand montant
-    ttc_val = max(all_values)
-
-    # 3) HT : d'abord via un libellé H.T / HT / H T
-    ht_val = None
-    m_ht = re.search(r"(?:H\.?T\.?|H T|HT)[^0-9]*(\d+\.\d{2})", cleaned, re.IGNORECASE)
-    if m_ht:
-        try:
-            ht_val = float(m_ht.group(1))
-        except ValueError:
-            ht_val = None
-
-    # Sinon : plus grand montant strictement inférieur au TTC
-    if ht_val is None:
-        smaller = [v for v in all_values if v < ttc_val - 1e-6]
-        if smaller:
-            ht_val = max(smaller)
-
-    # 4) TVA : d'abord via un libellé TVA
-    tva_val = None
-    m_tva = re.search(r"TVA[^0-9]*(\d+\.\d{2})", cleaned, re.IGNORECASE)
-    if m_tva:
+    def _session(self):
+        """Session prête à l'emploi (appelé sous verrou)."""
+        if self._server is not None and time.monotonic() - self._last_used > SMTP_CHECK_AFTER:
+            try:
+                if self._server.noop()[0] != 250:
+                    self._reset()
+            except (smtplib.SMTPException, OSError):
+                self._reset()
+        if self._server is None:
+            self._server = self._connect()
+        return self._server
+
+    def _send_one(self, msg):
+        start = time.monotonic()
         try:
-            tva_val = float(m_tva.group(1))
-        except ValueError:
-            tva_val = None
-
-    # Sinon : on calcule TVA = TTC - HT si possible
-    if tva_val is None and ht_val is not None:
-        tva_val = round(ttc_val - ht_val, 2)
-
-    # 5) On renvoie des chaînes "10.90" ou None
-    def fmt(x):
-        return f"{x:.2f}" if x is not None else None
-
-    return {
-        "ttc": fmt(ttc_val),
-        "ht": fmt(ht_val),
-        "tva": fmt(tva_val),
-    }
-
+            try:
+                self._session().send_message(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # session fermée côté serveur : on se reconnecte et on réessaie une fois
+                self._reset()
+                self._stats["reconnects"] += 1
+                self._session().send_message(msg)
+        except Exception:
+            self._stats["failures"] += 1
+            # on ne garde pas une session dans un état inconnu
+            self._reset()
+            raise
+        self._last_used = time.monotonic()
+        self._stats["sent"] += 1
+        self._stats["send_time_ms"] += (self._last_used - start) * 1000
+
+    def send(self, msg):
+        self.send_many([msg])
+
+    def send_many(self, messages):
+        with self._lock:
+            for msg in messages:
+                self._send_one(msg)
+
+    def close(self):
+        with self._lock:
+            if self._server is not None:
+                try:
+                    self._server.quit()
+                except Exception:
+                    pass
+                self._server = None
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+        sent = data["sent"]
+        data["send_time_ms"] = round(data["send_time_ms"], 1)
+        data["avg_send_ms"] = round(data["send_time_ms"] / sent, 1) if sent else None
+        data["connected"] = self._server is not None
+        data["pid"] = os.getpid()
+        return data
+
+
+_mail_transport = None
+_mail_transport_pid = None
+_mail_transport_lock = threading.Lock()
+
+
+def get_mail_transport():
+    """Transport SMTP du process courant (recréé après un fork, comme le pool DB)."""
+    global _mail_transport, _mail_transport_pid
+    if not SMTP_HOST:
+        raise RuntimeError("SMTP_HOST is not configured")
+    pid = os.getpid()
+    if _mail_transport is None or _mail_transport_pid != pid:
+        with _mail_transport_lock:
+            if _mail_transport is None or _mail_transport_pid != pid:
+                _mail_transport = MailTransport(
+                    SMTP_HOST,
+                    SMTP_PORT,
+                    SMTP_USER,
+                    SMTP_PASSWORD,
+                    starttls=SMTP_STARTTLS,
+                    timeout=SMTP_TIMEOUT,
+                )
+                _mail_transport_pid = pid
+    return _mail_transport
 
-def extract_date(text: str):
-    """
-    Cherche une date JJ/MM/AAAA ou AAAA-MM-JJ.
-    Retourne une date ISO (YYYY-MM-DD) ou None.
-    """
-    if not text:
-        return None
 
-    # format français JJ/MM/AAAA
-    m = re.search(r"(\d{2}/\d{2}/\d{4})", text)
-    if m:
-        try:
-            d = datetime.strptime(m.group(1), "%d/%m/%Y").date()
-            return d.isoformat()
-        except ValueError:
-            pass
+def build_mail(subject, body, to="compta@batirenov.info"):
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = SMTP_FROM
+    msg["To"] = to
+    msg.set_content(body)
+    return msg
 
-    # format ISO AAAA-MM-JJ
-    m = re.search(r"(\d{4}-\d{2}-\d{2})", text)
-    if m:
-        return m.group(1)
 
-    return None
+def _start_smtp_standin(received):
+    """Serveur SMTP local (aiosmtpd) qui garde les messages reçus dans received. Retourne (port, arrêt)."""
+    import socket
+    from aiosmtpd.controller import Controller
 
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
 
-@app.route("/api/scan_receipt", methods=["POST"])
-@login_required
-def scan_receipt():
-    file = request.files.get("receipt")
-    if not file:
-        return jsonify({"error": "Aucun fichier reçu"}), 400
+    class Handler:
+        async def handle_DATA(self, server, session, envelope):
+            received.append(envelope.content)
+            return "250 OK"
 
-    ocr_api_key = os.environ.get("OCRSPACE_API_KEY")
-    ocr_url = os.environ.get("OCRSPACE_URL", "https://api.ocr.space/parse/image")
+    controller = Controller(Handler(), hostname="127.0.0.1", port=port)
+    controller.start()
+    return port, controller.stop
 
-    if not ocr_api_key:
-        return jsonify({"error": "OCR non configuré (OCRSPACE_API_KEY manquant)"}), 500
 
-    # On compresse/redimensionne l'image pour rester < 1 Mo
+def cli_smtp_check():
+    """
+    python app.py smtp_check : MailTransport contre un serveur SMTP local (aucun vrai relais).
+    Un lot de 3 mails sur une seule session, puis un mail après une session coupée
+    (reconnexion). Code retour 1 si les compteurs ne sont pas ceux attendus.
+    """
+    import socket
+    received = []
+    port, stop = _start_smtp_standin(received)
+    transport = MailTransport("127.0.0.1", port, starttls=False, timeout=5)
     try:
-        img = PILImage.open(file.stream)
-
-        max_width = 1200
-        if img.width > max_width:
-            ratio = max_width / float(img.width)
-            new_height = int(float(img.height) * ratio)
-            img = img.resize((max_width, new_height))
-
-        buf = io.BytesIO()
-        img = img.convert("RGB")
-        img.save(buf, format="JPEG", quality=60)
-        buf.seek(0)
-
-        files = {"file": ("ticket.jpg", buf, "image/jpeg")}
-        resp = requests.post(
-            ocr_url,
-            files=files,
-            data={
-                "apikey": ocr_api_key,
-                "language": "fre",
-                "OCREngine": 2,
-            },
-            timeout=60,
-        )
-        resp.raise_for_status()
-        data = resp.json()
-    except Exception as e:
-        return jsonify({"error": f"Erreur OCR: {e}"}), 500
-
-    # Si l'API indique une erreur
-    if data.get("IsErroredOnProcessing"):
-        msg_list = data.get("ErrorMessage") or []
-        if isinstance(msg_list, list):
-            msg = " ".join(msg_list)
-        else:
-            msg = str(msg_list)
-        return jsonify({"error": f"OCR: {msg}"}), 500
+        transport.send_many([build_mail(f"Contrôle SMTP {i}", "Test") for i in range(3)])
+        # coupure de la session entre deux envois : le suivant doit se reconnecter
+        transport._server.sock.shutdown(socket.SHUT_RDWR)
+        transport.send(build_mail("Contrôle SMTP après coupure", "Test"))
+        transport.close()
+        deadline = time.monotonic() + 5
+        while len(received) < 4 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        stop()
+
+    stats = transport.stats()
+    print(f"[MAIL] Contrôle SMTP : {len(received)} mail(s) reçu(s), {stats}", flush=True)
+    expected = {"sent": 4, "failures": 0, "connects": 2, "reconnects": 1}
+    if len(received) != 4 or any(stats[k] != v for k, v in expected.items()):
+        print(f"[MAIL] Contrôle SMTP en échec (attendu : 4 reçus, {expected})", flush=True)
+        raise SystemExit(1)
+    print("[MAIL] Contrôle SMTP OK", flush=True)
 
-    parsed_results = data.get("ParsedResults")
-    if not parsed_results:
-        return jsonify({"error": "OCR n'a pas réussi à lire le ticket."}), 500
 
-    text = " ".join(r.get("ParsedText", "") for r in parsed_results) or ""
+# -----------------------------------------------------------------------------#
+# GÉNÉRATION DU RÉCAP MENSUEL + ENVOI MAIL / EXPORT
+# -----------------------------------------------------------------------------#
 
-    # Logs debug dans Render
-    print("=== OCR RAW TEXT ===")
-    print(text)
-    print("====================")
+# Lignes lues à la fois par les curseurs serveur des exports
+EXPORT_ITERSIZE = int(os.environ.get("EXPORT_ITERSIZE", "2000"))
+# Lignes CSV regroupées par morceau envoyé au client
+EXPORT_CHUNK_ROWS = 500
 
-    # --- Montants TTC / HT / TVA
-    amounts = parse_amounts_ttc_ht_tva(text)
-    amount = amounts["ttc"]          # TTC pour le champ principal
-    amount_ht = amounts["ht"]
-    tva_amount = amounts["tva"]
 
-    # --- Date & libellé
-    date_str = extract_date(text)
-    label_guess = text.strip().replace("\n", " ")[:80] if text else ""
+def iter_query(query, params=()):
+    """
+    Parcourt un SELECT via un curseur côté serveur (curseur nommé) :
+    seules EXPORT_ITERSIZE lignes sont en mémoire à la fois.
+    La connexion est rendue au pool quand le générateur est épuisé ou fermé.
+    """
+    with get_db() as conn:
+        with conn.cursor(name=f"export_{uuid.uuid4().hex}") as cur:
+            cur.itersize = EXPORT_ITERSIZE
+            cur.execute(query, params)
+            for row in cur:
+                yield row
 
-    # Si vraiment rien d'exploitable
-    if not amount and not amount_ht and not tva_amount and not date_str:
-        return jsonify({
-            "error": "Le ticket a été lu mais aucun montant ou date n'ont été détectés.",
-            "raw_text": text,
-        }), 500
 
-    return jsonify({
-        "amount": amount,          # TTC
-        "amount_ht": amount_ht,    # HT (peut être None)
-        "tva_amount": tva_amount,  # TVA (peut être None)
-        "date": date_str,
-        "label": label_guess,
-        "raw_text": text,
-    })
+def iter_csv_chunks(header, rows):
+    """Générateur de morceaux de CSV (séparateur ;) à partir de listes de valeurs."""
+    output = io.StringIO()
+    writer = csv.writer(output, delimiter=";")
+    writer.writerow(header)
+    for n, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if n % EXPORT_CHUNK_ROWS == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue()
+
+
+def csv_download(chunks, filename):
+    """Réponse CSV envoyée au fil de l'eau (chunked), sans tout garder en mémoire."""
+    return Response(
+        chunks,
+        mimetype="text/csv; charset=utf-8",
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}"
+        }
+    )
 
-# -----------------------------------------------------------------------------#
-# GÉNÉRATION DU RÉCAP MENSUEL + ENVOI MAIL / EXPORT
-# -----------------------------------------------------------------------------#
 
-def generate_monthly_report(year: int, month: int, approved_only: bool = True):
+def iter_monthly_report(year: int, month: int, approved_only: bool = True):
     """
-    Récupère les notes de frais pour un mois donné.
+    Parcourt les notes de frais d'un mois donné (Expense), sans tout charger.
 
     approved_only = True  -> uniquement les notes avec status = 'approved'
     approved_only = False -> toutes les notes, peu importe le statut
     """
-    conn = get_db()
-    cur = conn.cursor()
-
     start = date(year, month, 1)
     if month == 12:
         end = date(year + 1, 1, 1)
     else:
         end = date(year, month + 1, 1)
 
-    query = """
-        SELECT user_email, amount, amount_ht, tva_amount,
-               date, label, chantier, payment_method, comment_text,
-               receipt_path, status
+    query = f"""
+        SELECT {EXPENSE_COLUMNS}
         FROM expenses
         WHERE date >= %s AND date < %s
     """
@@ -734,61 +3003,179 @@ def generate_monthly_report(year: int, month: int, approved_only: bool = True):
 
     query += " ORDER BY date ASC"
 
-    cur.execute(query, params)
-    rows = cur.fetchall()
-    conn.close()
+    return map(expense_from_row, iter_query(query, params))
+
+
+def generate_monthly_report(year: int, month: int, approved_only: bool = True):
+    """Notes de frais d'un mois donné, en liste (voir iter_monthly_report)."""
+    return list(iter_monthly_report(year, month, approved_only))
 
-    result = []
-    for r in rows:
-        result.append({
-            "user_email": r[0],
-            "amount": float(r[1]),
-            "amount_ht": float(r[2]) if r[2] is not None else None,
-            "tva_amount": float(r[3]) if r[3] is not None else None,
-            "date": r[4].strftime("%Y-%m-%d"),
-            "label": r[5],
-            "chantier": r[6],
-            "payment_method": r[7],
-            "comment_text": r[8],
-            "receipt_path": r[9],
-            "status": r[10],
-        })
-    return result
+
+def iter_report_csv(rows):
+    """Morceaux du CSV récap à partir des Expense de iter_monthly_report."""
+    return iter_csv_chunks(REPORT_CSV_HEADER, map(expense_report_csv_row, rows))
 
 
 def format_report_csv(rows):
-    import io
-    import csv as csv_module
-    output = io.StringIO()
-    writer = csv_module.writer(output, delimiter=";")
-    writer.writerow([
-        "Date", "Montant TTC", "Montant HT", "TVA",
-        "Libellé", "Chantier", "Utilisateur",
-        "Moyen de paiement", "Commentaire",
-        "Statut", "Justificatif"
-    ])
-    for r in rows:
-        writer.writerow([
-            r["date"],
-            r["amount"],
-            r["amount_ht"] if r["amount_ht"] is not None else "",
-            r["tva_amount"] if r["tva_amount"] is not None else "",
-            r["label"],
-            r["chantier"],
-            r["user_email"],
-            r.get("payment_method") or "",
-            r.get("comment_text") or "",
-            r.get("status", ""),
-            r["receipt_path"] or "",
-        ])
-    return output.getvalue()
+    """CSV récap complet en une chaîne (pièce jointe du mail)."""
+    return "".join(iter_report_csv(rows))
+
+
+# Cache disque des justificatifs distants (Cloudinary) : une URL = un contenu immuable
+RECEIPT_CACHE_DIR = os.environ.get("RECEIPT_CACHE_DIR", os.path.join(BASE_DIR, "cache", "receipts"))
+# Téléchargements simultanés pour les exports PDF
+RECEIPT_FETCH_WORKERS = int(os.environ.get("RECEIPT_FETCH_WORKERS", "8"))
+
+_http_session = None
+_http_session_pid = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """Session requests du process (keep-alive), dimensionnée pour RECEIPT_FETCH_WORKERS threads."""
+    global _http_session, _http_session_pid
+    pid = os.getpid()
+    if _http_session is None or _http_session_pid != pid:
+        with _http_session_lock:
+            if _http_session is None or _http_session_pid != pid:
+                http_session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=4, pool_maxsize=RECEIPT_FETCH_WORKERS
+                )
+                http_session.mount("https://", adapter)
+                http_session.mount("http://", adapter)
+                _http_session = http_session
+                _http_session_pid = pid
+    return _http_session
+
+
+def fetch_receipt_file(receipt_path):
+    """
+    Chemin d'un fichier local contenant le justificatif, ou None s'il est introuvable.
+    - URL : téléchargée une seule fois dans RECEIPT_CACHE_DIR (clé = sha256 de l'URL)
+    - sinon : fichier de /uploads
+    """
+    if not receipt_path.startswith("http"):
+        local_path = os.path.join(app.config["UPLOAD_FOLDER"], receipt_path)
+        return local_path if os.path.exists(local_path) else None
+
+    key = hashlib.sha256(receipt_path.encode("utf-8")).hexdigest()
+    cache_path = os.path.join(RECEIPT_CACHE_DIR, key[:2], key)
+    if os.path.exists(cache_path):
+        return cache_path
+
+    resp = get_http_session().get(receipt_path, timeout=30)
+    resp.raise_for_status()
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # écriture atomique : un autre thread/worker ne lit jamais un fichier à moitié écrit
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(resp.content)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+# Images des PDF : résolution d'impression visée et qualité JPEG
+PDF_IMAGE_DPI = int(os.environ.get("PDF_IMAGE_DPI", "150"))
+PDF_IMAGE_QUALITY = int(os.environ.get("PDF_IMAGE_QUALITY", "70"))
+PDF_IMAGE_CACHE_DIR = os.environ.get("PDF_IMAGE_CACHE_DIR", os.path.join(BASE_DIR, "cache", "pdf_images"))
+
+
+def prepare_pdf_image(src_path, box):
+    """
+    Version allégée d'un justificatif pour le PDF : remise à l'endroit (EXIF),
+    réduite pour tenir dans box (largeur, hauteur en points) à PDF_IMAGE_DPI,
+    puis recompressée en JPEG. Le résultat est gardé en cache disque.
+    Retourne le chemin de l'image préparée (ou src_path si ce n'est pas une image lisible).
+    """
+    max_w = int(box[0] / 72 * PDF_IMAGE_DPI)
+    max_h = int(box[1] / 72 * PDF_IMAGE_DPI)
+
+    st = os.stat(src_path)
+    key = hashlib.sha256(
+        f"{os.path.abspath(src_path)}|{st.st_mtime_ns}|{st.st_size}|"
+        f"{max_w}x{max_h}|q{PDF_IMAGE_QUALITY}".encode("utf-8")
+    ).hexdigest()
+    out_path = os.path.join(PDF_IMAGE_CACHE_DIR, key[:2], f"{key}.jpg")
+    if os.path.exists(out_path):
+        return out_path
+
+    tmp_path = f"{out_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with PILImage.open(src_path) as img:
+            # JPEG : décodage directement à une résolution réduite (bien plus rapide)
+            # ; carré car l'image peut encore être pivotée par l'EXIF
+            side = max(max_w, max_h)
+            img.draft("RGB", (side, side))
+            img = flatten_to_rgb(ImageOps.exif_transpose(img))
+            img.thumbnail((max_w, max_h), PILImage.LANCZOS)
+
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            img.save(tmp_path, format="JPEG", quality=PDF_IMAGE_QUALITY, optimize=True)
+        os.replace(tmp_path, out_path)
+    except (UnidentifiedImageError, PILImage.DecompressionBombError, OSError, SyntaxError) as e:
+        # JPEG tronqué, image piégée, cache plein... : l'original part tel quel dans le PDF
+        print(f"[EXPORT] Image non préparée pour le PDF ({src_path}) : {e!r}", flush=True)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return src_path
+    return out_path
+
+
+def _fetch_and_prepare(receipt_path, image_box):
+    local_file = fetch_receipt_file(receipt_path)
+    if local_file and image_box:
+        local_file = prepare_pdf_image(local_file, image_box)
+    return local_file
+
+
+def prefetch_receipts(receipt_paths, image_box=None, progress=None):
+    """
+    Récupère en parallèle (pool de threads borné) les justificatifs d'un export.
+    Si image_box (largeur, hauteur en points) est donné, les images sont aussi
+    préparées pour le PDF (voir prepare_pdf_image).
+    progress(receipts_done=..., receipts_total=...) est appelé à chaque justificatif.
+    Retourne {receipt_path: chemin local} ; les échecs sont logués et absents du dict.
+    """
+    unique_paths = list(dict.fromkeys(p for p in receipt_paths if p))
+    if not unique_paths:
+        return {}
+
+    files = {}
+    with ThreadPoolExecutor(max_workers=RECEIPT_FETCH_WORKERS) as executor:
+        futures = {
+            executor.submit(_fetch_and_prepare, p, image_box): p
+            for p in unique_paths
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            receipt_path = futures[future]
+            if progress:
+                progress(receipts_done=done, receipts_total=len(futures))
+            try:
+                local_file = future.result()
+            except Exception as e:
+                print(f"[PDF] Erreur téléchargement {receipt_path}: {e!r}", flush=True)
+                continue
+            if local_file:
+                files[receipt_path] = local_file
+    return files
 
 
 def generate_pdf_report(rows):
     """Génère un PDF avec un tableau récapitulatif puis les justificatifs en plein format."""
     pdf_buffer = io.BytesIO()
+    write_pdf_report(rows, pdf_buffer)
+    return pdf_buffer.getvalue()
+
+
+def write_pdf_report(rows, output, progress=None):
+    """
+    Écrit le PDF de generate_pdf_report dans output (chemin de fichier ou buffer).
+    progress : voir prefetch_receipts.
+    """
     doc = SimpleDocTemplate(
-        pdf_buffer,
+        output,
         pagesize=A4,
         rightMargin=20 * mm,
         leftMargin=20 * mm,
@@ -825,33 +3212,16 @@ def generate_pdf_report(rows):
         Paragraph("Statut", header_style),
     ]
 
-    def fmt_amount(value):
-        if value is None:
-            return ""
-        try:
-            return f"{float(value):.2f} €"
-        except (TypeError, ValueError):
-            return ""
-
     def wrap_text(value):
         if not value:
             return ""
-        return Paragraph(str(value), paragraph_style)
+        return Paragraph(value, paragraph_style)
 
     table_data = [headers]
-    for r in rows:
-        table_data.append([
-            r.get("date", ""),
-            fmt_amount(r.get("amount")),
-            fmt_amount(r.get("amount_ht")),
-            fmt_amount(r.get("tva_amount")),
-            wrap_text(r.get("label", "")),
-            wrap_text(r.get("chantier", "")),
-            wrap_text(r.get("payment_method") or ""),
-            wrap_text(r.get("comment_text") or ""),
-            wrap_text(r.get("user_email", "")),
-            wrap_text(r.get("status", "")),
-        ])
+    for e in rows:
+        cells = expense_pdf_cells(e)
+        # date et montants en texte brut, le reste peut passer à la ligne
+        table_data.append([*cells[:4], *map(wrap_text, cells[4:])])
 
     width_ratios = [0.09, 0.08, 0.08, 0.06, 0.16, 0.12, 0.10, 0.12, 0.14, 0.05]
     col_widths = [doc.width * r for r in width_ratios]
@@ -875,38 +3245,205 @@ def generate_pdf_report(rows):
 
     elements.append(table)
 
-    for r in rows:
-        receipt_path = r.get("receipt_path")
-        if not receipt_path:
+    image_box = (doc.width, doc.height - 30)  # marge safe
+    receipt_files = prefetch_receipts(
+        (e.receipt_path for e in rows), image_box, progress
+    )
+
+    for e in rows:
+        receipt_path = e.receipt_path
+        local_file = receipt_files.get(receipt_path) if receipt_path else None
+        if not local_file:
             continue
 
         elements.append(PageBreak())
 
         try:
-            if receipt_path.startswith("http"):
-                resp = requests.get(receipt_path, timeout=30)
-                resp.raise_for_status()
-                img_bytes = io.BytesIO(resp.content)
-            else:
-                local_path = os.path.join(app.config["UPLOAD_FOLDER"], receipt_path)
-                if not os.path.exists(local_path):
-                    continue
-                with open(local_path, "rb") as f:
-                    img_bytes = io.BytesIO(f.read())
-
-            img_bytes.seek(0)
-
-            img = RLImage(img_bytes)
+            img = RLImage(local_file)
             img.hAlign = "CENTER"
-            img._restrictSize(doc.width, doc.height - 30)  # marge safe
+            img._restrictSize(*image_box)
             elements.append(img)
         except Exception as e:
             print(f"[PDF] Erreur image {receipt_path}: {e!r}", flush=True)
             continue
 
     doc.build(elements)
-    pdf_buffer.seek(0)
-    return pdf_buffer.getvalue()
+
+
+# -----------------------------------------------------------------------------#
+# RÉCAPS MENSUELS MATÉRIALISÉS (CSV / PDF des mois clos)
+# -----------------------------------------------------------------------------#
+REPORT_CACHE_DIR = os.environ.get("REPORT_CACHE_DIR", os.path.join(BASE_DIR, "cache", "reports"))
+# Un ancien fichier de récap n'est effacé qu'après ce délai : une requête peut encore être
+# en train de l'envoyer, ou une construction concurrente ne l'avoir pas encore enregistré
+REPORT_FILE_GRACE_SECONDS = 3600
+
+
+def invalidate_month_reports(cur, dates):
+    """
+    À appeler dans la transaction qui ajoute / valide / refuse / supprime une note :
+    les récaps déjà produits pour ces mois ne seront plus servis.
+    """
+    months = sorted({(d.year, d.month) for d in dates if d})
+    if not months:
+        return
+    execute_values(
+        cur,
+        """
+        INSERT INTO report_months (year, month, version)
+        VALUES %s
+        ON CONFLICT (year, month) DO UPDATE SET version = report_months.version + 1
+        """,
+        [(year, month, 1) for year, month in months]
+    )
+
+
+def is_closed_month(year: int, month: int):
+    today = date.today()
+    return (year, month) < (today.year, today.month)
+
+
+def _report_snapshot_dict(row):
+    return {
+        "file_path": row[0],
+        "content_hash": row[1],
+        "row_count": row[2],
+        "total_ttc": row[3],
+        "total_ht": row[4],
+        "total_tva": row[5],
+    }
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_month_report(year: int, month: int, kind: str, approved_only: bool,
+                     build=True, progress=None):
+    """
+    Récap d'un mois clos (kind = "csv" ou "pdf"), produit une seule fois puis
+    servi depuis le disque tant qu'aucune note du mois n'a changé.
+    Retourne un dict (file_path, content_hash, row_count, total_ttc, total_ht, total_tva),
+    ou None pour le mois en cours (qui bouge encore : on ne le matérialise pas).
+    build=False : consultation seule, None si le récap n'est pas à jour (le PDF se
+    construit alors dans un job d'export, voir admin_export_pdf).
+    """
+    if not is_closed_month(year, month):
+        return None
+
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT COALESCE(MAX(version), 0) FROM report_months WHERE year = %s AND month = %s",
+            (year, month)
+        )
+        version = cur.fetchone()[0]
+        cur.execute(
+            """
+            SELECT file_path, content_hash, row_count, total_ttc, total_ht, total_tva
+            FROM report_snapshots
+            WHERE year = %s AND month = %s AND kind = %s AND approved_only = %s
+              AND version = %s
+            """,
+            (year, month, kind, approved_only, version)
+        )
+        row = cur.fetchone()
+
+    if row and os.path.exists(row[0]):
+        return _report_snapshot_dict(row)
+    if not build:
+        return None
+
+    # Version lue AVANT les données : une modification pendant la construction
+    # incrémente la version, et ce snapshot ne sera alors jamais servi.
+    rows = generate_monthly_report(year, month, approved_only)
+    if progress:
+        progress(rows_done=0, rows_total=len(rows))
+
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    scope = "approved" if approved_only else "all"
+    prefix = f"{year}-{month:02d}-{scope}-"
+    tmp_path = os.path.join(
+        REPORT_CACHE_DIR, f"{prefix}{uuid.uuid4().hex}.{kind}.tmp"
+    )
+    if kind == "pdf":
+        write_pdf_report(rows, tmp_path, progress)
+    else:
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            for chunk in iter_report_csv(rows):
+                f.write(chunk)
+
+    content_hash = _file_sha256(tmp_path)
+    file_path = os.path.join(REPORT_CACHE_DIR, f"{prefix}{content_hash[:16]}.{kind}")
+    os.replace(tmp_path, file_path)
+
+    row = (
+        file_path,
+        content_hash,
+        len(rows),
+        sum((e.amount for e in rows), Decimal(0)),
+        sum((e.amount_ht or 0 for e in rows), Decimal(0)),
+        sum((e.tva_amount or 0 for e in rows), Decimal(0)),
+    )
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO report_snapshots
+                (year, month, kind, approved_only, version, content_hash, file_path,
+                 row_count, total_ttc, total_ht, total_tva)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (year, month, kind, approved_only) DO UPDATE
+            SET version = EXCLUDED.version,
+                content_hash = EXCLUDED.content_hash,
+                file_path = EXCLUDED.file_path,
+                row_count = EXCLUDED.row_count,
+                total_ttc = EXCLUDED.total_ttc,
+                total_ht = EXCLUDED.total_ht,
+                total_tva = EXCLUDED.total_tva,
+                created_at = NOW()
+            WHERE report_snapshots.version <= EXCLUDED.version
+            """,
+            (year, month, kind, approved_only, version) + row
+        )
+        # construction plus ancienne terminée après une plus récente : snapshot non remplacé
+        cur.execute(
+            """
+            SELECT file_path FROM report_snapshots
+            WHERE year = %s AND month = %s AND kind = %s AND approved_only = %s
+            """,
+            (year, month, kind, approved_only)
+        )
+        current = cur.fetchone()
+        conn.commit()
+
+    # anciens fichiers de ce récap : ni le snapshot en base, ni un fichier récent
+    # (celui qu'on va envoyer, ou celui d'une construction concurrente)
+    keep = {file_path, current[0] if current else None}
+    cutoff = time.time() - REPORT_FILE_GRACE_SECONDS
+    for name in os.listdir(REPORT_CACHE_DIR):
+        old_path = os.path.join(REPORT_CACHE_DIR, name)
+        if (name.startswith(prefix) and name.endswith(f".{kind}") and old_path not in keep
+                and os.path.getmtime(old_path) < cutoff):
+            os.remove(old_path)
+    return _report_snapshot_dict(row)
+
+
+def send_month_report(snapshot, filename):
+    """Réponse de téléchargement d'un récap matérialisé (ETag = hash du contenu)."""
+    kind = snapshot["file_path"].rsplit(".", 1)[-1]
+    return send_file(
+        snapshot["file_path"],
+        mimetype="application/pdf" if kind == "pdf" else "text/csv; charset=utf-8",
+        as_attachment=True,
+        download_name=filename,
+        etag=snapshot["content_hash"],
+        conditional=True,
+    )
 
 
 @app.route("/admin/export_last_month")
@@ -925,18 +3462,9 @@ def admin_export_last_month():
     month = today.month - 1 or 12
     year = today.year if today.month > 1 else today.year - 1
 
-    # On génère les données -> uniquement approved
-    rows = generate_monthly_report(year, month, approved_only=True)
-    csv_content = format_report_csv(rows)
-
+    # On génère les données -> uniquement approved (mois clos : récap matérialisé)
     filename = f"notes-de-frais-{year}-{month:02d}.csv"
-    return Response(
-        csv_content,
-        mimetype="text/csv; charset=utf-8",
-        headers={
-            "Content-Disposition": f"attachment; filename={filename}"
-        }
-    )
+    return send_month_report(get_month_report(year, month, "csv", True), filename)
 
 
 def send_report_email(year: int, month: int):
@@ -944,47 +3472,42 @@ def send_report_email(year: int, month: int):
     Envoi du récap par mail (si SMTP dispo).
     On n'envoie que les notes APPROUVÉES.
     """
-    import smtplib
-    from email.message import EmailMessage
-
-    rows = generate_monthly_report(year, month, approved_only=True)
-    csv_content = format_report_csv(rows)
+    snapshot = get_month_report(year, month, "csv", True)
+    if snapshot:
+        with open(snapshot["file_path"], "rb") as f:
+            csv_bytes = f.read()
+        totals = (
+            f"{snapshot['row_count']} note(s) validée(s), "
+            f"total {snapshot['total_ttc']:.2f} € TTC "
+            f"({snapshot['total_ht']:.2f} € HT, {snapshot['total_tva']:.2f} € TVA).\n"
+        )
+    else:
+        csv_bytes = format_report_csv(
+            generate_monthly_report(year, month, approved_only=True)
+        ).encode("utf-8")
+        totals = ""
 
-    msg = EmailMessage()
-    msg["Subject"] = f"Récap notes de frais {year}-{month:02d}"
-    msg["From"] = os.environ.get("SMTP_FROM", "no-reply@batirenov.info")
-    msg["To"] = "compta@batirenov.info"
-    msg.set_content(
+    msg = build_mail(
+        f"Récap notes de frais {year}-{month:02d}",
         f"Bonjour,\n\n"
-        f"Veuillez trouver ci-joint le récapitulatif des notes de frais pour {year}-{month:02d}.\n\n"
+        f"Veuillez trouver ci-joint le récapitulatif des notes de frais pour {year}-{month:02d}.\n"
+        f"{totals}\n"
         f"Cordialement,\n"
         f"L'application notes de frais BATI RENOV"
     )
 
     msg.add_attachment(
-        csv_content.encode("utf-8"),
+        csv_bytes,
         maintype="text",
         subtype="csv",
         filename=f"notes-de-frais-{year}-{month:02d}.csv"
     )
 
-    host = os.environ.get("SMTP_HOST")
-    port = int(os.environ.get("SMTP_PORT", "587"))
-    user = os.environ.get("SMTP_USER")
-    password = os.environ.get("SMTP_PASSWORD")
-
-    if not host:
-        raise RuntimeError("SMTP_HOST is not configured")
-
-    print(f"[MAIL] Envoi du récap {year}-{month:02d} via {host}:{port}", flush=True)
+    transport = get_mail_transport()
+    print(f"[MAIL] Envoi du récap {year}-{month:02d} via {SMTP_HOST}:{SMTP_PORT}", flush=True)
 
     try:
-        # timeout court pour éviter que le worker bloque trop longtemps
-        with smtplib.SMTP(host, port, timeout=10) as server:
-            server.starttls()
-            if user and password:
-                server.login(user, password)
-            server.send_message(msg)
+        transport.send(msg)
         print("[MAIL] Envoi OK", flush=True)
     except Exception as e:
         # log bien visible dans Render
@@ -993,39 +3516,29 @@ def send_report_email(year: int, month: int):
         raise
 
 
-def send_new_expense_email():
-    """Envoi d'une notification simple pour chaque nouvelle note de frais."""
-    import smtplib
-    from email.message import EmailMessage
-
-    host = os.environ.get("SMTP_HOST")
-    port = int(os.environ.get("SMTP_PORT", "587"))
-    user = os.environ.get("SMTP_USER")
-    password = os.environ.get("SMTP_PASSWORD")
-    from_addr = os.environ.get("SMTP_FROM", "no-reply@batirenov.info")
-
-    if not host:
-        print("[MAIL] SMTP_HOST non configuré, notification non envoyée", flush=True)
-        return
+def send_new_expenses_digest(items):
+    """
+    Envoi d'une seule notification pour un lot de nouvelles notes de frais.
+    items : liste de (date, montant, libellé, chantier, utilisateur).
+    """
+    transport = get_mail_transport()
 
-    msg = EmailMessage()
-    msg["Subject"] = "Nouvelle note de frais"
-    msg["From"] = from_addr
-    msg["To"] = "compta@batirenov.info"
-    msg.set_content("Une nouvelle note de frais vient d'arriver !")
+    lines = [
+        f"- {d:%Y-%m-%d} · {amount:.2f} € · {label} · {chantier} · {user_email}"
+        for d, amount, label, chantier, user_email in items
+    ]
 
-    print(f"[MAIL] Envoi notification nouvelle note via {host}:{port}", flush=True)
+    if len(items) == 1:
+        subject = "Nouvelle note de frais"
+        intro = "Une nouvelle note de frais vient d'arriver !"
+    else:
+        subject = f"{len(items)} nouvelles notes de frais"
+        intro = f"{len(items)} nouvelles notes de frais viennent d'arriver :"
+    msg = build_mail(subject, intro + "\n\n" + "\n".join(lines))
 
-    try:
-        with smtplib.SMTP(host, port, timeout=10) as server:
-            server.starttls()
-            if user and password:
-                server.login(user, password)
-            server.send_message(msg)
-        print("[MAIL] Notification nouvelle note envoyée", flush=True)
-    except Exception as e:
-        print(f"[MAIL] ERREUR SMTP nouvelle note : {e!r}", flush=True)
-        raise
+    print(f"[MAIL] Envoi notification ({len(items)} note(s)) via {SMTP_HOST}:{SMTP_PORT}", flush=True)
+    transport.send(msg)
+    print("[MAIL] Notification nouvelles notes envoyée", flush=True)
 
 
 @app.route("/admin/send_report_now")
@@ -1066,17 +3579,17 @@ def admin_export():
     except (TypeError, ValueError):
         return "Paramètres year et month invalides", 400
 
-    rows = generate_monthly_report(year, month, approved_only=True)
-    csv_content = format_report_csv(rows)
+    if month < 1 or month > 12:
+        return "Paramètre month invalide", 400
 
     filename = f"notes-de-frais-{year}-{month:02d}.csv"
-    return Response(
-        csv_content,
-        mimetype="text/csv; charset=utf-8",
-        headers={
-            "Content-Disposition": f"attachment; filename={filename}"
-        }
-    )
+    snapshot = get_month_report(year, month, "csv", True)
+    if snapshot:
+        return send_month_report(snapshot, filename)
+
+    # mois en cours : généré à la volée
+    rows = iter_monthly_report(year, month, approved_only=True)
+    return csv_download(iter_report_csv(rows), filename)
 
 
 @app.route("/admin/export_pdf")
@@ -1092,17 +3605,27 @@ def admin_export_pdf():
     if month < 1 or month > 12:
         return "Paramètre month invalide", 400
 
-    rows = generate_monthly_report(year, month, approved_only=False)
-    pdf_bytes = generate_pdf_report(rows)
-
     filename = f"notes-de-frais-{year}-{month:02d}.pdf"
-    return Response(
-        pdf_bytes,
-        mimetype="application/pdf",
-        headers={
-            "Content-Disposition": f"attachment; filename={filename}"
-        },
-    )
+    snapshot = get_month_report(year, month, "pdf", False, build=False)
+    if snapshot:
+        return send_month_report(snapshot, filename)
+
+    # pas de récap à jour (ou mois en cours) : PDF construit par un job d'export,
+    # réponse immédiate avec son suivi (status_url, puis download_url)
+    job_id = enqueue_export_job("pdf", {"year": year, "month": month}, session["user_email"])
+    return jsonify(export_job_to_dict(get_export_job(job_id))), 202
+
+
+def iter_all_expenses_csv_rows():
+    """Toutes les notes (tous statuts, toutes dates), en lignes CSV, au fil de l'eau."""
+    rows = iter_query(f"SELECT {EXPENSE_COLUMNS} FROM expenses ORDER BY date ASC, id ASC")
+    return map(expense_full_csv_row, map(expense_from_row, rows))
+
+
+def all_expenses_pdf_rows():
+    """Toutes les notes (tous statuts, toutes dates), en Expense pour le PDF."""
+    rows = iter_query(f"SELECT {EXPENSE_COLUMNS} FROM expenses ORDER BY date ASC, id ASC")
+    return list(map(expense_from_row, rows))
 
 
 @app.route("/admin/export_all_now")
@@ -1110,143 +3633,23 @@ def admin_export_pdf():
 def admin_export_all_now():
     """
     Export CSV de TOUTES les notes de frais (tous statuts, toutes dates).
-    Accessible uniquement pour les admins, via un bouton dans l'interface.
+    Envoyé au fil de l'eau : la mémoire ne dépend pas du nombre de notes.
+    (Le bouton de l'interface passe par un export en arrière-plan, voir /admin/export_jobs.)
     """
-    import io
-    import csv as csv_module
-
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT
-            date,
-            amount,
-            amount_ht,
-            tva_amount,
-            label,
-            chantier,
-            payment_method,
-            comment_text,
-            user_email,
-            receipt_path,
-            status,
-            validated_by,
-            validated_at
-        FROM expenses
-        ORDER BY date ASC, id ASC
-        """
-    )
-    rows = cur.fetchall()
-    conn.close()
-
-    output = io.StringIO()
-    writer = csv_module.writer(output, delimiter=";")
-
-    # En-têtes du CSV
-    writer.writerow([
-        "Date",
-        "Montant TTC",
-        "Montant HT",
-        "TVA",
-        "Libellé",
-        "Chantier",
-        "Moyen de paiement",
-        "Commentaire",
-        "Utilisateur",
-        "Justificatif",
-        "Statut",
-        "Validé par",
-        "Date de validation"
-    ])
-
-    for r in rows:
-        date_val = r[0].strftime("%Y-%m-%d") if r[0] else ""
-        amount = float(r[1]) if r[1] is not None else ""
-        amount_ht = float(r[2]) if r[2] is not None else ""
-        tva_amount = float(r[3]) if r[3] is not None else ""
-        label = r[4] or ""
-        chantier = r[5] or ""
-        payment_method = r[6] or ""
-        comment_text = r[7] or ""
-        user_email = r[8] or ""
-        receipt_path = r[9] or ""
-        status = r[10] or ""
-        validated_by = r[11] or ""
-        validated_at = r[12].strftime("%Y-%m-%d %H:%M:%S") if r[12] else ""
-
-        writer.writerow([
-            date_val,
-            amount,
-            amount_ht,
-            tva_amount,
-            label,
-            chantier,
-            payment_method,
-            comment_text,
-            user_email,
-            receipt_path,
-            status,
-            validated_by,
-            validated_at
-        ])
-
-    csv_content = output.getvalue()
     filename = f"notes-de-frais-ALL-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.csv"
-
-    return Response(
-        csv_content,
-        mimetype="text/csv; charset=utf-8",
-        headers={
-            "Content-Disposition": f"attachment; filename={filename}"
-        }
+    return csv_download(
+        iter_csv_chunks(ALL_EXPENSES_CSV_HEADER, iter_all_expenses_csv_rows()), filename
     )
 
 
 @app.route("/admin/export_pdf_all_now")
 @admin_required
 def admin_export_pdf_all_now():
-    """Export PDF de toutes les notes de frais (tous statuts, toutes dates)."""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT
-            date,
-            amount,
-            amount_ht,
-            tva_amount,
-            label,
-            chantier,
-            payment_method,
-            comment_text,
-            user_email,
-            receipt_path,
-            status
-        FROM expenses
-        ORDER BY date ASC, id ASC
-        """
-    )
-    rows = cur.fetchall()
-    conn.close()
-
-    formatted_rows = []
-    for r in rows:
-        formatted_rows.append({
-            "date": r[0].strftime("%Y-%m-%d") if r[0] else "",
-            "amount": float(r[1]) if r[1] is not None else None,
-            "amount_ht": float(r[2]) if r[2] is not None else None,
-            "tva_amount": float(r[3]) if r[3] is not None else None,
-            "label": r[4] or "",
-            "chantier": r[5] or "",
-            "payment_method": r[6],
-            "comment_text": r[7],
-            "user_email": r[8] or "",
-            "receipt_path": r[9],
-            "status": r[10] or "",
-        })
-
-    pdf_bytes = generate_pdf_report(formatted_rows)
+    """
+    Export PDF de toutes les notes de frais (tous statuts, toutes dates).
+    Synchrone : sur un gros historique, préférer l'export en arrière-plan (/admin/export_jobs).
+    """
+    pdf_bytes = generate_pdf_report(all_expenses_pdf_rows())
     filename = f"notes-de-frais-ALL-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.pdf"
 
     return Response(
@@ -1258,26 +3661,451 @@ def admin_export_pdf_all_now():
     )
 
 
+# -----------------------------------------------------------------------------#
+# EXPORTS EN ARRIÈRE-PLAN (JOBS) : PDF / GROS CSV
+# -----------------------------------------------------------------------------#
+# Fichiers produits, téléchargeables jusqu'à expiration
+EXPORT_DIR = os.environ.get("EXPORT_DIR", os.path.join(BASE_DIR, "exports"))
+EXPORT_JOB_WORKERS = int(os.environ.get("EXPORT_JOB_WORKERS", "1"))
+EXPORT_JOB_TTL_HOURS = int(os.environ.get("EXPORT_JOB_TTL_HOURS", "24"))
+# Un job "running" sans battement de cœur depuis ce délai (worker redémarré...) est considéré perdu
+EXPORT_JOB_STALE_SECONDS = 600
+# Battement de cœur d'un job "running" (y compris pendant doc.build, sans progression)
+EXPORT_JOB_HEARTBEAT_SECONDS = 60
+# Un job "queued" attend son tour derrière les autres (EXPORT_JOB_WORKERS=1) : délai compté
+# depuis created_at, bien plus long, au-delà duquel on le considère perdu
+EXPORT_JOB_QUEUED_STALE_HOURS = int(os.environ.get("EXPORT_JOB_QUEUED_STALE_HOURS", "6"))
+
+_export_executor = None
+_export_executor_pid = None
+_export_executor_lock = threading.Lock()
+
+
+def get_export_executor():
+    """Pool de threads des exports du process courant (hors des threads de requête)."""
+    global _export_executor, _export_executor_pid
+    pid = os.getpid()
+    if _export_executor is None or _export_executor_pid != pid:
+        with _export_executor_lock:
+            if _export_executor is None or _export_executor_pid != pid:
+                _export_executor = ThreadPoolExecutor(
+                    max_workers=EXPORT_JOB_WORKERS, thread_name_prefix="export-job"
+                )
+                _export_executor_pid = pid
+    return _export_executor
+
+
+class ExportJobProgress:
+    """Callback de progression d'un job : compteurs écrits en base au plus une fois par seconde."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.counters = {}
+        self._last_flush = 0.0
+
+    def __call__(self, **counters):
+        self.counters.update(counters)
+        if time.monotonic() - self._last_flush >= 1:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        c = self.counters
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                UPDATE export_jobs
+                SET rows_done = %s, rows_total = %s,
+                    receipts_done = %s, receipts_total = %s,
+                    updated_at = NOW()
+                WHERE id = %s
+                """,
+                (c.get("rows_done"), c.get("rows_total"),
+                 c.get("receipts_done"), c.get("receipts_total"), self.job_id)
+            )
+            conn.commit()
+
+    def touch(self):
+        """Rafraîchit seulement updated_at (le job est vivant)."""
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE export_jobs SET updated_at = NOW() WHERE id = %s AND status = 'running'",
+                (self.job_id,)
+            )
+            conn.commit()
+
+    @contextmanager
+    def heartbeat(self):
+        """
+        Thread qui appelle touch() toutes les EXPORT_JOB_HEARTBEAT_SECONDS tant que le
+        bloc s'exécute : les phases sans progression (doc.build) ne font pas passer le job
+        pour perdu.
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(EXPORT_JOB_HEARTBEAT_SECONDS):
+                try:
+                    self.touch()
+                except Exception as e:
+                    print(f"[EXPORT] Battement du job {self.job_id} en erreur : {e!r}", flush=True)
+
+        thread = threading.Thread(target=beat, name=f"export-heartbeat-{self.job_id}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+
+def _export_job_filename(kind, params):
+    if params.get("year"):
+        stem = f"notes-de-frais-{params['year']}-{params['month']:02d}"
+    else:
+        stem = f"notes-de-frais-ALL-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}"
+    return f"{stem}.{kind}"
+
+
+def build_export_file(kind, params, file_path, progress):
+    """
+    Produit le fichier d'un export.
+    kind   : "pdf" ou "csv"
+    params : {} pour tout exporter, {"year": ..., "month": ...} pour un mois
+             (CSV du mois = notes validées, PDF du mois = tous statuts, comme les routes directes)
+    """
+    if params.get("year") and is_closed_month(params["year"], params["month"]):
+        # mois clos : récap matérialisé (construit ici s'il n'est pas à jour), copié
+        # pour que l'expiration du job n'efface pas le snapshot
+        snapshot = get_month_report(
+            params["year"], params["month"], kind, kind == "csv", progress=progress
+        )
+        shutil.copyfile(snapshot["file_path"], file_path)
+        progress(rows_done=snapshot["row_count"], rows_total=snapshot["row_count"])
+        return
+
+    if kind == "pdf":
+        if params.get("year"):
+            rows = generate_monthly_report(params["year"], params["month"], approved_only=False)
+        else:
+            rows = all_expenses_pdf_rows()
+        progress(rows_done=0, rows_total=len(rows))
+        write_pdf_report(rows, file_path, progress)
+        progress(rows_done=len(rows))
+        return
+
+    if params.get("year"):
+        rows = iter_monthly_report(params["year"], params["month"], approved_only=True)
+        chunks = iter_report_csv(_count_rows(rows, progress))
+    else:
+        chunks = iter_csv_chunks(
+            ALL_EXPENSES_CSV_HEADER, _count_rows(iter_all_expenses_csv_rows(), progress)
+        )
+
+    with open(file_path, "w", encoding="utf-8", newline="") as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def _count_rows(rows, progress):
+    for n, row in enumerate(rows, start=1):
+        progress(rows_done=n)
+        yield row
+
+
+def run_export_job(job_id, kind, params):
+    """Exécuté dans le pool d'exports : construit le fichier puis marque le job terminé."""
+    progress = ExportJobProgress(job_id)
+    filename = _export_job_filename(kind, params)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    file_path = os.path.join(EXPORT_DIR, f"{job_id}.{kind}")
+
+    try:
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE export_jobs SET status = 'running', updated_at = NOW() WHERE id = %s",
+                (job_id,)
+            )
+            conn.commit()
+
+        with progress.heartbeat():
+            build_export_file(kind, params, file_path, progress)
+        progress.flush()
+    except Exception as e:
+        print(f"[EXPORT] Job {job_id} en erreur : {e!r}", flush=True)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                UPDATE export_jobs
+                SET status = 'failed', error = %s, finished_at = NOW(), updated_at = NOW()
+                WHERE id = %s
+                """,
+                (repr(e), job_id)
+            )
+            conn.commit()
+        return
+
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE export_jobs
+            SET status = 'done', file_path = %s, filename = %s,
+                finished_at = NOW(), updated_at = NOW(),
+                expires_at = NOW() + make_interval(hours => %s)
+            WHERE id = %s
+            """,
+            (file_path, filename, EXPORT_JOB_TTL_HOURS, job_id)
+        )
+        conn.commit()
+    print(f"[EXPORT] Job {job_id} terminé : {filename}", flush=True)
+
+
+def purge_expired_exports():
+    """Supprime les fichiers et les jobs expirés."""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "DELETE FROM export_jobs WHERE expires_at < NOW() RETURNING file_path"
+        )
+        paths = [r[0] for r in cur.fetchall() if r[0]]
+        conn.commit()
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def export_job_to_dict(row):
+    (job_id, kind, status, rows_done, rows_total, receipts_done, receipts_total,
+     filename, error, created_at, finished_at, expires_at, stale) = row
+    if status in ("queued", "running") and stale:
+        # stale : running sans battement depuis EXPORT_JOB_STALE_SECONDS,
+        # ou queued depuis plus de EXPORT_JOB_QUEUED_STALE_HOURS
+        status = "failed"
+        error = error or "Export interrompu (worker redémarré ?)"
+    data = {
+        "id": job_id,
+        "kind": kind,
+        "status": status,
+        "rows_done": rows_done,
+        "rows_total": rows_total,
+        "receipts_done": receipts_done,
+        "receipts_total": receipts_total,
+        "filename": filename,
+        "error": error,
+        "created_at": created_at.isoformat(),
+        "finished_at": finished_at.isoformat() if finished_at else None,
+        "expires_at": expires_at.isoformat() if expires_at else None,
+        "status_url": url_for("admin_export_job_status", job_id=job_id),
+        "download_url": None,
+    }
+    if status == "done":
+        data["download_url"] = url_for("admin_export_job_download", job_id=job_id)
+    return data
+
+
+def get_export_job(job_id):
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, kind, status, rows_done, rows_total, receipts_done, receipts_total,
+                   filename, error, created_at, finished_at, expires_at,
+                   CASE status
+                       WHEN 'running' THEN updated_at < NOW() - make_interval(secs => %s)
+                       WHEN 'queued' THEN created_at < NOW() - make_interval(hours => %s)
+                       ELSE FALSE
+                   END
+            FROM export_jobs
+            WHERE id = %s AND (expires_at IS NULL OR expires_at > NOW())
+            """,
+            (EXPORT_JOB_STALE_SECONDS, EXPORT_JOB_QUEUED_STALE_HOURS, job_id)
+        )
+        return cur.fetchone()
+
+
+def enqueue_export_job(kind, params, created_by):
+    """Enregistre un job d'export et le confie au pool d'exports. Retourne son id."""
+    purge_expired_exports()
+
+    job_id = uuid.uuid4().hex
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO export_jobs (id, kind, params, created_by)
+            VALUES (%s, %s, %s, %s)
+            """,
+            (job_id, kind, json.dumps(params), created_by)
+        )
+        conn.commit()
+
+    get_export_executor().submit(run_export_job, job_id, kind, params)
+    return job_id
+
+
+@app.route("/admin/export_jobs", methods=["POST"])
+@admin_required
+def admin_create_export_job():
+    """
+    Lance un export en arrière-plan et répond tout de suite avec l'id du job.
+    Formulaire :
+      - kind  : pdf | csv
+      - year, month (optionnels) : un mois ; sinon toutes les notes
+    """
+    kind = request.form.get("kind", "")
+    if kind not in ("pdf", "csv"):
+        return jsonify({"error": "Paramètre kind invalide"}), 400
+
+    params = {}
+    if request.form.get("year") or request.form.get("month"):
+        try:
+            params = {
+                "year": int(request.form.get("year")),
+                "month": int(request.form.get("month")),
+            }
+        except (TypeError, ValueError):
+            return jsonify({"error": "Paramètres year et month invalides"}), 400
+        if params["month"] < 1 or params["month"] > 12:
+            return jsonify({"error": "Paramètre month invalide"}), 400
+
+    job_id = enqueue_export_job(kind, params, session["user_email"])
+    return jsonify(export_job_to_dict(get_export_job(job_id))), 202
+
+
+@app.route("/admin/export_jobs/<job_id>")
+@admin_required
+def admin_export_job_status(job_id):
+    """Avancement d'un export : statut, lignes traitées, justificatifs récupérés."""
+    row = get_export_job(job_id)
+    if not row:
+        return jsonify({"error": "Export introuvable ou expiré"}), 404
+    return jsonify(export_job_to_dict(row))
+
+
+@app.route("/admin/export_jobs/<job_id>/download")
+@admin_required
+def admin_export_job_download(job_id):
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT kind, file_path, filename
+            FROM export_jobs
+            WHERE id = %s AND status = 'done' AND expires_at > NOW()
+            """,
+            (job_id,)
+        )
+        row = cur.fetchone()
+    if not row or not os.path.exists(row[1]):
+        return "Export introuvable ou expiré", 404
+
+    kind, file_path, filename = row
+    return send_file(
+        file_path,
+        mimetype="application/pdf" if kind == "pdf" else "text/csv; charset=utf-8",
+        as_attachment=True,
+        download_name=filename,
+    )
+
+
+# -----------------------------------------------------------------------------#
+# ROUTES ADMIN : MÉTRIQUES (POOL DE CONNEXIONS, TRANSPORT SMTP)
+# -----------------------------------------------------------------------------#
+@app.route("/admin/db_pool_stats")
+@admin_required
+def admin_db_pool_stats():
+    """
+    Compteurs du pool du worker qui répond (checkouts, attentes, taille...).
+    Chaque worker gunicorn a son propre pool : le champ "pid" permet de les distinguer.
+    """
+    return jsonify(get_db_pool().stats())
+
+
+@app.route("/admin/mail_stats")
+@admin_required
+def admin_mail_stats():
+    """Compteurs du transport SMTP du worker qui répond (envois, échecs, latence)."""
+    if not SMTP_HOST:
+        return jsonify({"error": "SMTP non configuré (SMTP_HOST)"}), 503
+    return jsonify(get_mail_transport().stats())
+
+
+@app.route("/admin/ocr_stats")
+@admin_required
+def admin_ocr_stats():
+    """Latence et échecs par moteur OCR, pour le worker qui répond."""
+    return jsonify({
+        "pid": os.getpid(),
+        "backends": {b.name: b.stats() for b in get_ocr_backends()},
+    })
+
+
 # -----------------------------------------------------------------------------#
 # ROUTES ADMIN : VALIDATION / REFUS DES NOTES
 # -----------------------------------------------------------------------------#
+# action -> statut posé (None = suppression)
+EXPENSE_ACTIONS = {"approve": "approved", "reject": "rejected", "delete": None}
+# Nombre max de notes par appel groupé
+EXPENSES_BULK_MAX = 500
+
+
+def apply_expense_action(cur, action, expense_ids, admin_email):
+    """
+    Valide / refuse / supprime des notes en une requête (dans la transaction de l'appelant).
+    Retourne (ids réellement modifiés, justificatifs à effacer après le commit) : une note
+    déjà dans ce statut, ou introuvable, est ignorée.
+    """
+    released = []
+    if action == "delete":
+        cur.execute(
+            "DELETE FROM expenses WHERE id = ANY(%s) RETURNING id, date, receipt_path",
+            (list(expense_ids),)
+        )
+        rows = cur.fetchall()
+        for _, _, receipt_path in rows:
+            # fichier local effacé seulement si c'était sa dernière note
+            released.append(release_receipt(cur, receipt_path))
+        cur.execute(
+            "DELETE FROM expense_tombstones WHERE deleted_at < NOW() - make_interval(days => %s)",
+            (EXPENSE_TOMBSTONE_DAYS,)
+        )
+    else:
+        cur.execute(
+            """
+            UPDATE expenses
+            SET status = %s,
+                validated_by = %s,
+                validated_at = NOW()
+            WHERE id = ANY(%s) AND status IS DISTINCT FROM %s
+            RETURNING id, date
+            """,
+            (EXPENSE_ACTIONS[action], admin_email, list(expense_ids), EXPENSE_ACTIONS[action])
+        )
+        rows = cur.fetchall()
+    invalidate_month_reports(cur, [r[1] for r in rows])
+    return [r[0] for r in rows], released
+
+
+def _run_expense_action(action, expense_ids):
+    with get_db() as conn:
+        cur = conn.cursor()
+        done, released = apply_expense_action(cur, action, expense_ids, session["user_email"])
+        conn.commit()
+    remove_released_receipts(released)
+    return done
+
+
 @app.route("/admin/expenses/<int:expense_id>/approve", methods=["POST"])
 @admin_required
 def approve_expense(expense_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE expenses
-        SET status = 'approved',
-            validated_by = %s,
-            validated_at = NOW()
-        WHERE id = %s
-        """,
-        (session["user_email"], expense_id)
-    )
-    conn.commit()
-    conn.close()
+    _run_expense_action("approve", [expense_id])
     flash("Note de frais validée.", "success")
     return redirect(url_for("expenses"))
 
@@ -1285,20 +4113,7 @@ def approve_expense(expense_id):
 @app.route("/admin/expenses/<int:expense_id>/reject", methods=["POST"])
 @admin_required
 def reject_expense(expense_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE expenses
-        SET status = 'rejected',
-            validated_by = %s,
-            validated_at = NOW()
-        WHERE id = %s
-        """,
-        (session["user_email"], expense_id)
-    )
-    conn.commit()
-    conn.close()
+    _run_expense_action("reject", [expense_id])
     flash("Note de frais refusée.", "warning")
     return redirect(url_for("expenses"))
 
@@ -1306,32 +4121,204 @@ def reject_expense(expense_id):
 @app.route("/admin/expenses/<int:expense_id>/delete", methods=["POST"])
 @admin_required
 def delete_expense(expense_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT receipt_path FROM expenses WHERE id = %s", (expense_id,))
-    row = cur.fetchone()
-    if row and row[0]:
-        path = row[0]
-        if not path.startswith("http"):
-            local_path = os.path.join(app.config["UPLOAD_FOLDER"], path)
-            if os.path.exists(local_path):
-                os.remove(local_path)
-
-    cur.execute("DELETE FROM expenses WHERE id = %s", (expense_id,))
-    conn.commit()
-    conn.close()
+    _run_expense_action("delete", [expense_id])
     flash("Note de frais supprimée.", "success")
     return redirect(url_for("expenses"))
 
 
+@app.route("/api/admin/expenses/bulk", methods=["POST"])
+@admin_required
+def bulk_expense_action():
+    """
+    Validation / refus / suppression de plusieurs notes en un aller-retour (sélection
+    multiple de main.js), dans une seule transaction.
+    Corps JSON : {"action": "approve" | "reject" | "delete", "ids": [12, 13, ...]}
+    Réponse : {"action": ..., "ids": [notes modifiées], "skipped": [déjà dans ce statut ou introuvables]}
+    """
+    payload = request.get_json(silent=True) or {}
+    action = payload.get("action")
+    if action not in EXPENSE_ACTIONS:
+        return jsonify({"error": "Paramètre action invalide"}), 400
+    ids = payload.get("ids")
+    if (not isinstance(ids, list) or not ids
+            or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids)):
+        return jsonify({"error": "Paramètre ids invalide (liste d'identifiants)"}), 400
+    if len(ids) > EXPENSES_BULK_MAX:
+        return jsonify({"error": f"{EXPENSES_BULK_MAX} notes maximum par appel"}), 400
+
+    ids = sorted(set(ids))
+    done = _run_expense_action(action, ids)
+    done_set = set(done)
+    return jsonify({
+        "action": action,
+        "ids": sorted(done),
+        "skipped": [i for i in ids if i not in done_set],
+    })
+
+
+# -----------------------------------------------------------------------------#
+# OUTBOX : NOTIFICATIONS ENVOYÉES EN ARRIÈRE-PLAN
+# -----------------------------------------------------------------------------#
+# thread  : un thread dispatcher par worker gunicorn (démarré à la 1ère requête)
+# off     : pas de thread, lancer à part "python app.py mail_dispatcher"
+MAIL_DISPATCHER = os.environ.get("MAIL_DISPATCHER", "thread")
+# Les nouvelles notes arrivées pendant cette fenêtre (secondes) partent dans un seul mail
+NOTIFY_DIGEST_WINDOW = int(os.environ.get("NOTIFY_DIGEST_WINDOW", "300"))
+MAIL_DISPATCH_INTERVAL = float(os.environ.get("MAIL_DISPATCH_INTERVAL", "15"))
+MAIL_MAX_ATTEMPTS = int(os.environ.get("MAIL_MAX_ATTEMPTS", "5"))
+# Nouvel essai après 1 min, 2 min, 4 min... (plafonné à 1 h)
+MAIL_RETRY_BASE = 60
+MAIL_RETRY_MAX = 3600
+# Lignes envoyées / abandonnées gardées ce nombre de jours (historique), purgées toutes les heures
+MAIL_OUTBOX_RETENTION_DAYS = int(os.environ.get("MAIL_OUTBOX_RETENTION_DAYS", "30"))
+MAIL_OUTBOX_PURGE_INTERVAL = 3600
+
+
+def enqueue_new_expense_notification(cur, expense_id):
+    """
+    À appeler dans la transaction qui insère la note : pas de note sans notification.
+    Sans SMTP_HOST (dev, local), aucun dispatcher ne tourne : rien n'est mis en file.
+    """
+    if not SMTP_HOST:
+        return
+    cur.execute(
+        "INSERT INTO mail_outbox (kind, expense_id) VALUES ('new_expense', %s)",
+        (expense_id,)
+    )
+
+
+def dispatch_mail_outbox():
+    """
+    Un passage du dispatcher : regroupe les notifications en attente dans un mail.
+    On attend que la plus ancienne ait NOTIFY_DIGEST_WINDOW secondes.
+    Les lignes sont verrouillées (SKIP LOCKED) : plusieurs workers peuvent
+    tourner sans envoyer deux fois la même notification.
+    Retourne le nombre de notifications envoyées.
+    """
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT o.id, o.attempts, NOW() - o.created_at,
+                   e.date, e.amount, e.label, e.chantier, e.user_email
+            FROM mail_outbox o
+            LEFT JOIN expenses e ON e.id = o.expense_id
+            WHERE o.kind = 'new_expense'
+              AND o.status = 'pending'
+              AND o.next_attempt_at <= NOW()
+            ORDER BY o.id
+            FOR UPDATE OF o SKIP LOCKED
+            """
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return 0
+        if max(r[2] for r in rows).total_seconds() < NOTIFY_DIGEST_WINDOW:
+            return 0
+
+        ids = [r[0] for r in rows]
+        # une note supprimée entre-temps n'a plus rien à notifier
+        items = [r[3:] for r in rows if r[3] is not None]
+
+        try:
+            if items:
+                send_new_expenses_digest(items)
+        except Exception as e:
+            print(f"[MAIL] ERREUR SMTP notification : {e!r}", flush=True)
+            delay = min(MAIL_RETRY_BASE * 2 ** max(r[1] for r in rows), MAIL_RETRY_MAX)
+            cur.execute(
+                """
+                UPDATE mail_outbox
+                SET attempts = attempts + 1,
+                    last_error = %s,
+                    status = CASE WHEN attempts + 1 >= %s THEN 'failed' ELSE 'pending' END,
+                    next_attempt_at = NOW() + make_interval(secs => %s)
+                WHERE id = ANY(%s)
+                """,
+                (repr(e), MAIL_MAX_ATTEMPTS, delay, ids)
+            )
+            conn.commit()
+            return 0
+
+        cur.execute(
+            "UPDATE mail_outbox SET status = 'sent', sent_at = NOW() WHERE id = ANY(%s)",
+            (ids,)
+        )
+        conn.commit()
+        return len(items)
+
+
+def purge_mail_outbox():
+    """Supprime les notifications envoyées ou abandonnées depuis plus de MAIL_OUTBOX_RETENTION_DAYS jours."""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            DELETE FROM mail_outbox
+            WHERE status IN ('sent', 'failed')
+              AND created_at < NOW() - make_interval(days => %s)
+            """,
+            (MAIL_OUTBOX_RETENTION_DAYS,)
+        )
+        conn.commit()
+
+
+def mail_dispatcher_loop():
+    last_purge = 0.0
+    while True:
+        try:
+            dispatch_mail_outbox()
+            if time.monotonic() - last_purge >= MAIL_OUTBOX_PURGE_INTERVAL:
+                purge_mail_outbox()
+                last_purge = time.monotonic()
+        except Exception as e:
+            print(f"[MAIL] Dispatcher : {e!r}", flush=True)
+        time.sleep(MAIL_DISPATCH_INTERVAL)
+
+
+_mail_dispatcher_pid = None
+_mail_dispatcher_lock = threading.Lock()
+
+
+def start_mail_dispatcher():
+    """Démarre le thread dispatcher une fois par process."""
+    global _mail_dispatcher_pid
+    if _mail_dispatcher_pid == os.getpid():
+        return
+    with _mail_dispatcher_lock:
+        if _mail_dispatcher_pid == os.getpid():
+            return
+        threading.Thread(
+            target=mail_dispatcher_loop, name="mail-dispatcher", daemon=True
+        ).start()
+        _mail_dispatcher_pid = os.getpid()
+
+
+@app.before_request
+def start_background_workers():
+    if MAIL_DISPATCHER == "thread" and SMTP_HOST:
+        start_mail_dispatcher()
+
+
 # -----------------------------------------------------------------------------#
 # MAIN
 # -----------------------------------------------------------------------------#
 if __name__ == "__main__":
     import sys
-    init_db()
-    sync_users_from_csv()
-    if len(sys.argv) > 1 and sys.argv[1] == "send_report_cron":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "migrate":
+        run_migrations()
+        sync_users_from_csv()
+    elif command == "send_report_cron":
         cli_send_report_cron()
+    elif command == "mail_dispatcher":
+        mail_dispatcher_loop()
+    elif command == "smtp_check":
+        cli_smtp_check()
+    elif command == "sweep_receipts":
+        sweep_orphan_receipts()
     else:
+        # serveur de dev : on migre au lancement pour simplifier
+        run_migrations()
+        sync_users_from_csv()
         app.run(debug=True, host="0.0.0.0", port=5000)
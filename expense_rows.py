@@ -0,0 +1,274 @@
+"""
+Lignes de la table expenses : colonnes déclarées une seule fois, enregistrement compact
+et sérialiseurs (JSON, CSV, PDF).
+
+Une ligne lue en base devient un Expense (namedtuple, sans __dict__) : aucune conversion à
+la lecture, les valeurs restent celles de psycopg2 (Decimal pour les montants, date /
+datetime). Chaque sortie convertit seulement ce dont elle a besoin :
+  - expense_json : dict pour /api/expenses (montants en nombre JSON)
+  - expense_report_csv_row / expense_full_csv_row : lignes des CSV (montants exacts, "12.30")
+  - expense_pdf_cells : textes du tableau PDF
+Le template lit directement les attributs (e.amount, e.date...).
+
+Module autonome (pas de base de données) : app.py l'utilise pour les pages et les exports,
+et `python expense_rows.py [lignes]` compare le débit (lignes/s) et la mémoire par ligne
+à l'ancienne conversion en dicts.
+"""
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+# Ordre des colonnes lues en base = ordre des champs d'Expense
+EXPENSE_FIELDS = (
+    "id", "user_email", "amount", "amount_ht", "tva_amount",
+    "date", "label", "chantier", "payment_method", "comment_text",
+    "receipt_path", "created_at", "status", "validated_by", "validated_at",
+)
+EXPENSE_COLUMNS = ", ".join(EXPENSE_FIELDS)
+
+
+class Expense(namedtuple("Expense", EXPENSE_FIELDS)):
+    """Une note de frais telle que lue en base."""
+    __slots__ = ()
+
+
+# Ligne de curseur -> Expense, sans passer par un dict
+expense_from_row = Expense._make
+
+
+def expense_json(e):
+    """
+    Dict pour le JSON de /api/expenses. Montants en nombres : un NUMERIC(10,2) tient en
+    moins de 15 chiffres, float() le restitue à l'identique ("12.3" pour 12.30).
+    """
+    return {
+        "id": e.id,
+        "user_email": e.user_email,
+        "amount": float(e.amount),
+        "amount_ht": float(e.amount_ht) if e.amount_ht is not None else None,
+        "tva_amount": float(e.tva_amount) if e.tva_amount is not None else None,
+        "date": e.date.isoformat(),
+        "label": e.label,
+        "chantier": e.chantier,
+        "payment_method": e.payment_method,
+        "comment_text": e.comment_text,
+        "receipt_path": e.receipt_path,
+        "created_at": e.created_at.isoformat(),
+        "status": e.status,
+        "validated_by": e.validated_by,
+        "validated_at": e.validated_at.isoformat() if e.validated_at else None,
+    }
+
+
+# CSV récap mensuel (pièce jointe du mail, export du mois)
+REPORT_CSV_HEADER = [
+    "Date", "Montant TTC", "Montant HT", "TVA",
+    "Libellé", "Chantier", "Utilisateur",
+    "Moyen de paiement", "Commentaire",
+    "Statut", "Justificatif"
+]
+
+
+def expense_report_csv_row(e):
+    # Decimal écrit tel quel par le module csv : "12.30", pas d'arrondi binaire
+    return (
+        e.date,
+        e.amount,
+        "" if e.amount_ht is None else e.amount_ht,
+        "" if e.tva_amount is None else e.tva_amount,
+        e.label,
+        e.chantier,
+        e.user_email,
+        e.payment_method or "",
+        e.comment_text or "",
+        e.status or "",
+        e.receipt_path or "",
+    )
+
+
+# CSV "tout exporter"
+ALL_EXPENSES_CSV_HEADER = [
+    "Date",
+    "Montant TTC",
+    "Montant HT",
+    "TVA",
+    "Libellé",
+    "Chantier",
+    "Moyen de paiement",
+    "Commentaire",
+    "Utilisateur",
+    "Justificatif",
+    "Statut",
+    "Validé par",
+    "Date de validation"
+]
+
+
+def expense_full_csv_row(e):
+    return (
+        e.date,
+        e.amount,
+        "" if e.amount_ht is None else e.amount_ht,
+        "" if e.tva_amount is None else e.tva_amount,
+        e.label or "",
+        e.chantier or "",
+        e.payment_method or "",
+        e.comment_text or "",
+        e.user_email or "",
+        e.receipt_path or "",
+        e.status or "",
+        e.validated_by or "",
+        e.validated_at.strftime("%Y-%m-%d %H:%M:%S") if e.validated_at else "",
+    )
+
+
+def format_amount(value):
+    """Montant affiché dans le PDF ("12.30 €"), vide si absent."""
+    return "" if value is None else f"{value:.2f} €"
+
+
+def expense_pdf_cells(e):
+    """Textes d'une ligne du tableau PDF (Date, TTC, HT, TVA, Libellé ... Statut)."""
+    return (
+        e.date.isoformat(),
+        format_amount(e.amount),
+        format_amount(e.amount_ht),
+        format_amount(e.tva_amount),
+        e.label or "",
+        e.chantier or "",
+        e.payment_method or "",
+        e.comment_text or "",
+        e.user_email or "",
+        e.status or "",
+    )
+
+
+# -----------------------------------------------------------------------------#
+# BENCHMARK : python expense_rows.py [lignes]
+# -----------------------------------------------------------------------------#
+def sample_rows(count):
+    """Lignes comme les renvoie psycopg2 (Decimal, date, datetime)."""
+    start = datetime(2025, 1, 1, 8, 30)
+    statuses = ("pending", "approved", "rejected")
+    rows = []
+    for i in range(count):
+        created = start + timedelta(minutes=17 * i)
+        ht = Decimal(1000 + (i * 37) % 90000).scaleb(-2)
+        tva = (ht * Decimal("0.20")).quantize(Decimal("0.01"))
+        status = statuses[i % 3]
+        rows.append((
+            i + 1, f"user{i % 40}@batirenov.info", ht + tva, ht, tva,
+            created.date(), f"Achat fournitures {i}", f"Chantier {i % 25}",
+            "CB" if i % 2 else None, None,
+            f"ab/cd/{i:064x}.jpg" if i % 4 else None,
+            created, status,
+            "admin@batirenov.info" if status != "pending" else None,
+            created + timedelta(days=3) if status != "pending" else None,
+        ))
+    return rows
+
+
+def legacy_row_to_dict(r):
+    """Conversion d'avant (référence) : un dict de 15 clés par ligne, montants en float."""
+    return {
+        "id": r[0],
+        "user_email": r[1],
+        "amount": float(r[2]),
+        "amount_ht": float(r[3]) if r[3] is not None else None,
+        "tva_amount": float(r[4]) if r[4] is not None else None,
+        "date": r[5].strftime("%Y-%m-%d"),
+        "label": r[6],
+        "chantier": r[7],
+        "payment_method": r[8],
+        "comment_text": r[9],
+        "receipt_path": r[10],
+        "created_at": r[11].isoformat(),
+        "status": r[12],
+        "validated_by": r[13],
+        "validated_at": r[14].isoformat() if r[14] else None,
+    }
+
+
+def legacy_full_csv_row(r):
+    """Ancienne ligne du CSV "tout exporter" (colonnes relues à la main, montants en float)."""
+    return [
+        r[5].strftime("%Y-%m-%d") if r[5] else "",
+        float(r[2]) if r[2] is not None else "",
+        float(r[3]) if r[3] is not None else "",
+        float(r[4]) if r[4] is not None else "",
+        r[6] or "", r[7] or "", r[8] or "", r[9] or "",
+        r[1] or "", r[10] or "", r[12] or "", r[13] or "",
+        r[14].strftime("%Y-%m-%d %H:%M:%S") if r[14] else "",
+    ]
+
+
+def legacy_pdf_dict(r):
+    """Ancien dict du PDF, puis mise en forme des montants comme write_pdf_report."""
+    d = {
+        "date": r[5].strftime("%Y-%m-%d") if r[5] else "",
+        "amount": float(r[2]) if r[2] is not None else None,
+        "amount_ht": float(r[3]) if r[3] is not None else None,
+        "tva_amount": float(r[4]) if r[4] is not None else None,
+        "label": r[6] or "", "chantier": r[7] or "",
+        "payment_method": r[8], "comment_text": r[9],
+        "user_email": r[1] or "", "receipt_path": r[10], "status": r[12] or "",
+    }
+    return [
+        d["date"],
+        f"{d['amount']:.2f} €" if d["amount"] is not None else "",
+        f"{d['amount_ht']:.2f} €" if d["amount_ht"] is not None else "",
+        f"{d['tva_amount']:.2f} €" if d["tva_amount"] is not None else "",
+        d["label"], d["chantier"], d["payment_method"] or "", d["comment_text"] or "",
+        d["user_email"], d["status"],
+    ]
+
+
+def _rows_per_second(convert, rows, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for r in rows:
+            convert(r)
+    return len(rows) * repeat / (time.perf_counter() - start)
+
+
+def _bytes_per_row(convert, rows):
+    """Mémoire gardée par ligne quand la liste convertie est conservée (page, PDF)."""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [convert(r) for r in rows]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del kept
+    return size / len(rows)
+
+
+def run_benchmark(count=20000, repeat=5):
+    rows = sample_rows(count)
+    cases = (
+        ("lecture (page, PDF)", legacy_row_to_dict, expense_from_row),
+        ("JSON /api/expenses", legacy_row_to_dict, lambda r: expense_json(Expense._make(r))),
+        ("CSV tout exporter", legacy_full_csv_row, lambda r: expense_full_csv_row(Expense._make(r))),
+        ("PDF tableau", legacy_pdf_dict, lambda r: expense_pdf_cells(Expense._make(r))),
+    )
+    print(f"{count} lignes x {repeat}")
+    for name, legacy, current in cases:
+        old_rate = _rows_per_second(legacy, rows, repeat)
+        new_rate = _rows_per_second(current, rows, repeat)
+        print(f"{name:20} : avant {old_rate:>9.0f} lignes/s, après {new_rate:>9.0f} lignes/s "
+              f"(x{new_rate / old_rate:.2f})")
+    old_bytes = _bytes_per_row(legacy_row_to_dict, rows)
+    new_bytes = _bytes_per_row(expense_from_row, rows)
+    print(f"Mémoire par ligne gardée : avant {old_bytes:.0f} o, après {new_bytes:.0f} o")
+
+    # précision : somme des montants en float (avant) / en Decimal (après)
+    float_total = sum(float(r[2]) for r in rows)
+    exact_total = sum(r[2] for r in rows)
+    print(f"Total TTC : float {float_total!r}, Decimal {exact_total}")
+
+
+if __name__ == "__main__":
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
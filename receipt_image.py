@@ -0,0 +1,303 @@
+"""
+Préparation des photos de tickets avant OCR : image plus petite à envoyer,
+sans perdre en lisibilité.
+
+Étapes de prepare_receipt_image() :
+  - repérage du ticket sur une vignette (décodage JPEG fortement réduit)
+  - décodage JPEG en mode draft (réduction par le décodeur) à l'échelle qui garde le ticket
+    recadré à max_width, pas la photo entière
+  - rotation selon l'EXIF (photos de téléphone prises "de travers")
+  - niveaux de gris
+  - recadrage sur le ticket, redressement des petites inclinaisons
+  - qualité JPEG ajustée pour tenir dans un budget d'octets
+
+legacy_prepare() est l'ancien traitement (photo entière réduite, couleur), toujours celui
+par défaut d'app.py (OCR_IMAGE_PIPELINE=legacy) tant que le taux de lecture OCR du nouveau
+n'a pas été mesuré sur de vraies photos.
+
+Module autonome (Pillow, et pytesseract pour tesseract_text) : app.py appelle ses fonctions
+dans des pools de process démarrés par forkserver, qui importent ce module et pas app.py
+(ni Flask ni base de données). `python receipt_image.py DOSSIER [--ocr]` compare ce
+traitement à l'ancien
+(taille envoyée, temps CPU, et taux de lecture OCR si pytesseract et tesseract sont installés).
+"""
+import hashlib
+import io
+import os
+import sys
+import time
+
+from PIL import Image, ImageChops, ImageOps, ImageStat
+
+MAX_WIDTH = 1200
+# Taille max visée pour l'image envoyée à l'OCR (octets) : pas plus que legacy_prepare
+# (photo entière à 1200 px, couleur, JPEG q60 : ~36 Ko sur des photos 4000x3000)
+BYTE_BUDGET = 36 * 1024
+MIN_QUALITY = 35
+MAX_QUALITY = 70
+# Écart de gris avec le fond à partir duquel un pixel fait partie du ticket
+CROP_THRESHOLD = 40
+# Inclinaison max corrigée (degrés) : au-delà, c'est l'EXIF ou l'utilisateur qui se trompe
+DESKEW_MAX_ANGLE = 6
+# Taille de l'image de travail pour détecter bord et inclinaison
+ANALYSIS_SIZE = 600
+# Empreinte perceptuelle : grille PHASH_GRID x PHASH_GRID (256 bits).
+# Une grille 8x8 classique ne distingue pas assez des tickets qui se ressemblent tous
+# (longue bande blanche et lignes de texte).
+PHASH_GRID = 16
+
+EXIF_ORIENTATION = 0x0112
+
+
+def open_downscaled(data, max_width=MAX_WIDTH):
+    """
+    Ouvre l'image ; pour un JPEG, le décodeur réduit directement (1/2, 1/4, 1/8) et
+    sort du gris, au plus près de max_width une fois l'image remise à l'endroit.
+    """
+    img = Image.open(io.BytesIO(data))
+    if img.format == "JPEG":
+        width, height = img.size
+        if img.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            # image tournée d'un quart de tour : la largeur finale est la hauteur stockée
+            requested = (int(max_width * width / height), max_width)
+        else:
+            requested = (max_width, int(max_width * height / width))
+        img.draft("L", requested)
+    return img
+
+
+def _background_level(img):
+    """Niveau de gris du fond : médiane des quatre bords."""
+    width, height = img.size
+    strips = [
+        img.crop((0, 0, width, 2)),
+        img.crop((0, height - 2, width, height)),
+        img.crop((0, 0, 2, height)),
+        img.crop((width - 2, 0, width, height)),
+    ]
+    levels = sorted(ImageStat.Stat(strip).median[0] for strip in strips)
+    return (levels[1] + levels[2]) // 2
+
+
+def crop_box(img, threshold=CROP_THRESHOLD, margin=0.02):
+    """
+    Zone de ce qui se détache du fond (le ticket posé sur une table, ou le texte d'un scan
+    sur fond blanc), en fractions de l'image : (gauche, haut, droite, bas).
+    None si rien de net ne ressort.
+    """
+    small = img.copy()
+    small.thumbnail((ANALYSIS_SIZE, ANALYSIS_SIZE))
+    background = Image.new("L", small.size, _background_level(small))
+    mask = ImageChops.difference(small, background).point(lambda p: 255 if p > threshold else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return None
+
+    left = max(0.0, bbox[0] / small.width - margin)
+    top = max(0.0, bbox[1] / small.height - margin)
+    right = min(1.0, bbox[2] / small.width + margin)
+    bottom = min(1.0, bbox[3] / small.height + margin)
+    # zone trop petite : probablement une tache, pas le ticket
+    if (right - left) * (bottom - top) < 0.1:
+        return None
+    return left, top, right, bottom
+
+
+def apply_crop(img, box):
+    if box is None:
+        return img
+    left, top, right, bottom = box
+    return img.crop((int(left * img.width), int(top * img.height),
+                     int(right * img.width), int(bottom * img.height)))
+
+
+def auto_crop(img, threshold=CROP_THRESHOLD, margin=0.02):
+    """Recadre sur le ticket ; image inchangée si rien de net ne ressort."""
+    return apply_crop(img, crop_box(img, threshold, margin))
+
+
+def _row_profile_score(img, angle):
+    """Netteté du profil horizontal après rotation : max quand les lignes sont droites."""
+    rotated = img.rotate(angle, resample=Image.NEAREST, fillcolor=0)
+    rows = list(rotated.resize((1, rotated.height), Image.BOX).getdata())
+    return sum((a - b) ** 2 for a, b in zip(rows, rows[1:]))
+
+
+def estimate_skew(img, max_angle=DESKEW_MAX_ANGLE):
+    """Inclinaison des lignes de texte (degrés), par recherche grossière puis fine."""
+    small = img.copy()
+    small.thumbnail((ANALYSIS_SIZE, ANALYSIS_SIZE))
+    # texte en blanc sur fond noir : les lignes font des pics dans le profil
+    small = ImageOps.autocontrast(small).point(lambda p: 255 if p < 128 else 0)
+
+    candidates = range(-max_angle, max_angle + 1)
+    best = max(candidates, key=lambda a: _row_profile_score(small, a))
+    fine = [best + step / 4 for step in range(-3, 4)]
+    return max(fine, key=lambda a: _row_profile_score(small, a))
+
+
+def deskew(img, max_angle=DESKEW_MAX_ANGLE):
+    angle = estimate_skew(img, max_angle)
+    if abs(angle) < 0.5:
+        return img
+    return img.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+
+
+def _encode(img, quality):
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
+
+
+def encode_within_budget(img, byte_budget=BYTE_BUDGET,
+                         min_quality=MIN_QUALITY, max_quality=MAX_QUALITY):
+    """
+    JPEG à la meilleure qualité qui tient dans byte_budget (recherche dichotomique).
+    Si même la qualité minimale dépasse, l'image est réduite et on recommence.
+    """
+    while True:
+        data = _encode(img, max_quality)
+        if len(data) <= byte_budget:
+            return data
+        best = None
+        low, high = min_quality, max_quality - 1
+        while low <= high:
+            quality = (low + high) // 2
+            candidate = _encode(img, quality)
+            if len(candidate) <= byte_budget:
+                best, low = candidate, quality + 1
+            else:
+                high = quality - 1
+        if best is not None or img.width < 400:
+            return best or candidate
+        img = img.resize((int(img.width * 0.75), int(img.height * 0.75)), Image.LANCZOS)
+
+
+def _open_upright(data, max_width):
+    img = ImageOps.exif_transpose(open_downscaled(data, max_width))
+    return img.convert("L")
+
+
+def prepare_receipt_image(data, max_width=MAX_WIDTH, byte_budget=BYTE_BUDGET):
+    """Octets de la photo d'origine -> octets JPEG (gris, recadré, redressé) pour l'OCR."""
+    # Le ticket est repéré sur une vignette, puis le décodeur réduit seulement autant que
+    # le permet la largeur du ticket (pas celle de la photo) : le texte garde max_width px.
+    box = crop_box(_open_upright(data, ANALYSIS_SIZE))
+    crop_width = box[2] - box[0] if box else 1.0
+    img = apply_crop(_open_upright(data, int(max_width / crop_width)), box)
+    if img.width > max_width:
+        img = img.resize((max_width, int(img.height * max_width / img.width)), Image.LANCZOS)
+    img = deskew(img)
+    img = ImageOps.autocontrast(img, cutoff=1)
+    return encode_within_budget(img, byte_budget)
+
+
+def legacy_prepare(data, max_width=MAX_WIDTH):
+    """
+    Traitement d'avant (référence du benchmark) : photo entière à max_width px de large,
+    couleur, JPEG q60. Mêmes octets qu'avant ce module : empreintes et cache OCR inchangés.
+    """
+    img = Image.open(io.BytesIO(data))
+    if img.width > max_width:
+        img = img.resize((max_width, int(img.height * max_width / img.width)))
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=60)
+    return buf.getvalue()
+
+
+def image_dhash(image_bytes, grid=PHASH_GRID):
+    """
+    Empreinte perceptuelle (dHash) : deux photos du même ticket, même décalées ou
+    recompressées un peu différemment, ont des empreintes proches.
+    Retournée sous forme de chaîne de '0'/'1', directement castable en BIT(256).
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        small = img.convert("L").resize((grid + 1, grid), Image.LANCZOS)
+        pixels = list(small.getdata())
+    bits = []
+    for row in range(grid):
+        for col in range(grid):
+            left = pixels[row * (grid + 1) + col]
+            right = pixels[row * (grid + 1) + col + 1]
+            bits.append("1" if left > right else "0")
+    return "".join(bits)
+
+
+def preprocess_receipt(data, pipeline="legacy", max_width=MAX_WIDTH, byte_budget=BYTE_BUDGET):
+    """
+    Exécuté dans le pool d'images d'app.py : (JPEG pour l'OCR, (sha256, dHash) de ce JPEG).
+    pipeline : "legacy" (legacy_prepare) ou "receipt" (prepare_receipt_image).
+    """
+    if pipeline == "receipt":
+        image_bytes = prepare_receipt_image(data, max_width, byte_budget)
+    else:
+        image_bytes = legacy_prepare(data, max_width)
+    return image_bytes, (hashlib.sha256(image_bytes).hexdigest(), image_dhash(image_bytes))
+
+
+def tesseract_text(image_bytes, lang="fra", timeout=0):
+    """Texte lu par Tesseract (process du pool Tesseract d'app.py) ; timeout 0 = sans limite."""
+    import pytesseract
+
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        return pytesseract.image_to_string(img, lang=lang, timeout=timeout)
+
+
+# -----------------------------------------------------------------------------#
+# BENCHMARK : python receipt_image.py DOSSIER [--ocr]
+# -----------------------------------------------------------------------------#
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def _ocr_hit(image_bytes):
+    """Lecture Tesseract + analyse : le ticket est "lu" si on trouve un TTC et une date."""
+    from receipt_parser import parse_receipt
+
+    parsed = parse_receipt(tesseract_text(image_bytes))
+    return bool(parsed["ttc"] and parsed["date"])
+
+
+def run_benchmark(directory, with_ocr=False):
+    paths = sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not paths:
+        print(f"Aucune image dans {directory}")
+        return
+
+    totals = {
+        "legacy": {"bytes": 0, "cpu": 0.0, "hits": 0},
+        "pipeline": {"bytes": 0, "cpu": 0.0, "hits": 0},
+    }
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        line = [os.path.basename(path), f"{len(data) // 1024} Ko"]
+        for name, prepare in (("legacy", legacy_prepare), ("pipeline", prepare_receipt_image)):
+            start = time.process_time()
+            output = prepare(data)
+            cpu = time.process_time() - start
+            totals[name]["bytes"] += len(output)
+            totals[name]["cpu"] += cpu
+            line.append(f"{name} {len(output) // 1024} Ko {cpu * 1000:.0f} ms")
+            if with_ocr:
+                hit = _ocr_hit(output)
+                totals[name]["hits"] += hit
+                line.append("lu" if hit else "NON lu")
+        print(" | ".join(line))
+
+    count = len(paths)
+    for name, total in totals.items():
+        summary = (f"{name:9} : {total['bytes'] / count / 1024:.0f} Ko/image, "
+                   f"{total['cpu'] / count * 1000:.0f} ms CPU/image")
+        if with_ocr:
+            summary += f", tickets lus {total['hits']}/{count}"
+        print(summary)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage : python receipt_image.py DOSSIER_D_IMAGES [--ocr]")
+        sys.exit(1)
+    run_benchmark(sys.argv[1], with_ocr="--ocr" in sys.argv[2:])
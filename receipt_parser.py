@@ -0,0 +1,319 @@
+"""
+Analyse du texte OCR d'un ticket de caisse : montants TTC / HT / TVA, taux de TVA,
+date et enseigne, avec un indice de confiance par champ.
+
+Le texte est lu en une seule passe par une expression régulière compilée une fois
+(tokenizer) ; les montants sont rattachés au libellé lu en début de ligne
+("TOTAL TTC", "TVA", "HT", "ESPECES"...). Les lignes "taux + montants" des tableaux
+de TVA sont reconnues, et TTC = HT + TVA sert de contrôle de cohérence.
+
+Module autonome (pas de base de données) : app.py l'utilise pour le scan des tickets,
+et `python receipt_parser.py` mesure précision et débit sur samples/receipts/.
+"""
+import os
+import re
+import sys
+import json
+import time
+from datetime import date
+
+# Les montants sont manipulés en centimes (entiers) : calculs exacts et rapides.
+# Écart toléré (arrondis), en centimes, pour TTC = HT + TVA et TVA = HT x taux
+TOLERANCE_CENTS = 2
+
+MONTHS = {
+    "janv": 1, "janvier": 1, "fevr": 2, "févr": 2, "fevrier": 2, "février": 2,
+    "mars": 3, "avr": 4, "avril": 4, "mai": 5, "juin": 6, "juil": 7, "juillet": 7,
+    "aout": 8, "août": 8, "sept": 9, "septembre": 9, "oct": 10, "octobre": 10,
+    "nov": 11, "novembre": 11, "dec": 12, "déc": 12, "decembre": 12, "décembre": 12,
+}
+
+# Mot (majuscules, sans points : "H.T." -> "HT") -> rôle des montants de la ligne
+KEYWORDS = {
+    "SOUS": "subtotal",
+    "HT": "ht", "HORS": "ht",
+    "TVA": "tva", "VAT": "tva", "TAX": "tva", "TAXE": "tva", "TAXES": "tva",
+    "TTC": "ttc", "PAYER": "ttc", "MONTANT": "ttc",
+    "TOTAL": "total",
+    "ESPECES": "payment", "ESPÈCES": "payment", "RENDU": "payment", "MONNAIE": "payment",
+    "CB": "payment", "CARTE": "payment", "PAYE": "payment", "PAIEMENT": "payment",
+    "CHEQUE": "payment", "CHÈQUE": "payment",
+}
+# Un "TOTAL" peut être précisé par le mot suivant ("TOTAL HT", "TOTAL TVA"...)
+REFINES_TOTAL = ("ht", "tva", "ttc")
+
+_MONTH_NAMES = "|".join(sorted(MONTHS, key=len, reverse=True))
+
+# Un seul motif pour tout le ticket ; à une même position, la première alternative
+# qui correspond l'emporte (une date "12.03.24" n'est donc jamais lue comme montant).
+# Chaque jeton absorbe les blancs qui le précèdent, et les mots qui se suivent forment
+# un seul jeton "text" ("TOTAL TTC EUR") : le moteur essaie peu de positions.
+_TOKEN_RE = re.compile(
+    r"[^\S\n]*(?:"
+    r"(?P<nl>\n)"
+    r"|(?P<text>[^\W\d_]+(?:[ .'\-]+[^\W\d_]+)*\.?)"
+    r"|(?P<iso>(?<!\d)\d{4}-\d{2}-\d{2}(?!\d))"
+    r"|(?P<dmy>(?<![\d.,])\d{1,2}[/.\-]\d{1,2}[/.\-](?:\d{4}|\d{2})(?![\d.,]))"
+    r"|(?P<dtext>(?<!\d)\d{1,2}(?:er)?\s+(?i:" + _MONTH_NAMES + r")\.?\s+\d{4}(?!\d))"
+    r"|(?P<time>(?<!\d)\d{1,2}[:h]\d{2}(?::\d{2})?(?!\d))"
+    r"|(?P<rate>(?<![\d.,])\d{1,2}(?:[.,]\d{1,2})?\s?%)"
+    r"|(?P<amount>(?<![\d.,])-?\s?(?:\d{1,3}(?:[  .']\d{3})+|\d+)[.,]\d{2}(?![\d%]))"
+    r"|(?P<number>\d+(?:[.,]\d+)*)"
+    r")"
+)
+
+_NON_DIGIT_RE = re.compile(r"\D")
+_WORD_SPLIT_RE = re.compile(r"[ '\-]+")
+_DATE_SPLIT_RE = re.compile(r"[/.\-]")
+_DTEXT_RE = re.compile(r"(\d{1,2})(?:er)?\s+([^\s.]+)\.?\s+(\d{4})")
+
+
+def parse_amount(raw):
+    """'1 234,56' / '1.234,56' / '-12.50' -> centimes (123456 / 123456 / -1250)."""
+    # toujours 2 décimales : une fois les séparateurs retirés, il reste les centimes
+    cents = int(_NON_DIGIT_RE.sub("", raw))
+    return -cents if raw.lstrip().startswith("-") else cents
+
+
+def parse_rate(raw):
+    """' 5,5 %' -> 5.5"""
+    return float(raw.strip().rstrip("%").strip().replace(",", "."))
+
+
+def format_cents(cents):
+    """1090 -> '10.90'"""
+    if cents is None:
+        return None
+    sign = "-" if cents < 0 else ""
+    cents = abs(cents)
+    return f"{sign}{cents // 100}.{cents % 100:02d}"
+
+
+def keyword_role(words):
+    """Rôle d'un groupe de mots ("TOTAL TTC EUR" -> "ttc"), ou None."""
+    role = None
+    for word in _WORD_SPLIT_RE.split(words.replace(".", "").upper()):
+        found = KEYWORDS.get(word)
+        if found is None:
+            continue
+        if role is None:
+            role = found
+            if role != "total":
+                break
+        elif found in REFINES_TOTAL:
+            role = found
+            break
+    return role
+
+
+def _parse_date(kind, raw):
+    raw = raw.strip()
+    try:
+        if kind == "iso":
+            return date.fromisoformat(raw)
+        if kind == "dtext":
+            m = _DTEXT_RE.match(raw)
+            month = MONTHS.get(m.group(2).lower())
+            return date(int(m.group(3)), month, int(m.group(1))) if month else None
+        d, m, y = _DATE_SPLIT_RE.split(raw)
+        year = int(y) + 2000 if len(y) == 2 else int(y)
+        return date(year, int(m), int(d))
+    except ValueError:
+        return None
+
+
+def _close(a, b):
+    return abs(a - b) <= TOLERANCE_CENTS
+
+
+def _vat_row(rate, amounts):
+    """
+    Ligne d'un tableau de TVA ("20% 100,00 20,00 120,00") -> (ht, tva, ttc) ou None.
+    On cherche HT, TVA (= HT x taux) et éventuellement TTC (= HT + TVA) parmi les montants.
+    """
+    for i, ht in enumerate(amounts):
+        for tva in amounts[i + 1:]:
+            if ht > 0 and _close(ht * rate / 100, tva):
+                ttc = ht + tva
+                return ht, tva, (ttc if any(_close(a, ttc) for a in amounts) else None)
+    return None
+
+
+def parse_receipt(text):
+    """
+    Texte OCR -> dict :
+      ttc, ht, tva       chaînes "10.90" ou None
+      vat_rates          taux de TVA lus (liste de float)
+      date               date ISO ou None
+      merchant           enseigne (première ligne de texte) ou None
+      consistent         True si TTC = HT + TVA a pu être vérifié, False si contredit, None sinon
+      confidence         {champ: 0..1}
+    """
+    result = {
+        "ttc": None, "ht": None, "tva": None, "vat_rates": [],
+        "date": None, "merchant": None, "consistent": None,
+        "confidence": {"ttc": 0.0, "ht": 0.0, "tva": 0.0, "date": 0.0, "merchant": 0.0},
+    }
+    if not text:
+        return result
+
+    # --- passe unique sur le texte
+    labelled = {"ttc": [], "total": [], "ht": [], "tva": []}
+    free_amounts = []
+    rates = []
+    vat_rows = []
+    found_date = None
+    date_confidence = 0.0
+    merchant = None
+
+    line_kw = None
+    line_rate = None
+    line_amounts = []
+    line_text = None
+    line_has_values = False
+
+    for m in _TOKEN_RE.finditer(text + "\n"):
+        kind = m.lastgroup
+        if kind == "nl":
+            if line_rate is not None and line_kw is None and len(line_amounts) >= 2:
+                row = _vat_row(line_rate, line_amounts)
+                if row:
+                    vat_rows.append(row)
+            # enseigne : première ligne faite uniquement de mots
+            if merchant is None and line_text and not line_has_values:
+                merchant = line_text
+            line_kw, line_rate, line_amounts, line_text, line_has_values = None, None, [], None, False
+        elif kind == "text":
+            words = m.group(kind)
+            if merchant is None:
+                line_text = f"{line_text} {words}" if line_text else words
+            # le libellé en début de ligne donne le rôle ("TOTAL TTC EUR", "DONT TVA 20%")
+            if line_kw is None or line_kw == "total":
+                role = keyword_role(words)
+                if line_kw is None or role in REFINES_TOTAL:
+                    line_kw = role or line_kw
+        elif kind == "amount":
+            line_has_values = True
+            value = parse_amount(m.group(kind))
+            line_amounts.append(value)
+            if line_kw in labelled:
+                labelled[line_kw].append(value)
+            elif line_kw is None and value > 0:
+                free_amounts.append(value)
+        elif kind == "rate":
+            line_has_values = True
+            line_rate = parse_rate(m.group(kind))
+            rates.append(line_rate)
+        elif kind in ("iso", "dmy", "dtext"):
+            line_has_values = True
+            if found_date is None:
+                raw = m.group(kind)
+                found_date = _parse_date(kind, raw)
+                if found_date:
+                    date_confidence = 0.95 if kind != "dmy" or len(raw) >= 8 else 0.8
+        else:
+            line_has_values = True
+
+    # --- décision
+    conf = result["confidence"]
+    ttc = ht = tva = None
+
+    if labelled["ttc"]:
+        ttc, conf["ttc"] = max(labelled["ttc"]), 0.9
+    elif labelled["total"]:
+        ttc, conf["ttc"] = max(labelled["total"]), 0.85
+    elif vat_rows and all(r[2] is not None for r in vat_rows):
+        ttc, conf["ttc"] = sum(r[2] for r in vat_rows), 0.8
+    elif free_amounts:
+        # aucun libellé : le plus grand montant (hors paiement / rendu monnaie)
+        ttc, conf["ttc"] = max(free_amounts), 0.4
+
+    if labelled["ht"]:
+        ht, conf["ht"] = max(labelled["ht"]), 0.9
+    if labelled["tva"]:
+        tva, conf["tva"] = max(labelled["tva"]), 0.9
+        if len(labelled["tva"]) > 1 and len(set(rates)) > 1:
+            # une ligne de TVA par taux, sans total TVA
+            tva = sum(labelled["tva"])
+    if vat_rows:
+        if ht is None:
+            ht, conf["ht"] = sum(r[0] for r in vat_rows), 0.85
+        if tva is None:
+            tva, conf["tva"] = sum(r[1] for r in vat_rows), 0.85
+
+    # valeurs manquantes déduites de TTC = HT + TVA
+    if ttc is not None:
+        if ht is None and tva is not None:
+            ht, conf["ht"] = ttc - tva, 0.7
+        elif tva is None and ht is not None:
+            tva, conf["tva"] = ttc - ht, 0.7
+
+    # contrôle de cohérence
+    if ttc is not None and ht is not None and tva is not None:
+        consistent = _close(ht + tva, ttc)
+        result["consistent"] = consistent
+        if consistent:
+            for field in ("ttc", "ht", "tva"):
+                conf[field] = max(conf[field], 0.95)
+            if len(set(rates)) == 1 and _close(ht * rates[0] / 100, tva):
+                conf["tva"] = conf["ht"] = 0.99
+        else:
+            for field in ("ht", "tva"):
+                conf[field] = min(conf[field], 0.3)
+
+    result.update({
+        "ttc": format_cents(ttc),
+        "ht": format_cents(ht),
+        "tva": format_cents(tva),
+        "vat_rates": sorted(set(rates)),
+        "date": found_date.isoformat() if found_date else None,
+        "merchant": merchant[:80] if merchant else None,
+    })
+    conf["date"] = date_confidence
+    conf["merchant"] = 0.6 if merchant else 0.0
+    return result
+
+
+# -----------------------------------------------------------------------------#
+# BENCHMARK : python receipt_parser.py [répétitions]
+# -----------------------------------------------------------------------------#
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples", "receipts")
+BENCH_FIELDS = ("ttc", "ht", "tva", "date", "merchant")
+
+
+def run_benchmark(repeat=2000, samples_dir=SAMPLES_DIR):
+    """Précision sur le corpus (samples/receipts/expected.json) puis débit en tickets/s."""
+    with open(os.path.join(samples_dir, "expected.json"), encoding="utf-8") as f:
+        expected = json.load(f)
+    texts = {}
+    for name in sorted(expected):
+        with open(os.path.join(samples_dir, name), encoding="utf-8") as f:
+            texts[name] = f.read()
+
+    ok = total = 0
+    for name, text in texts.items():
+        got = parse_receipt(text)
+        errors = []
+        for field in BENCH_FIELDS:
+            if field not in expected[name]:
+                continue
+            total += 1
+            if got[field] == expected[name][field]:
+                ok += 1
+            else:
+                errors.append(f"{field}={got[field]!r} (attendu {expected[name][field]!r})")
+        print(f"{'OK ' if not errors else 'ERR'} {name}" + (" : " + ", ".join(errors) if errors else ""))
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts.values():
+            parse_receipt(text)
+    elapsed = time.perf_counter() - start
+    count = repeat * len(texts)
+    print(f"Champs corrects : {ok}/{total}")
+    print(f"Débit : {count / elapsed:.0f} tickets/s ({elapsed / count * 1e6:.1f} µs/ticket)")
+    return ok, total
+
+
+if __name__ == "__main__":
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -1,92 +1,394 @@
-// Filtrage & tri côté client + scan OCR
+// Liste des notes : filtres / tri / pagination côté serveur (via /api/expenses) et synchronisation
+// par delta (?since=) ; scan OCR, upload direct des justificatifs, actions groupées (admin)
+
+function escapeHtml(value) {
+  return String(value ?? "")
+    .replace(/&/g, "&amp;")
+    .replace(/</g, "&lt;")
+    .replace(/>/g, "&gt;")
+    .replace(/"/g, "&quot;")
+    .replace(/'/g, "&#39;");
+}
+
+const EMPTY_CELL = '<span class="text-muted">-</span>';
+
+function formatAmountCell(value) {
+  if (value == null) return EMPTY_CELL;
+  return `${Number(value).toFixed(2)} €`;
+}
+
+function textOrEmpty(value) {
+  return value ? escapeHtml(value) : EMPTY_CELL;
+}
+
+function statusBadge(status) {
+  if (status === "approved") return '<span class="badge bg-success">Validée</span>';
+  if (status === "rejected") return '<span class="badge bg-danger">Refusée</span>';
+  return '<span class="badge bg-secondary">En attente</span>';
+}
+
+// Miniature chargée seulement à l'approche de l'écran (loading="lazy"), clic = aperçu moyen
+function receiptCell(e) {
+  if (!e.receipt_path) return EMPTY_CELL;
+  const path = e.receipt_path;
+  const href = path.startsWith("http")
+    ? path
+    : `/uploads/${path.split("/").map(encodeURIComponent).join("/")}`;
+  return `<a href="/receipts/${e.id}/preview" target="_blank">
+            <img src="/receipts/${e.id}/thumb" class="receipt-thumb" width="48" height="48" alt=""
+                 loading="lazy" decoding="async" onerror="this.parentNode.remove()">
+          </a>
+          <a href="${escapeHtml(href)}" target="_blank" class="btn btn-link btn-sm text-decoration-none">
+            Voir
+          </a>`;
+}
+
+function adminActionsCell(e) {
+  const base = `/admin/expenses/${e.id}`;
+  return `<td>
+      <input type="checkbox" class="form-check-input me-1 expense-select" value="${e.id}">
+      <form method="post" action="${base}/approve" class="d-inline">
+        <button type="submit" class="btn btn-success btn-sm" ${e.status === "approved" ? "disabled" : ""}>✓</button>
+      </form>
+      <form method="post" action="${base}/reject" class="d-inline ms-1">
+        <button type="submit" class="btn btn-outline-danger btn-sm" ${e.status === "rejected" ? "disabled" : ""}>✕</button>
+      </form>
+      <form method="post" action="${base}/delete" class="d-inline ms-1"
+            onsubmit="return confirm('Supprimer cette note ?');">
+        <button type="submit" class="btn btn-outline-danger btn-sm">🗑</button>
+      </form>
+    </td>`;
+}
+
+// Même rendu que la boucle de templates/expenses.html
+function renderExpenseRow(e, isAdmin) {
+  const tr = document.createElement("tr");
+  tr.dataset.id = e.id;
+  tr.dataset.date = e.date;
+  tr.dataset.amount = e.amount;
+  tr.dataset.chantier = (e.chantier || "").toLowerCase();
+  tr.innerHTML = `
+    <td>${escapeHtml(e.date)}</td>
+    <td>${formatAmountCell(e.amount)}</td>
+    <td>${formatAmountCell(e.amount_ht)}</td>
+    <td>${formatAmountCell(e.tva_amount)}</td>
+    <td>${escapeHtml(e.label)}</td>
+    <td class="chantier-cell">${escapeHtml(e.chantier)}</td>
+    <td>${textOrEmpty(e.payment_method)}</td>
+    <td>${textOrEmpty(e.comment_text)}</td>
+    <td>${escapeHtml(e.user_email)}</td>
+    <td class="status-cell">${statusBadge(e.status)}</td>
+    <td>${receiptCell(e)}</td>
+    ${isAdmin ? adminActionsCell(e) : ""}`;
+  return tr;
+}
 
 function setupFiltersAndSorting() {
   const table = document.getElementById("expenses-table");
   if (!table) return;
 
   const tbody = table.querySelector("tbody");
-  const rows = Array.from(tbody.querySelectorAll("tr"));
+  const isAdmin = table.dataset.isAdmin === "true";
+  const pageSize = table.dataset.pageSize || "";
 
   const dateFromInput = document.getElementById("filter-date-from");
   const dateToInput = document.getElementById("filter-date-to");
   const chantierInput = document.getElementById("filter-chantier");
+  const statusInput = document.getElementById("filter-status");
+  const userInput = document.getElementById("filter-user");
   const resetBtn = document.getElementById("reset-filters-btn");
   const sortDateBtn = document.getElementById("sort-date-btn");
   const sortAmountBtn = document.getElementById("sort-amount-btn");
+  const loadMoreBtn = document.getElementById("load-more-btn");
+  const emptyMsg = document.getElementById("expenses-empty");
 
-  let sortDateAsc = true;
-  let sortAmountAsc = true;
+  // La première page est rendue par le serveur
+  let sort = table.dataset.sort || "date";
+  let order = table.dataset.order || "desc";
+  let nextCursor = table.dataset.nextCursor || null;
+  let requestSeq = 0;
 
-  function applyFilters() {
-    const from = dateFromInput ? dateFromInput.value || null : null;
-    const to = dateToInput ? dateToInput.value || null : null;
-    const chantier = (chantierInput?.value || "").toLowerCase();
-
-    rows.forEach((row) => {
-      const rowDate = row.getAttribute("data-date") || "";
-      const rowChantier = (row.getAttribute("data-chantier") || "").toLowerCase();
+  function buildParams(cursor) {
+    const params = new URLSearchParams();
+    if (dateFromInput?.value) params.set("date_from", dateFromInput.value);
+    if (dateToInput?.value) params.set("date_to", dateToInput.value);
+    if (chantierInput?.value.trim()) params.set("chantier", chantierInput.value.trim());
+    if (statusInput?.value) params.set("status", statusInput.value);
+    if (userInput?.value.trim()) params.set("user", userInput.value.trim());
+    params.set("sort", sort);
+    params.set("order", order);
+    if (pageSize) params.set("limit", pageSize);
+    if (cursor) params.set("cursor", cursor);
+    return params;
+  }
 
-      let visible = true;
+  function updateFooter() {
+    if (loadMoreBtn) loadMoreBtn.classList.toggle("d-none", !nextCursor);
+    if (emptyMsg) emptyMsg.classList.toggle("d-none", tbody.rows.length > 0);
+  }
 
-      if (from && rowDate < from) visible = false;
-      if (to && rowDate > to) visible = false;
+  // append = false : on remplace le tableau (nouveau filtre / tri)
+  function loadPage(append) {
+    const seq = ++requestSeq;
+    const params = buildParams(append ? nextCursor : null);
+    if (loadMoreBtn) loadMoreBtn.disabled = true;
 
-      if (chantier && !rowChantier.includes(chantier)) visible = false;
+    return fetch(`/api/expenses?${params.toString()}`)
+      .then((resp) => resp.json())
+      .then((data) => {
+        // une réponse plus ancienne qu'un filtre plus récent est ignorée
+        if (seq !== requestSeq) return;
+        if (data.error) {
+          alert("Erreur : " + data.error);
+          return;
+        }
+        if (!append) tbody.innerHTML = "";
+        const fragment = document.createDocumentFragment();
+        data.items.forEach((e) => fragment.appendChild(renderExpenseRow(e, isAdmin)));
+        tbody.appendChild(fragment);
+        nextCursor = data.next_cursor;
+        updateFooter();
+      })
+      .catch((err) => {
+        console.error(err);
+        alert("Erreur réseau pendant le chargement des notes.");
+      })
+      .finally(() => {
+        if (loadMoreBtn) loadMoreBtn.disabled = false;
+      });
+  }
 
-      row.style.display = visible ? "" : "none";
-    });
+  let debounceTimer = null;
+  function reloadDebounced() {
+    clearTimeout(debounceTimer);
+    debounceTimer = setTimeout(() => loadPage(false), 300);
   }
 
   function resetFilters() {
     if (dateFromInput) dateFromInput.value = "";
     if (dateToInput) dateToInput.value = "";
     if (chantierInput) chantierInput.value = "";
-    applyFilters();
-  }
-
-  function sortBy(field, asc) {
-    const factor = asc ? 1 : -1;
-    const visibleRows = rows.slice().filter((r) => r.style.display !== "none");
-
-    visibleRows.sort((a, b) => {
-      let av, bv;
-      if (field === "date") {
-        av = a.getAttribute("data-date") || "";
-        bv = b.getAttribute("data-date") || "";
-      } else if (field === "amount") {
-        av = parseFloat(a.getAttribute("data-amount") || "0");
-        bv = parseFloat(b.getAttribute("data-amount") || "0");
-      } else {
-        av = "";
-        bv = "";
-      }
+    if (statusInput) statusInput.value = "";
+    if (userInput) userInput.value = "";
+    loadPage(false);
+  }
 
-      if (av < bv) return -1 * factor;
-      if (av > bv) return 1 * factor;
-      return 0;
-    });
+  function sortBy(field) {
+    // 1er clic : croissant, puis on alterne
+    order = sort === field && order === "asc" ? "desc" : "asc";
+    sort = field;
+    loadPage(false);
+  }
+
+  // Synchronisation par delta : le tableau est la copie locale, on n'y fusionne que
+  // les notes créées / modifiées / supprimées depuis syncCursor
+  let syncCursor = table.dataset.syncCursor || null;
+  const syncInterval = Number(table.dataset.syncInterval || 0) * 1000;
+  let syncing = false;
+
+  // ordre du tableau : < 0 si la note a passe avant la ligne b
+  function compareRows(a, b) {
+    const key = (x) => (sort === "amount" ? Number(x.amount) : x.date);
+    let diff = key(a) < key(b) ? -1 : key(a) > key(b) ? 1 : 0;
+    if (!diff) diff = Number(a.id) - Number(b.id);
+    return order === "desc" ? -diff : diff;
+  }
+
+  function mergeItem(e) {
+    const existing = tbody.querySelector(`tr[data-id="${e.id}"]`);
+    const checked = existing?.querySelector(".expense-select")?.checked;
+    if (existing) existing.remove();
+    // ne correspond plus aux filtres (ex. validée alors qu'on affiche "en attente")
+    if (!e.match) return;
 
-    visibleRows.forEach((row) => tbody.appendChild(row));
+    const tr = renderExpenseRow(e, isAdmin);
+    if (checked) tr.querySelector(".expense-select").checked = true;
+    const next = Array.from(tbody.rows).find((row) => compareRows(e, row.dataset) < 0);
+    if (next) tbody.insertBefore(tr, next);
+    else if (!nextCursor) tbody.appendChild(tr);
+    // sinon : la note tombe dans les pages pas encore chargées
   }
 
-  if (dateFromInput) dateFromInput.addEventListener("change", applyFilters);
-  if (dateToInput) dateToInput.addEventListener("change", applyFilters);
-  if (chantierInput) chantierInput.addEventListener("input", applyFilters);
+  function syncChanges() {
+    if (!syncCursor || syncing || document.hidden) return;
+    syncing = true;
+    const seq = requestSeq;
+    const params = buildParams(null);
+    params.set("since", syncCursor);
+
+    fetch(`/api/expenses?${params.toString()}`)
+      .then((resp) => resp.json())
+      .then((data) => {
+        if (data.error) throw new Error(data.error);
+        // liste rechargée pendant l'appel (filtre, tri) : on garde l'ancien curseur,
+        // le prochain delta renverra ces changements (fusion idempotente)
+        if (seq !== requestSeq) return;
+        syncCursor = data.cursor;
+        if (data.reset) {
+          loadPage(false);
+          return;
+        }
+        data.items.forEach(mergeItem);
+        data.deleted.forEach((id) => tbody.querySelector(`tr[data-id="${id}"]`)?.remove());
+        updateFooter();
+      })
+      .catch((err) => console.error(err))
+      .finally(() => {
+        syncing = false;
+      });
+  }
+
+  if (syncInterval > 0) {
+    setInterval(syncChanges, syncInterval);
+    document.addEventListener("visibilitychange", syncChanges);
+  }
+
+  if (dateFromInput) dateFromInput.addEventListener("change", () => loadPage(false));
+  if (dateToInput) dateToInput.addEventListener("change", () => loadPage(false));
+  if (statusInput) statusInput.addEventListener("change", () => loadPage(false));
+  if (chantierInput) chantierInput.addEventListener("input", reloadDebounced);
+  if (userInput) userInput.addEventListener("input", reloadDebounced);
   if (resetBtn) resetBtn.addEventListener("click", resetFilters);
+  if (loadMoreBtn) loadMoreBtn.addEventListener("click", () => loadPage(true));
+
+  if (sortDateBtn) sortDateBtn.addEventListener("click", () => sortBy("date"));
+  if (sortAmountBtn) sortAmountBtn.addEventListener("click", () => sortBy("amount"));
+}
+
+// Validation / refus / suppression de plusieurs notes cochées : un seul appel groupé
+const BULK_ACTION_STATUS = { approve: "approved", reject: "rejected" };
+
+function setupBulkActions() {
+  const table = document.getElementById("expenses-table");
+  const bar = document.getElementById("bulk-actions");
+  if (!table || !bar) return;
+
+  const tbody = table.querySelector("tbody");
+  const selectAll = document.getElementById("select-all-expenses");
+  const countLabel = document.getElementById("bulk-count");
+  const buttons = bar.querySelectorAll("[data-bulk-action]");
+  const emptyMsg = document.getElementById("expenses-empty");
 
-  if (sortDateBtn) {
-    sortDateBtn.addEventListener("click", () => {
-      sortBy("date", sortDateAsc);
-      sortDateAsc = !sortDateAsc;
+  function selectedBoxes() {
+    return Array.from(tbody.querySelectorAll(".expense-select:checked"));
+  }
+
+  function updateBar() {
+    const count = selectedBoxes().length;
+    bar.classList.toggle("d-none", count === 0);
+    countLabel.textContent = `${count} note${count > 1 ? "s" : ""} sélectionnée${count > 1 ? "s" : ""}`;
+    if (selectAll) {
+      const total = tbody.querySelectorAll(".expense-select").length;
+      selectAll.checked = total > 0 && count === total;
+      selectAll.indeterminate = count > 0 && count < total;
+    }
+  }
+
+  function applyResult(data) {
+    data.ids.forEach((id) => {
+      const tr = tbody.querySelector(`tr[data-id="${id}"]`);
+      if (!tr) return;
+      if (data.action === "delete") {
+        tr.remove();
+        return;
+      }
+      const status = BULK_ACTION_STATUS[data.action];
+      tr.querySelector(".status-cell").innerHTML = statusBadge(status);
+      tr.querySelector('form[action$="/approve"] button').disabled = status === "approved";
+      tr.querySelector('form[action$="/reject"] button').disabled = status === "rejected";
+    });
+    tbody.querySelectorAll(".expense-select:checked").forEach((box) => {
+      box.checked = false;
     });
+    if (emptyMsg) emptyMsg.classList.toggle("d-none", tbody.rows.length > 0);
+    updateBar();
+  }
+
+  function runAction(action) {
+    const ids = selectedBoxes().map((box) => Number(box.value));
+    if (!ids.length) return;
+    if (action === "delete" && !confirm(`Supprimer ${ids.length} note(s) ?`)) return;
+
+    buttons.forEach((btn) => { btn.disabled = true; });
+    fetch(bar.dataset.url, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ action, ids }),
+    })
+      .then((resp) => resp.json())
+      .then((data) => {
+        if (data.error) {
+          alert("Erreur : " + data.error);
+          return;
+        }
+        applyResult(data);
+      })
+      .catch((err) => {
+        console.error(err);
+        alert("Erreur réseau pendant la mise à jour des notes.");
+      })
+      .finally(() => {
+        buttons.forEach((btn) => { btn.disabled = false; });
+      });
   }
 
-  if (sortAmountBtn) {
-    sortAmountBtn.addEventListener("click", () => {
-      sortBy("amount", sortAmountAsc);
-      sortAmountAsc = !sortAmountAsc;
+  tbody.addEventListener("change", (evt) => {
+    if (evt.target.classList.contains("expense-select")) updateBar();
+  });
+  if (selectAll) {
+    selectAll.addEventListener("change", () => {
+      tbody.querySelectorAll(".expense-select").forEach((box) => {
+        box.checked = selectAll.checked;
+      });
+      updateBar();
     });
   }
+  buttons.forEach((btn) => btn.addEventListener("click", () => runAction(btn.dataset.bulkAction)));
+  // lignes remplacées ou ajoutées par les filtres / "Charger plus"
+  new MutationObserver(updateBar).observe(tbody, { childList: true });
+}
+
+// Le scan tourne en arrière-plan côté serveur : on interroge le job jusqu'au résultat
+const SCAN_POLL_INTERVAL_MS = 1000;
+const SCAN_POLL_MAX_TRIES = 120;
+
+// En dessous de cet indice de confiance, le montant pré-rempli est signalé à vérifier
+const SCAN_MIN_CONFIDENCE = 0.5;
+
+function pollScanResult(statusUrl) {
+  return new Promise((resolve, reject) => {
+    let tries = 0;
+
+    function poll() {
+      fetch(statusUrl)
+        .then((resp) => resp.json())
+        .then((data) => {
+          if (data.status === "pending") {
+            tries += 1;
+            if (tries >= SCAN_POLL_MAX_TRIES) {
+              resolve({ error: "le scan prend trop de temps, réessaie plus tard." });
+            } else {
+              setTimeout(poll, SCAN_POLL_INTERVAL_MS);
+            }
+            return;
+          }
+          resolve(data);
+        })
+        .catch(reject);
+    }
+
+    poll();
+  });
+}
+
+// Justificatif déjà utilisé pour une note existante : on prévient avant la saisie
+function warnDuplicateReceipt(duplicates) {
+  if (!duplicates || !duplicates.length) return;
+  const lines = duplicates.map((d) => {
+    const detail = d.amount != null ? ` – ${formatAmountCell(d.amount)} – ${d.label || ""}` : "";
+    return `• note #${d.id} du ${d.date}${detail}`;
+  });
+  alert("Attention : ce justificatif semble déjà avoir été soumis :\n" + lines.join("\n"));
 }
 
 function setupScanButton() {
@@ -100,18 +402,28 @@ function setupScanButton() {
       return;
     }
 
-    const formData = new FormData();
-    formData.append("receipt", fileInput.files[0]);
-
     btn.disabled = true;
     const originalText = btn.textContent;
     btn.textContent = "Scan en cours...";
 
-    fetch("/api/scan_receipt", {
-      method: "POST",
-      body: formData,
-    })
+    // on attend la version allégée de la photo si elle est en préparation
+    Promise.resolve(receiptFileReady)
+      .then(() => {
+        const formData = new FormData();
+        formData.append("receipt", fileInput.files[0]);
+        return fetch("/api/scan_receipt", {
+          method: "POST",
+          body: formData,
+        });
+      })
       .then((resp) => resp.json())
+      .then((job) => {
+        if (job.error) return job;
+        warnDuplicateReceipt(job.duplicates);
+        // Ticket déjà scanné : le résultat en cache arrive directement
+        if (job.status === "done") return job;
+        return pollScanResult(job.status_url);
+      })
       .then((data) => {
         if (data.error) {
           console.error("OCR error:", data.error);
@@ -121,20 +433,23 @@ function setupScanButton() {
 
         console.log("OCR data:", data);
 
-        // helper pour remplir un input number proprement
-        function fillNumber(selector, value) {
+        const confidence = data.confidence || {};
+
+        // helper pour remplir un input number proprement ; champ douteux = bordure orange
+        function fillNumber(selector, value, fieldConfidence) {
           const input = document.querySelector(selector);
           if (!input || value == null) return;
           const num = parseFloat(value);
           if (!isNaN(num)) {
             input.value = num.toFixed(2); // ex: 10.90 -> "10.90"
+            input.classList.toggle("border-warning", fieldConfidence != null && fieldConfidence < SCAN_MIN_CONFIDENCE);
           }
         }
 
         // TTC / HT / TVA
-        fillNumber('input[name="amount"]', data.amount);
-        fillNumber('input[name="amount_ht"]', data.amount_ht);
-        fillNumber('input[name="tva_amount"]', data.tva_amount);
+        fillNumber('input[name="amount"]', data.amount, confidence.ttc);
+        fillNumber('input[name="amount_ht"]', data.amount_ht, confidence.ht);
+        fillNumber('input[name="tva_amount"]', data.tva_amount, confidence.tva);
 
         // Date (YYYY-MM-DD)
         if (data.date) {
@@ -161,7 +476,234 @@ function setupScanButton() {
   });
 }
 
+// Exports admin en arrière-plan : lancement du job, suivi, puis téléchargement
+function setupExportJobs() {
+  const buttons = document.querySelectorAll(".export-job-btn");
+
+  function progressText(job) {
+    if (job.status === "queued") return "En file d'attente...";
+    if (job.receipts_total) {
+      return `Justificatifs ${job.receipts_done || 0}/${job.receipts_total}...`;
+    }
+    if (job.rows_done) return `${job.rows_done} lignes...`;
+    return "Export en cours...";
+  }
+
+  buttons.forEach((btn) => {
+    btn.addEventListener("click", () => {
+      const originalText = btn.textContent;
+      const formData = new FormData();
+      formData.append("kind", btn.dataset.exportKind);
+
+      btn.disabled = true;
+      btn.textContent = "Lancement...";
+
+      function finish() {
+        btn.disabled = false;
+        btn.textContent = originalText;
+      }
+
+      function poll(statusUrl) {
+        fetch(statusUrl)
+          .then((resp) => resp.json())
+          .then((job) => {
+            if (job.error && job.status !== "failed") throw new Error(job.error);
+            if (job.status === "done") {
+              window.location.href = job.download_url;
+              finish();
+            } else if (job.status === "failed") {
+              alert("L'export a échoué : " + (job.error || "erreur inconnue"));
+              finish();
+            } else {
+              btn.textContent = progressText(job);
+              setTimeout(() => poll(statusUrl), 2000);
+            }
+          })
+          .catch((err) => {
+            console.error(err);
+            alert("Erreur pendant le suivi de l'export.");
+            finish();
+          });
+      }
+
+      fetch(btn.dataset.exportUrl, { method: "POST", body: formData })
+        .then((resp) => resp.json())
+        .then((job) => {
+          if (job.error) throw new Error(job.error);
+          poll(job.status_url);
+        })
+        .catch((err) => {
+          console.error(err);
+          alert("Impossible de lancer l'export.");
+          finish();
+        });
+    });
+  });
+}
+
+// Photo du justificatif réduite dans le navigateur avant tout envoi (scan, upload, formulaire).
+// Réglages fournis par le serveur (data-compress-max / data-compress-quality du formulaire).
+let receiptWorker = null;
+// Promesse résolue quand le fichier du champ "receipt" est prêt à partir
+let receiptFileReady = null;
+let compressionSeq = 0;
+const compressionRequests = new Map();
+
+function compressReceipt(file, maxDimension, quality) {
+  if (!file.type.startsWith("image/") || !window.Worker || !window.OffscreenCanvas) {
+    return Promise.resolve(file);
+  }
+  if (!receiptWorker) {
+    receiptWorker = new Worker("/static/receipt_worker.js");
+    receiptWorker.onmessage = (evt) => {
+      const resolve = compressionRequests.get(evt.data.id);
+      compressionRequests.delete(evt.data.id);
+      if (resolve) resolve(evt.data);
+    };
+  }
+
+  const id = ++compressionSeq;
+  return new Promise((resolve) => {
+    compressionRequests.set(id, resolve);
+    receiptWorker.postMessage({ id, file, maxDimension, quality });
+  }).then(({ blob, error }) => {
+    if (error) console.error("Compression impossible :", error);
+    if (!blob) return file;
+    const name = file.name.replace(/\.[^.]+$/, "") + ".jpg";
+    return new File([blob], name, { type: "image/jpeg", lastModified: Date.now() });
+  });
+}
+
+// Upload direct du justificatif dès qu'il est choisi (Cloudinary signé ou disque du serveur) :
+// le formulaire n'envoie ensuite que le jeton, pas le fichier.
+function uploadWithProgress(method, url, body, onProgress) {
+  return new Promise((resolve, reject) => {
+    const xhr = new XMLHttpRequest();
+    xhr.open(method, url);
+    xhr.upload.onprogress = (evt) => {
+      if (evt.lengthComputable) onProgress(Math.round((evt.loaded / evt.total) * 100));
+    };
+    xhr.onload = () => {
+      if (xhr.status >= 200 && xhr.status < 300) resolve(xhr.responseText);
+      else reject(new Error(`HTTP ${xhr.status}`));
+    };
+    xhr.onerror = () => reject(new Error("erreur réseau"));
+    xhr.send(body);
+  });
+}
+
+function setupDirectUpload() {
+  const form = document.getElementById("expense-form");
+  const fileInput = form ? form.querySelector('input[name="receipt"]') : null;
+  const tokenInput = document.getElementById("receipt-token");
+  // réponse signée de Cloudinary : le serveur vérifie la signature au lieu d'interroger l'API
+  const proofInput = document.getElementById("receipt-upload");
+  const status = document.getElementById("receipt-upload-status");
+  if (!form || !fileInput || !tokenInput || !form.dataset.uploadUrl) return;
+
+  let pendingUpload = null;
+  // numéro de la sélection en cours : un upload terminé après un changement de fichier est ignoré
+  let selection = 0;
+
+  function startUpload(file, selectionId) {
+    tokenInput.value = "";
+    if (proofInput) proofInput.value = "";
+    status.textContent = "Envoi du justificatif...";
+
+    return fetch(form.dataset.uploadUrl, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ filename: file.name }),
+    })
+      .then((resp) => {
+        if (!resp.ok) throw new Error(`HTTP ${resp.status}`);
+        return resp.json();
+      })
+      .then((ticket) => {
+        const onProgress = (pct) => {
+          status.textContent = `Envoi du justificatif... ${pct}%`;
+        };
+        if (ticket.provider === "cloudinary") {
+          const body = new FormData();
+          Object.entries(ticket.fields).forEach(([k, v]) => body.append(k, v));
+          body.append("file", file);
+          return uploadWithProgress("POST", ticket.upload_url, body, onProgress).then((responseText) => {
+            const res = JSON.parse(responseText);
+            const proof = JSON.stringify({
+              public_id: res.public_id,
+              version: res.version,
+              signature: res.signature,
+              format: res.format,
+            });
+            return { token: ticket.token, proof };
+          });
+        }
+        // stockage local : la réponse donne le jeton du fichier rangé (adresse de contenu)
+        return uploadWithProgress("PUT", ticket.upload_url, file, onProgress)
+          .then((responseText) => ({ token: JSON.parse(responseText).token, proof: "" }));
+      })
+      .then(({ token, proof }) => {
+        // on vérifie que c'est toujours le fichier sélectionné
+        if (selectionId === selection) {
+          tokenInput.value = token;
+          if (proofInput) proofInput.value = proof;
+          status.textContent = "Justificatif envoyé ✅";
+        }
+      })
+      .catch((err) => {
+        // échec : le fichier partira avec le formulaire, comme avant
+        console.error("Upload direct impossible :", err);
+        status.textContent = "";
+      });
+  }
+
+  const maxDimension = parseInt(form.dataset.compressMax, 10) || 2000;
+  const quality = parseFloat(form.dataset.compressQuality) || 0.8;
+
+  fileInput.addEventListener("change", () => {
+    const file = fileInput.files && fileInput.files[0];
+    const selectionId = ++selection;
+    tokenInput.value = "";
+    if (proofInput) proofInput.value = "";
+    if (!file) {
+      receiptFileReady = pendingUpload = null;
+      status.textContent = "";
+      return;
+    }
+
+    status.textContent = "Préparation de la photo...";
+    receiptFileReady = compressReceipt(file, maxDimension, quality).then((compact) => {
+      // le champ contient désormais la version allégée (utilisée aussi par le scan
+      // et par l'envoi classique du formulaire si l'upload direct échoue)
+      if (compact !== file && selectionId === selection && window.DataTransfer) {
+        const dt = new DataTransfer();
+        dt.items.add(compact);
+        fileInput.files = dt.files;
+      }
+      return compact;
+    });
+    pendingUpload = receiptFileReady.then((compact) => startUpload(compact, selectionId));
+  });
+
+  form.addEventListener("submit", (evt) => {
+    if (form.dataset.submitting) return;
+    evt.preventDefault();
+    const submitBtn = form.querySelector('button[type="submit"]');
+    if (submitBtn) submitBtn.disabled = true;
+
+    Promise.resolve(pendingUpload).then(() => {
+      // justificatif déjà stocké : inutile de renvoyer le fichier avec le formulaire
+      if (tokenInput.value) fileInput.disabled = true;
+      form.dataset.submitting = "1";
+      form.submit();
+    });
+  });
+}
+
 document.addEventListener("DOMContentLoaded", () => {
   setupFiltersAndSorting();
   setupScanButton();
+  setupDirectUpload();
+  setupExportJobs();
+  setupBulkActions();
 });
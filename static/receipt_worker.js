@@ -0,0 +1,28 @@
+// Web Worker : réduit et recompresse une photo de ticket avant l'envoi
+// (hors du thread principal pour ne pas figer la page sur les gros fichiers).
+// Message reçu : { id, file, maxDimension, quality } ; réponse : { id, blob } ou { id, error }.
+
+self.onmessage = async (evt) => {
+  const { id, file, maxDimension, quality } = evt.data;
+  try {
+    // imageOrientation : applique la rotation EXIF des photos de téléphone
+    const bitmap = await createImageBitmap(file, { imageOrientation: "from-image" });
+    const scale = Math.min(1, maxDimension / Math.max(bitmap.width, bitmap.height));
+    const width = Math.round(bitmap.width * scale);
+    const height = Math.round(bitmap.height * scale);
+
+    const canvas = new OffscreenCanvas(width, height);
+    const ctx = canvas.getContext("2d");
+    // fond blanc : les PNG transparents ne deviennent pas noirs en JPEG
+    ctx.fillStyle = "#fff";
+    ctx.fillRect(0, 0, width, height);
+    ctx.drawImage(bitmap, 0, 0, width, height);
+    bitmap.close();
+
+    const blob = await canvas.convertToBlob({ type: "image/jpeg", quality });
+    // déjà plus petit à l'origine (photo déjà compressée) : on garde l'original
+    self.postMessage({ id, blob: blob.size < file.size ? blob : null });
+  } catch (err) {
+    self.postMessage({ id, error: String(err) });
+  }
+};